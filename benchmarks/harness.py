@@ -0,0 +1,57 @@
+"""
+Helpers shared by the benchmarks: a manifestservice app running against a local
+in-memory s3 stand-in (moto), with authentication bypassed.
+
+Run the benchmarks from the root of the repository, e.g.:
+
+    python -m benchmarks.offset_index_bench
+"""
+
+import contextlib
+import os
+import time
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+BUCKET = "benchmark-manifest-bucket"
+
+
+@contextlib.contextmanager
+def local_app(config=None, sub="18"):
+    """
+    Yields a Flask test client for an app storing files in a moto bucket, and
+    authenticating every request as user `sub`.
+    """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    from manifestservice.api import create_app
+
+    app = create_app()
+    app.config["MANIFEST_BUCKET_NAME"] = BUCKET
+    app.config.update(config or {})
+
+    with mock_aws(), mock.patch(
+        "manifestservice.manifests._authenticate_user", return_value=(None, 200)
+    ), mock.patch(
+        "manifestservice.manifests.current_token", new={"sub": sub, "aud": ["user"]}
+    ):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        with app.app_context():
+            yield app.test_client()
+
+
+def timed(fn, repeat=5):
+    """
+    Returns the best wall-clock time, in seconds, of `repeat` calls to `fn`.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,100 @@
+"""
+Compares the time and peak memory of building and serializing a large folder
+listing, the way it was done before manifestservice.listing (a dict per file,
+sorted() copies and a single jsonify) and with the compact streamed listing.
+s3 is replaced by a fake paginator so that only the service's work is measured.
+
+    python -m benchmarks.listing_bench [--files 100000]
+"""
+
+import argparse
+import ntpath
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import flask
+
+from manifestservice import listing, manifests
+
+from .harness import timed
+
+
+def _fake_client(folder, count):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    contents = [
+        {
+            "Key": f"{folder}/manifest-{start + timedelta(seconds=i):%Y-%m-%dT%H-%M-%S}.json",
+            "LastModified": start + timedelta(seconds=i),
+            "Size": 1000,
+        }
+        for i in range(count)
+    ]
+    pages = [contents[i : i + 1000] for i in range(0, count, 1000)]
+    client = mock.MagicMock()
+    client.get_paginator.return_value.paginate.side_effect = lambda **kw: (
+        {"Contents": page} for page in pages
+    )
+    return client
+
+
+def legacy_listing(client, bucket, folder):
+    manifest_files = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder + "/"):
+        for obj in page["Contents"]:
+            manifest_files.append(
+                {
+                    "filename": ntpath.basename(obj["Key"]),
+                    "last_modified": obj["LastModified"].strftime("%Y-%m-%d %H:%M:%S"),
+                    "last_modified_timestamp": datetime.timestamp(obj["LastModified"]),
+                }
+            )
+    manifest_files = sorted(manifest_files, key=lambda i: i["last_modified_timestamp"])
+    return flask.jsonify({"manifests": manifest_files}).get_data()
+
+
+def streamed_listing(client, bucket, folder):
+    with mock.patch("manifestservice.storage.get_s3_client", return_value=client):
+        files, ok = listing.list_files_uncoalesced(bucket, folder)
+    assert ok, files
+    response = manifests._listing_response("manifests", files["manifests"])
+    # consume the body the way the server sends it, one chunk at a time
+    return sum(len(chunk) for chunk in response.response)
+
+
+def _peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = flask.Flask(__name__)
+    client = _fake_client("user-18", args.files)
+    with app.app_context():
+        # the fake s3 pages are shared by both runs and not part of the peak
+        legacy = lambda: legacy_listing(client, "bucket", "user-18")
+        streamed = lambda: streamed_listing(client, "bucket", "user-18")
+        with mock.patch("manifestservice.storage.get_s3_client", return_value=client):
+            files, _ = listing.list_files_uncoalesced("bucket", "user-18")
+        body = manifests._listing_response("manifests", files["manifests"]).get_data()
+        assert flask.json.loads(legacy()) == flask.json.loads(body)
+        results = [
+            (name, timed(fn), _peak_memory(fn))
+            for name, fn in [("dicts + jsonify", legacy), ("streamed", streamed)]
+        ]
+
+    print(f"Listing a folder of {args.files} files:")
+    for name, elapsed, peak in results:
+        print(f"  {name:16} {elapsed * 1000:8.1f} ms {peak / 2**20:8.1f} MiB peak")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+"""
+End-to-end load test. Starts a local s3 stand-in (moto server) and the service
+under gunicorn, replays a weighted mix of user sessions against it from
+concurrent clients, and reports throughput, p50/p99 latency and error rate for
+each combination of gunicorn worker and thread counts:
+
+    python -m benchmarks.loadgen --workers 1,2 --threads 1,8 --clients 16 \\
+        --duration 30 --output load-report.json
+
+Sessions:
+- ui_session: a user opening the export page, listing their manifests, cohorts
+  and metadata files and downloading one manifest
+- bulk_export: an export from the portal, uploading a manifest, a cohort GUID
+  and a metadata file, then refreshing the listing
+- large_upload: an upload of a large manifest
+
+The report file records the commit it was run on; pass an older report with
+--compare to print the change of throughput and p99 latency for each run.
+Clients are threads of this process, so keep an eye on its CPU usage: a
+saturated load generator measures itself rather than the service.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import boto3
+import requests
+
+BUCKET = "load-test-manifest-bucket"
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = "ui_session=0.75,bulk_export=0.2,large_upload=0.05"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _manifest_body(records):
+    return json.dumps(
+        [
+            {
+                "object_id": f"dg.1234/{uuid.uuid4()}",
+                "subject_id": f"subject-{i % 500}",
+            }
+            for i in range(records)
+        ]
+    ).encode("utf-8")
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+class LocalS3(object):
+    """
+    A moto server with the manifest bucket, seeded with `seed_manifests`
+    manifests per user.
+    """
+
+    def __init__(self):
+        from moto.server import ThreadedMotoServer
+
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        # do not log every s3 request
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        self.server = ThreadedMotoServer(ip_address="127.0.0.1", port=self.port)
+        self.server.start()
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=self.url,
+            region_name="us-east-1",
+            aws_access_key_id="load-test",
+            aws_secret_access_key="load-test",
+        )
+
+    def reset(self, users, seed_manifests, manifest_body):
+        requests.post(self.url + "/moto-api/reset").raise_for_status()
+        self.client.create_bucket(Bucket=BUCKET)
+        for user in users:
+            for i in range(seed_manifests):
+                self.client.put_object(
+                    Bucket=BUCKET,
+                    Key=f"user-{user}/manifest-2024-01-01T00-00-00.{i:06d}.json",
+                    Body=manifest_body,
+                )
+
+    def stop(self):
+        self.server.stop()
+
+
+class Service(object):
+    """
+    The service running under gunicorn against the local s3, with
+    authentication bypassed (see benchmarks/load_app.py).
+    """
+
+    def __init__(self, s3_url, workers, threads, config=None):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.workdir = tempfile.TemporaryDirectory()
+        # the config file must be in the working directory of the service
+        config_path = os.path.join(self.workdir.name, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(
+                dict(
+                    {"hostname": "localhost", "manifest_bucket_name": BUCKET},
+                    **(config or {}),
+                ),
+                f,
+            )
+        env = dict(
+            os.environ,
+            PYTHONPATH=REPO_ROOT,
+            MANIFEST_SERVICE_CONFIG_PATH=config_path,
+            AWS_ENDPOINT_URL_S3=s3_url,
+            AWS_ACCESS_KEY_ID="load-test",
+            AWS_SECRET_ACCESS_KEY="load-test",
+        )
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "--chdir",
+                self.workdir.name,
+                "--bind",
+                f"127.0.0.1:{self.port}",
+                "--workers",
+                str(workers),
+                "--threads",
+                str(threads),
+                "--worker-class",
+                "gthread",
+                "--timeout",
+                "300",
+                "--log-level",
+                "warning",
+                "benchmarks.load_app:application",
+            ],
+            env=env,
+        )
+        self._wait_until_ready()
+
+    def _wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The service failed to start")
+            try:
+                if requests.get(self.url + "/_status", timeout=1).ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("The service did not start in time")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+        self.workdir.cleanup()
+
+
+class Client(object):
+    """
+    A simulated user making requests with a keep-alive connection and recording
+    (endpoint, status, latency) for each of them.
+    """
+
+    def __init__(self, base_url, user, recorder):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.headers["X-Benchmark-User"] = str(user)
+        self.recorder = recorder
+
+    def request(self, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, timeout=120, **kwargs
+            )
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        self.recorder(endpoint, status, time.perf_counter() - start)
+        return response
+
+
+def ui_session(client, bodies, rng):
+    listing = client.request("GET /", "GET", "/")
+    client.request("GET /cohorts", "GET", "/cohorts")
+    client.request("GET /metadata", "GET", "/metadata")
+    if listing is not None and listing.ok and listing.json()["manifests"]:
+        manifest = rng.choice(listing.json()["manifests"])
+        client.request("GET /file", "GET", "/file/" + manifest["filename"])
+
+
+def bulk_export(client, bodies, rng):
+    headers = {"Content-Type": "application/json"}
+    client.request("POST /", "POST", "/", data=bodies["manifest"], headers=headers)
+    client.request(
+        "POST /cohorts", "POST", "/cohorts", json={"guid": str(uuid.uuid4())}
+    )
+    client.request(
+        "POST /metadata", "POST", "/metadata", json={"export": str(uuid.uuid4())}
+    )
+    client.request("GET /", "GET", "/")
+
+
+def large_upload(client, bodies, rng):
+    headers = {"Content-Type": "application/json"}
+    client.request("POST / (large)", "POST", "/", data=bodies["large"], headers=headers)
+
+
+SESSIONS = {
+    "ui_session": ui_session,
+    "bulk_export": bulk_export,
+    "large_upload": large_upload,
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SESSIONS:
+            raise ValueError(f"Unknown session {name}; use one of {list(SESSIONS)}")
+        weights[name] = float(weight)
+    return weights
+
+
+def run_load(base_url, args, bodies, weights):
+    """
+    Runs `args.clients` concurrent simulated users for `args.warmup` +
+    `args.duration` seconds and returns the results of the measured part.
+    """
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    measuring = threading.Event()
+    stop = threading.Event()
+    names, session_weights = zip(*weights.items())
+
+    def record(endpoint, status, latency):
+        if not measuring.is_set():
+            return
+        with lock:
+            latencies[endpoint].append(latency)
+            if not 200 <= status < 400:
+                errors[endpoint] += 1
+
+    def run_client(i):
+        rng = random.Random(i)
+        client = Client(base_url, rng.randrange(args.users), record)
+        while not stop.is_set():
+            session = rng.choices(names, session_weights)[0]
+            SESSIONS[session](client, bodies, rng)
+
+    threads = [
+        threading.Thread(target=run_client, args=(i,), daemon=True)
+        for i in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup)
+    measuring.set()
+    start = time.monotonic()
+    time.sleep(args.duration)
+    measuring.clear()
+    elapsed = time.monotonic() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    all_latencies = sorted(l for values in latencies.values() for l in values)
+    total_errors = sum(errors.values())
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "p50_ms": _percentile(values, 50) * 1000,
+            "p99_ms": _percentile(values, 99) * 1000,
+            "error_rate": errors[endpoint] / len(values),
+        }
+    return {
+        "requests": len(all_latencies),
+        "throughput": len(all_latencies) / elapsed,
+        "p50_ms": (_percentile(all_latencies, 50) or 0) * 1000,
+        "p99_ms": (_percentile(all_latencies, 99) or 0) * 1000,
+        "error_rate": total_errors / len(all_latencies) if all_latencies else 0,
+        "endpoints": endpoints,
+    }
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=REPO_ROOT,
+                text=True,
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def print_run(run):
+    print(
+        "workers={workers:<3} threads={threads:<3} {throughput:8.1f} req/s  "
+        "p50 {p50_ms:8.1f} ms  p99 {p99_ms:8.1f} ms  errors {error_rate:6.2%}".format(
+            **run
+        )
+    )
+    for endpoint, stats in run["endpoints"].items():
+        print(
+            "    {:18} {requests:7d} req  p50 {p50_ms:8.1f} ms  "
+            "p99 {p99_ms:8.1f} ms  errors {error_rate:6.2%}".format(endpoint, **stats)
+        )
+
+
+def compare(report, previous):
+    print(f"Compared to {previous.get('commit')}:")
+    previous_runs = {(r["workers"], r["threads"]): r for r in previous["runs"]}
+    for run in report["runs"]:
+        old = previous_runs.get((run["workers"], run["threads"]))
+        if old is None:
+            continue
+        print(
+            "workers={:<3} threads={:<3} throughput {:+7.1%}  p99 {:+7.1%}  "
+            "errors {:6.2%} -> {:6.2%}".format(
+                run["workers"],
+                run["threads"],
+                run["throughput"] / old["throughput"] - 1,
+                run["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0,
+                old["error_rate"],
+                run["error_rate"],
+            )
+        )
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--workers", type=_int_list, default=[1, 2])
+    parser.add_argument("--threads", type=_int_list, default=[1, 8])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds per run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="session=weight,...")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed-manifests", type=int, default=20)
+    parser.add_argument("--manifest-records", type=int, default=1000)
+    parser.add_argument("--large-records", type=int, default=100000)
+    parser.add_argument(
+        "--config", type=json.loads, default={}, help="extra config.json keys, as JSON"
+    )
+    parser.add_argument("--output", help="report file to write")
+    parser.add_argument("--compare", help="report file of a previous run")
+    args = parser.parse_args(args)
+
+    weights = parse_mix(args.mix)
+    bodies = {
+        "manifest": _manifest_body(args.manifest_records),
+        "large": _manifest_body(args.large_records),
+    }
+    commit, dirty = _git_commit()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare")
+        },
+        "runs": [],
+    }
+
+    s3 = LocalS3()
+    try:
+        for workers in args.workers:
+            for threads in args.threads:
+                s3.reset(range(args.users), args.seed_manifests, bodies["manifest"])
+                service = Service(s3.url, workers, threads, args.config)
+                try:
+                    run = run_load(service.url, args, bodies, weights)
+                finally:
+                    service.stop()
+                run = dict(run, workers=workers, threads=threads)
+                report["runs"].append(run)
+                print_run(run)
+    finally:
+        s3.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Compares reading one record deep into a large manifest with and without the
+offset index sidecar (manifest_index_stride).
+
+    python -m benchmarks.offset_index_bench [--records 1000000] [--record 900000]
+"""
+
+import argparse
+
+from .harness import local_app, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--record", type=int, default=900000)
+    parser.add_argument("--stride", type=int, default=1000)
+    args = parser.parse_args()
+
+    manifest = [
+        {"object_id": f"dg.1234/{i:08d}", "subject_id": f"subject-{i % 5000}"}
+        for i in range(args.records)
+    ]
+
+    with local_app({"manifest_index_stride": args.stride}) as client:
+        r = client.post("/", json=manifest)
+        assert r.status_code == 200, r.json
+        url = f"/file/{r.json['filename']}?offset={args.record}&limit=1"
+        expected = [manifest[args.record]]
+
+        def read():
+            r = client.get(url)
+            assert r.json == expected, r.data
+
+        with_index = timed(read)
+        # the index is only looked up when indexing is enabled
+        client.application.config["manifest_index_stride"] = 0
+        without_index = timed(read)
+
+    print(f"Reading record {args.record} of a {args.records}-record manifest:")
+    print(f"  without offset index: {without_index * 1000:10.1f} ms")
+    print(f"  with offset index:    {with_index * 1000:10.1f} ms")
+    print(f"  speedup:              {without_index / with_index:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
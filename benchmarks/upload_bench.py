@@ -0,0 +1,93 @@
+"""
+Compares the CPU time and peak memory, per MB uploaded, of validating a manifest
+upload and storing the request body as sent, with parsing it and serializing it
+again (how uploads were handled before), and measures the full upload request.
+
+    python -m benchmarks.upload_bench [--records 200000] [--stride 1000]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from manifestservice import streaming
+from manifestservice.manifests import is_valid_manifest
+
+from .harness import local_app
+
+REQUIRED_KEYS = ["object_id"]
+
+
+def reserialize(body, stride):
+    manifest = json.loads(body)
+    assert is_valid_manifest(manifest, REQUIRED_KEYS)
+    return streaming.serialize_with_offsets(manifest, stride)
+
+
+def passthrough(body, stride):
+    return streaming.scan_json_array(
+        body,
+        stride,
+        validate=lambda record: isinstance(record, dict)
+        and is_valid_manifest([record], REQUIRED_KEYS),
+    )
+
+
+def measure(fn, repeat=3):
+    """
+    Returns the best CPU time, in seconds, of `repeat` calls to `fn`, and the
+    peak memory, in bytes, allocated by one call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--stride", type=int, default=1000)
+    args = parser.parse_args()
+
+    manifest = [
+        {"object_id": f"dg.1234/{i:08d}", "subject_id": f"subject-{i % 5000}"}
+        for i in range(args.records)
+    ]
+    body = json.dumps(manifest).encode("utf-8")
+    megabytes = len(body) / 1024 / 1024
+    del manifest
+
+    results = {
+        "parse and re-serialize": measure(lambda: reserialize(body, args.stride)),
+        "validate, store as sent": measure(lambda: passthrough(body, args.stride)),
+    }
+    with local_app({"manifest_index_stride": args.stride}) as client:
+
+        def upload():
+            r = client.post(
+                "/", data=body, headers={"Content-Type": "application/json"}
+            )
+            assert r.status_code == 200, r.json
+
+        results["upload request"] = measure(upload)
+
+    print(f"{args.records}-record manifest upload ({megabytes:.1f} MB):")
+    print(f"  {'':24}  {'CPU ms/MB':>10}  {'peak MB/MB':>10}")
+    for name, (cpu, peak) in results.items():
+        print(
+            f"  {name:24}  {cpu * 1000 / megabytes:10.1f}"
+            f"  {peak / 1024 / 1024 / megabytes:10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
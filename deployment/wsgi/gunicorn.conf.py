@@ -1,6 +1,19 @@
 wsgi_app = "deployment.wsgi.wsgi:application"
 bind = "0.0.0.0:8000"
 workers = 1
+# threads let GET /watch requests wait for new files without blocking the worker;
+# at most `watch_max_waiters` threads wait at once
+worker_class = "gthread"
+threads = 16
 user = "gen3"
 group = "gen3"
 timeout = 300
+# seconds for a worker to finish its requests and drain its background tasks
+graceful_timeout = 45
+
+
+def worker_exit(server, worker):
+    from manifestservice import tasks
+    from manifestservice.api import app
+
+    tasks.shutdown(app)
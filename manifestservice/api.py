@@ -2,6 +2,7 @@ import flask
 import logging
 import time
 
+from . import deadlines, tasks, tracing
 from .manifests import blueprint as manifests_bp
 import os
 import json
@@ -23,6 +24,9 @@ def validate_config_path(config_path):
 def create_app():
     app = flask.Flask(__name__)
     app.register_blueprint(manifests_bp, url_prefix="")
+    tracing.init_app(app)
+    deadlines.init_app(app)
+    tasks.init_app(app)
 
     # load configuration
     config_path = os.environ.get("MANIFEST_SERVICE_CONFIG_PATH", "config.json")
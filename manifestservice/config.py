@@ -0,0 +1,85 @@
+"""
+Defaults for the optional config.json keys. See the README for what each key
+does.
+"""
+
+import flask
+
+DEFAULTS = {
+    "request_timeout": 60,
+    "request_timeouts": {
+        "manifests.put_manifest": 120,
+        "manifests.put_metadata": 120,
+        "manifests.put_metadata_upload_part": 120,
+        "manifests.commit_metadata_upload": 120,
+        "manifests.delete_files": 120,
+        "manifests.combine_manifests": 300,
+        "manifests.rebuild_object_index": 300,
+        "manifests.export_files": 300,
+    },
+    "s3_region": "us-east-1",
+    "s3_read_replicas": [],
+    "s3_local_region": None,
+    "s3_connect_timeout": 5,
+    "s3_read_timeout": 60,
+    "s3_max_attempts": 3,
+    "s3_retry_mode": "adaptive",
+    "circuit_breaker_failure_threshold": 5,
+    "circuit_breaker_reset_timeout": 30,
+    "hedged_reads": False,
+    "hedged_read_percentile": 95,
+    "single_flight": True,
+    "single_flight_max_keys": 1024,
+    "manifest_index_stride": 0,
+    "manifest_max_record_size": 64 * 1024 * 1024,
+    "object_index": False,
+    "object_index_fields": ["object_id"],
+    "object_index_partitions": 16,
+    "combine_sort_run_size": 100000,
+    "deduplicate_uploads": False,
+    "upload_record_max_age_days": 30,
+    "rate_limit_read_per_second": 0,
+    "rate_limit_read_burst": 20,
+    "rate_limit_write_per_second": 0,
+    "rate_limit_write_burst": 5,
+    "rate_limit_redis_url": None,
+    "sync_token_max_age": 86400,
+    "sync_overlap": 10,
+    "listing_cache_ttl": 0,
+    "invalidation_bus": "local",
+    "invalidation_bus_redis_url": None,
+    "invalidation_bus_heartbeat": 5,
+    "watch_timeout": 25,
+    "watch_poll_interval": 5,
+    "watch_max_waiters": 8,
+    "tracing_sample_rate": 0,
+    "tracing_exporter": "log",
+    "tracing_file_path": "traces.jsonl",
+    "tracing_otlp_endpoint": "http://localhost:4318/v1/traces",
+    "server_timing": False,
+    "quota_max_files": 0,
+    "quota_max_bytes": 0,
+    "metadata_upload_max_chunk_size": 64 * 1024 * 1024,
+    "background_tasks": False,
+    "background_task_workers": 4,
+    "background_task_queue_size": 1000,
+    "background_task_max_attempts": 3,
+    "background_task_retry_delay": 1,
+    "background_task_drain_timeout": 30,
+    "background_task_queue_path": None,
+    "export_bucket": None,
+    "export_prefix": "user-{sub}/",
+    "export_region": None,
+    "export_workers": 8,
+    "key_layout": "legacy",
+    "key_shard_width": 2,
+    "key_layout_fallback": True,
+}
+
+
+def get_config(key):
+    """
+    Returns the value of an optional config key for the current app, or its
+    default value if it is not set in config.json.
+    """
+    return flask.current_app.config.get(key, DEFAULTS.get(key))
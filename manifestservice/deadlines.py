@@ -0,0 +1,146 @@
+"""
+Request deadlines: every request gets a time budget, "request_timeout" seconds
+or the route's entry in "request_timeouts", which clients can shorten with an
+X-Request-Timeout header (in seconds) when they give up sooner.
+
+s3 calls made for the request only use what is left of the budget: the s3
+client is picked with a read timeout that fits in the remaining time (see
+storage.get_s3_client()), and no call or retry is attempted once the deadline
+has passed; DeadlineExceeded is raised instead. The request then ends with a
+504 rather than keeping a worker thread busy for a client that is gone.
+"""
+
+import contextvars
+import time
+
+import flask
+
+from .config import get_config
+
+# read timeouts of the s3 clients used by requests with a deadline, so that
+# only a few clients (and connection pools) are created
+READ_TIMEOUT_STEPS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+_current_deadline = contextvars.ContextVar("manifestservice_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+        self.exceeded = False
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            self.exceeded = True
+            raise DeadlineExceeded(
+                f"The request did not complete within {self.timeout:g} seconds."
+            )
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+def remaining(default=None):
+    """
+    Returns the seconds left before the deadline of the current request, or
+    `default` if there is none.
+    """
+    deadline = _current_deadline.get()
+    return default if deadline is None else deadline.remaining()
+
+
+def check():
+    """
+    Raises DeadlineExceeded if the deadline of the current request has passed.
+    """
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def read_timeout(configured):
+    """
+    Returns the read timeout for an s3 call made now: the largest of
+    READ_TIMEOUT_STEPS that fits in the remaining time, capped to the
+    `configured` timeout.
+    """
+    left = remaining()
+    if left is None or left >= configured:
+        return configured
+    fitting = [step for step in READ_TIMEOUT_STEPS if step <= left]
+    return fitting[-1] if fitting else READ_TIMEOUT_STEPS[0]
+
+
+def _before_s3_send(**kwargs):
+    # called before every attempt, retries included
+    check()
+
+
+def instrument_s3_client(client):
+    """
+    Makes every call and retry of a boto3 s3 client fail with DeadlineExceeded
+    once the deadline of the current request has passed.
+    """
+    client.meta.events.register_first("before-send.s3", _before_s3_send)
+    return client
+
+
+def _route_timeout():
+    timeouts = get_config("request_timeouts")
+    timeout = timeouts.get(flask.request.endpoint) if flask.request.endpoint else None
+    if timeout is None:
+        timeout = get_config("request_timeout")
+    header = flask.request.headers.get("X-Request-Timeout")
+    if header:
+        try:
+            timeout = min(timeout, max(float(header), 0))
+        except ValueError:
+            pass
+    return timeout
+
+
+def _before_request():
+    deadline = Deadline(_route_timeout())
+    flask.g.manifestservice_deadline = deadline
+    flask.g.manifestservice_deadline_token = _current_deadline.set(deadline)
+
+
+def _after_request(response):
+    # errors caused by the deadline are reported as such, whichever code path
+    # turned them into an error response
+    deadline = flask.g.get("manifestservice_deadline")
+    if deadline is not None and deadline.exceeded and response.status_code >= 500:
+        return _timeout_response(deadline)
+    return response
+
+
+def _teardown_request(exc):
+    token = flask.g.pop("manifestservice_deadline_token", None)
+    if token is not None:
+        _current_deadline.reset(token)
+
+
+def _timeout_response(deadline):
+    error = f"The request did not complete within {deadline.timeout:g} seconds."
+    return flask.make_response(flask.jsonify({"error": error}), 504)
+
+
+def _handle_deadline_exceeded(e):
+    deadline = flask.g.get("manifestservice_deadline") or Deadline(0)
+    return _timeout_response(deadline)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_error_handler(DeadlineExceeded, _handle_deadline_exceeded)
@@ -0,0 +1,106 @@
+"""
+Server-side copies of the files of a user folder to the workspace storage
+configured with "export_bucket" and "export_prefix": the files do not go
+through the service. The copies of a request run concurrently, in a pool of
+"export_workers" threads shared by the requests of the worker.
+"""
+
+import contextvars
+from concurrent import futures
+
+import flask
+from cdislogging import get_logger
+
+from . import files, listing, storage, tracing
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+# Types of files that can be exported
+EXPORTABLE_FILE_TYPES = ("manifests", "metadata")
+
+
+def export_files(folder_name, sub, files_by_type):
+    """
+    Copies files of the folder of the user `sub` to the export destination.
+    Returns ((exported, errors), True), where `exported` lists the type,
+    filename and destination key of every copied file and `errors` the type,
+    filename and error of the others, or (error, False) if the user's files
+    cannot be listed.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    result, ok = listing.list_files(bucket_name, folder_name)
+    if not ok:
+        return result, False
+    prefix = get_config("export_prefix").format(sub=sub)
+
+    pool = storage.app_state(
+        "export_pool",
+        lambda: futures.ThreadPoolExecutor(
+            max_workers=get_config("export_workers"), thread_name_prefix="export"
+        ),
+    )
+    exported = []
+    errors = []
+    copies = []
+    for file_type, filenames in files_by_type.items():
+        sizes = {entry["filename"]: entry.size for entry in result[file_type]}
+        for filename in filenames:
+            if filename not in sizes:
+                errors.append(
+                    {"type": file_type, "filename": filename, "error": "Not found."}
+                )
+                continue
+            key = prefix + filename
+            # the copies see the deadline and trace of the request
+            future = pool.submit(
+                contextvars.copy_context().run,
+                _export_file,
+                folder_name,
+                file_type,
+                filename,
+                sizes[filename],
+                key,
+            )
+            copies.append((file_type, filename, key, future))
+
+    for file_type, filename, key, future in copies:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Failed to export {filename} of {folder_name}: {e}")
+            message = "Currently unable to connect to s3."
+            if storage.is_not_found(e):
+                message = "Not found."
+            errors.append({"type": file_type, "filename": filename, "error": message})
+            continue
+        exported.append({"type": file_type, "filename": filename, "key": key})
+    return (exported, errors), True
+
+
+def _export_file(folder_name, file_type, filename, size, key):
+    """
+    Copies a file of the user's folder, or of the user's legacy folder if it is
+    not found there, to `key` in the export bucket.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    subfolder = files.DELETABLE_FILE_TYPES[file_type][0]
+
+    def copy(folder):
+        storage.copy_object(
+            bucket_name,
+            f"{folder}/{subfolder}{filename}",
+            get_config("export_bucket"),
+            key,
+            size,
+            region=get_config("export_region"),
+        )
+
+    with tracing.span("export", bytes=size):
+        try:
+            copy(folder_name)
+        except Exception as e:
+            legacy_folder = listing.get_legacy_folder(folder_name)
+            if not (legacy_folder and storage.is_not_found(e)):
+                raise
+            copy(legacy_folder)
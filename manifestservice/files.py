@@ -0,0 +1,178 @@
+"""
+Reads and deletions of the files of a user folder. Files of users of the
+sharded key layout who were not migrated yet are read from, and deleted from,
+their legacy folder too (see layout.py).
+"""
+
+import flask
+from cdislogging import get_logger
+
+from . import layout, listing, sidecars, storage, streaming, sync, tracing
+from .config import get_config
+from .resilience import CircuitOpenError
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+# Where each type of file is stored in a user folder, and the kinds of sidecar
+# files deleted along with it
+DELETABLE_FILE_TYPES = {
+    "manifests": ("", ["index"]),
+    "cohorts": ("cohorts/", []),
+    "metadata": ("exported-metadata/", []),
+}
+
+
+def read_file(bucket_name, folder, filename):
+    """
+    Returns the body of a file as a string, with single quotes replaced by
+    double quotes if it was stored with single quotes by older versions of the
+    service. Raises if the file cannot be read from s3.
+    """
+    with tracing.span("read_file") as span:
+        as_bytes = storage.get_object_body(
+            bucket_name, folder + "/" + filename, from_replica=True
+        )
+        span.set(bytes=len(as_bytes))
+    as_string = as_bytes.decode("utf-8")
+    if not streaming.is_single_quoted(as_string):
+        return as_string
+    return as_string.replace("'", '"')
+
+
+def open_manifest_stream(bucket_name, folder_name, filename):
+    """
+    Starts a GET of a manifest of the user's folder, or of the user's legacy
+    folder if it is not found there. Returns the s3 response.
+    """
+    try:
+        return storage.open_object_stream(bucket_name, f"{folder_name}/{filename}")
+    except Exception as e:
+        legacy_folder = listing.get_legacy_folder(folder_name)
+        if not (legacy_folder and storage.is_not_found(e)):
+            raise
+        return storage.open_object_stream(bucket_name, f"{legacy_folder}/{filename}")
+
+
+def open_manifest_slice(bucket_name, folder, filename, offset, limit):
+    """
+    Starts a GET of a manifest for reading `limit` records from `offset`, from
+    a read replica, falling back to the user's legacy folder if it is not found.
+    Only the part of the manifest holding the records is read if the manifest
+    has an offset index. Returns (response, offset) with the offset of the first
+    requested record within the response.
+    """
+    try:
+        return _open_slice(bucket_name, folder, filename, offset, limit)
+    except Exception as e:
+        legacy_folder = listing.get_legacy_folder(folder)
+        if not (legacy_folder and storage.is_not_found(e)):
+            raise
+        return _open_slice(bucket_name, legacy_folder, filename, offset, limit)
+
+
+def _open_slice(bucket_name, folder, filename, offset, limit):
+    if get_config("manifest_index_stride") and (offset or limit) and limit != 0:
+        response, offset = _open_indexed_range(
+            bucket_name, folder, filename, offset, limit
+        )
+        if response is not None:
+            return response, offset
+    response = storage.open_object_stream(
+        bucket_name, folder + "/" + filename, from_replica=True
+    )
+    return response, offset
+
+
+def _open_indexed_range(bucket_name, folder, filename, offset, limit):
+    """
+    Uses the offset index of a manifest, if it has one, to start a ranged GET of
+    only the part of the manifest that contains the requested records.
+    Returns (response, offset) with the offset of the first requested record
+    within the range, or (None, offset) if the whole manifest must be read.
+    """
+    index = sidecars.get_offset_index(folder, filename)
+    if not index:
+        return None, offset
+    byte_range = streaming.byte_range_for_records(index, offset, limit)
+    if byte_range is None:
+        # past the end of the manifest; let the regular read return no records
+        return None, offset
+
+    first_byte, last_byte, skip = byte_range
+    try:
+        response = storage.open_object_stream(
+            bucket_name,
+            folder + "/" + filename,
+            (first_byte, last_byte),
+            from_replica=True,
+        )
+    except Exception as e:
+        logger.warning(f"Ranged read of {filename} failed, reading it whole: {e}")
+        return None, offset
+
+    total_size = response.get("ContentRange", "").rpartition("/")[2]
+    if total_size != str(index["size"]):
+        # the manifest was replaced after the index was written
+        response["Body"].close()
+        return None, offset
+    return response, skip
+
+
+def delete_files(folder_name, files_by_type):
+    """
+    Deletes files from a user folder, along with their sidecar files.
+    `files_by_type` is a dict of file type ("manifests", "cohorts" or "metadata")
+    to filenames. Returns ((deleted, errors), True), where `deleted` has the same
+    format as `files_by_type` and `errors` is a list of
+    { "type", "filename", "error" } for the files that could not be deleted.
+    Files are deleted from the legacy folder of the user too, if any.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    folders = [folder_name]
+    legacy_folder = listing.get_legacy_folder(folder_name)
+    if legacy_folder:
+        folders.append(legacy_folder)
+    files_by_key = {}
+    sidecar_keys = []
+    for folder in folders:
+        for file_type, filenames in files_by_type.items():
+            sub_folder, sidecar_kinds = DELETABLE_FILE_TYPES[file_type]
+            for filename in filenames:
+                files_by_key[f"{folder}/{sub_folder}{filename}"] = (
+                    file_type,
+                    filename,
+                )
+                for kind in sidecar_kinds:
+                    sidecar_keys.append(layout.sidecar_key(folder, kind, filename))
+
+    try:
+        failed = storage.delete_objects(bucket_name, list(files_by_key) + sidecar_keys)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f'Failed to delete files in folder "{folder_name}": {e}')
+        return str(e), False
+
+    errors = []
+    failed_files = set()
+    for key, message in failed:
+        if key in files_by_key:
+            file_type, filename = files_by_key[key]
+            if (file_type, filename) not in failed_files:
+                failed_files.add((file_type, filename))
+                errors.append(
+                    {"type": file_type, "filename": filename, "error": message}
+                )
+        else:
+            logger.warning(f"Failed to delete sidecar file {key}: {message}")
+    deleted = {file_type: [] for file_type in files_by_type}
+    for file_type, filename in dict.fromkeys(files_by_key.values()):
+        if (file_type, filename) not in failed_files:
+            deleted[file_type].append(filename)
+
+    if deleted.get("manifests"):
+        for folder in folders:
+            sidecars.remove_manifest_summaries(folder, deleted["manifests"])
+    if any(deleted.values()):
+        sync.record_deletion(folder_name, deleted)
+    return (deleted, errors), True
@@ -0,0 +1,205 @@
+"""
+Invalidation bus: tells every worker of every pod that the files of a user
+folder changed, so that the state a worker derives from them (cached listings,
+requests watching the folder) is refreshed even when another worker or pod
+handled the write.
+
+Events are published by every write to a user folder and delivered to the
+subscribers of every worker, through a pluggable transport:
+
+- "local": in-process only, for single-worker deployments and tests;
+- "redis": a Redis pub/sub channel (the `redis` package must be installed),
+  shared by every worker and pod.
+
+Staleness is bounded when the bus is down: the Redis transport is only healthy
+while its subscription is connected and receives the heartbeats published by
+the workers, every "invalidation_bus_heartbeat" seconds. Caches are bypassed
+while the bus is unhealthy, and their entries expire after their TTL anyway.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+from cdislogging import get_logger
+
+from . import listing, storage, watch
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+_HEARTBEAT = "heartbeat"
+
+
+class LocalTransport(object):
+    """
+    Delivers messages to the buses sharing the same `hub` (a list), in process.
+    """
+
+    def __init__(self, hub=None):
+        self.hub = hub if hub is not None else []
+        self.healthy = True
+
+    def start(self, receive):
+        self.hub.append(receive)
+
+    def publish(self, message):
+        for receive in list(self.hub):
+            receive(message)
+
+    def close(self):
+        pass
+
+
+class RedisTransport(object):
+    """
+    Publishes messages to a Redis pub/sub channel, and receives them from a
+    subscriber thread, which reconnects after failures.
+    """
+
+    def __init__(self, client, channel="manifestservice:invalidation", heartbeat=5):
+        self.client = client
+        self.channel = channel
+        self.heartbeat = heartbeat
+        self._last_received = None
+        self._retry_publish_at = 0
+        self._closed = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url, socket_timeout=1), **kwargs)
+
+    @property
+    def healthy(self):
+        # the worker's own heartbeats come back through the channel
+        last = self._last_received
+        return last is not None and time.monotonic() - last < 3 * self.heartbeat
+
+    def start(self, receive):
+        self._thread = threading.Thread(
+            target=self._run, args=(receive,), name="invalidation-bus", daemon=True
+        )
+        self._thread.start()
+
+    def publish(self, message):
+        # do not wait on an unavailable Redis for every write; caches are not
+        # used until it is back (see healthy)
+        if time.monotonic() < self._retry_publish_at:
+            return
+        try:
+            self.client.publish(self.channel, message)
+        except Exception as e:
+            logger.warning(f"Failed to publish to the invalidation bus: {e}")
+            self._last_received = None
+            self._retry_publish_at = time.monotonic() + self.heartbeat
+
+    def _run(self, receive):
+        while not self._closed.is_set():
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                next_heartbeat = 0
+                while not self._closed.is_set():
+                    if time.monotonic() >= next_heartbeat:
+                        self.client.publish(self.channel, _HEARTBEAT)
+                        next_heartbeat = time.monotonic() + self.heartbeat
+                    message = pubsub.get_message(timeout=min(1, self.heartbeat))
+                    if message is None or message["type"] != "message":
+                        continue
+                    self._last_received = time.monotonic()
+                    data = message["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode("utf-8")
+                    if data != _HEARTBEAT:
+                        receive(data)
+            except Exception as e:
+                self._last_received = None
+                logger.warning(f"Invalidation bus unavailable, reconnecting: {e}")
+                self._closed.wait(self.heartbeat)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join(2 * self.heartbeat)
+
+
+class InvalidationBus(object):
+    """
+    Publishes folder change events and calls the subscribers, `fn(folder)`, for
+    the events of every worker, this one included.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.origin = uuid.uuid4().hex
+        self._subscribers = []
+        transport.start(self._receive)
+
+    @property
+    def healthy(self):
+        return self.transport.healthy
+
+    def subscribe(self, fn):
+        self._subscribers.append(fn)
+
+    def publish(self, folder):
+        # this worker's subscribers are called right away, not through the bus
+        self._deliver(folder)
+        self.transport.publish(json.dumps({"origin": self.origin, "folder": folder}))
+
+    def _receive(self, message):
+        try:
+            event = json.loads(message)
+            origin, folder = event["origin"], event["folder"]
+        except Exception as e:
+            logger.warning(f"Ignoring invalid invalidation event {message!r}: {e}")
+            return
+        if origin != self.origin:
+            self._deliver(folder)
+
+    def _deliver(self, folder):
+        for fn in self._subscribers:
+            try:
+                fn(folder)
+            except Exception as e:
+                logger.error(f"Invalidation of {folder} failed: {e}")
+
+    def close(self):
+        self.transport.close()
+
+
+def get_invalidation_bus():
+    """
+    Returns the invalidation bus of the app, through which the changes to a user
+    folder made by any worker drop this worker's cached listing of the folder
+    and wake up the requests watching it.
+    """
+    cache = listing.get_listing_cache()
+    notifier = watch.get_change_notifier()
+    transport = storage.app_state("invalidation_transport", _create_transport)
+
+    def create():
+        bus = InvalidationBus(transport)
+        bus.subscribe(cache.invalidate)
+        bus.subscribe(notifier.notify)
+        return bus
+
+    return storage.app_state("invalidation_bus", create)
+
+
+def _create_transport():
+    if get_config("invalidation_bus") == "redis":
+        return RedisTransport.from_url(
+            get_config("invalidation_bus_redis_url"),
+            heartbeat=get_config("invalidation_bus_heartbeat"),
+        )
+    return LocalTransport()
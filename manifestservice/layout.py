@@ -0,0 +1,135 @@
+"""
+Key layouts of the manifest bucket.
+
+In the "legacy" layout, the files of a user are under PREFIX/user-<sub>/. s3
+partitions request rates by key prefix, so busy users and bulk jobs end up
+sharing the limits of a few prefixes. In the "sharded" layout, the user folder
+is placed under a shard: the first `key_shard_width` hex characters of the
+SHA-256 of the user's id, PREFIX/<shard>/user-<sub>/, which spreads the users
+evenly over 16 ** width prefixes.
+
+While users are migrated from one layout to the other (see migrate_layout.py),
+the service reads from both: see legacy_folder().
+
+In both layouts, the files the service derives from a user's files (offset
+indexes, change journal...) are kept next to the user folder rather than in it,
+under .sidecars/user-<sub>/, so that listing a user's files never lists them.
+
+Moving a file resets its s3 last modification time, so the migration records
+the times the files had in a sidecar file, which listings, the usage report and
+the retention job read back (see original_last_modified()).
+"""
+
+import hashlib
+import ntpath
+import re
+from datetime import datetime
+
+SIDECAR_FOLDER = ".sidecars"
+
+# sidecar file, in the sidecar folder of a user folder, recording the last
+# modification times of the files moved there by the layout migration
+MOVED_FILES = "layout/moved.json"
+
+
+def shard(sub, width):
+    """
+    Returns the shard of the user with id `sub`.
+    """
+    return hashlib.sha256(str(sub).encode("utf-8")).hexdigest()[:width]
+
+
+def user_folder(root, sub, sharded=False, width=2):
+    """
+    Returns the folder of the user with id `sub` under `root` ("" or a prefix
+    ending with "/"), without a trailing slash.
+    """
+    if sharded:
+        return f"{root}{shard(sub, width)}/user-{sub}"
+    return f"{root}user-{sub}"
+
+
+def sidecar_folder(folder):
+    """
+    Returns the folder of the sidecar files of the user folder `folder`:
+    "<root>.sidecars/user-<sub>", or "<root><shard>/.sidecars/user-<sub>".
+    """
+    parent, _, name = folder.rpartition("/")
+    parent = parent + "/" if parent else ""
+    return f"{parent}{SIDECAR_FOLDER}/{name}"
+
+
+def sidecar_key(folder, kind, filename):
+    """
+    Returns the key of a file the service keeps alongside a file of the user
+    folder `folder`, such as its offset index: `filename` in the `kind`
+    sub-folder of the sidecar folder.
+    """
+    return f"{sidecar_folder(folder)}/{kind}/{filename}"
+
+
+def classify_key(key, folder):
+    """
+    Returns (file_type, filename) for an s3 key in the user folder `folder`,
+    where file_type is "manifests", "cohorts" or "metadata".
+    """
+    if "cohorts/" in key:
+        return "cohorts", key.split("cohorts/")[1]
+    if "metadata/" in key:
+        return "metadata", key.split("metadata/")[1]
+    if "\\" in key or key[1:2] == ":":
+        return "manifests", ntpath.basename(key)
+    # same as ntpath.basename() for keys without Windows path syntax, but faster
+    return "manifests", key.rpartition("/")[2]
+
+
+def moved_files_key(folder):
+    """
+    Returns the key of the MOVED_FILES sidecar file of the user folder `folder`.
+    """
+    return f"{sidecar_folder(folder)}/{MOVED_FILES}"
+
+
+def original_last_modified(moved_files, folder, key, last_modified):
+    """
+    Returns the last modification time of the object `key` of the user folder
+    `folder` as users know it: the time it had before the layout migration
+    moved it, according to `moved_files` (the contents of the MOVED_FILES
+    sidecar file, or None), or `last_modified` if it was not moved, or was
+    replaced after it was moved.
+    """
+    if not moved_files:
+        return last_modified
+    moved = moved_files["files"].get(key[len(folder) + 1 :])
+    if moved is None or datetime.fromisoformat(moved["moved"]) != last_modified:
+        return last_modified
+    return datetime.fromisoformat(moved["last_modified"])
+
+
+def is_shard(name, width=None):
+    """
+    Returns True if `name` (a key component) is a shard, of any width if
+    `width` is None.
+    """
+    pattern = r"[0-9a-f]+" if width is None else r"[0-9a-f]{%d}" % width
+    return re.fullmatch(pattern, name) is not None
+
+
+def legacy_folder(folder, width):
+    """
+    Returns the legacy equivalent of a folder of the sharded layout (a user
+    folder, or a sub-folder of one), or None if `folder` is not sharded.
+    """
+    match = re.search(r"(^|/)[0-9a-f]{%d}/(?=user-)" % width, folder)
+    if match is None:
+        return None
+    return folder[: match.start()] + match.group(1) + folder[match.end() :]
+
+
+def sharded_folder(folder, width):
+    """
+    Returns the sharded equivalent of a legacy user folder ("<root>user-<sub>").
+    """
+    root, _, name = folder.rpartition("/")
+    root = root + "/" if root else ""
+    return user_folder(root, name[len("user-") :], sharded=True, width=width)
@@ -0,0 +1,285 @@
+"""
+Listings of user folders: the s3 listing itself, and the compact representation
+and streamed serialization of its result.
+
+A listing can hold hundreds of thousands of entries, so each entry is a small
+__slots__ object keeping the datetime returned by s3, and the display values
+("last_modified" string and timestamp) are only computed while the JSON response
+is written out, one entry at a time.
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+from cdislogging import get_logger
+
+from . import layout, storage, tracing
+from .config import get_config
+from .resilience import CircuitOpenError
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+
+class FileEntry(object):
+    """
+    A file in a listing. Supports read-only dict-style access to "filename",
+    "last_modified" and "last_modified_timestamp", so it can be used wherever
+    the listing entries used to be dicts. The size, in bytes, is only used by
+    the service (quotas) and is not part of the JSON representation.
+    """
+
+    __slots__ = ("filename", "modified", "size")
+
+    KEYS = ("filename", "last_modified", "last_modified_timestamp")
+
+    def __init__(self, filename, modified, size=0):
+        self.filename = filename
+        self.modified = modified
+        self.size = size
+
+    def __getitem__(self, key):
+        if key == "filename":
+            return self.filename
+        if key == "last_modified":
+            return self.modified.strftime("%Y-%m-%d %H:%M:%S")
+        if key == "last_modified_timestamp":
+            return datetime.timestamp(self.modified)
+        raise KeyError(key)
+
+    def keys(self):
+        return self.KEYS
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_json(self):
+        # same output as json.dumps(dict(self)), without building the dict
+        return (
+            '{"filename": '
+            + encode_basestring_ascii(self.filename)
+            + ', "last_modified": "'
+            + self.modified.strftime("%Y-%m-%d %H:%M:%S")
+            + '", "last_modified_timestamp": '
+            + repr(datetime.timestamp(self.modified))
+            + "}"
+        )
+
+    def __repr__(self):
+        return "FileEntry({!r}, {!r})".format(self.filename, self.modified)
+
+
+class SortedList(list):
+    """
+    A list of FileEntry that remembers whether entries were appended in
+    modification order, so that sorting it is free in the common case: file
+    names start with a timestamp, and s3 lists keys in lexicographic order.
+    """
+
+    __slots__ = ("in_order",)
+
+    def __init__(self):
+        super().__init__()
+        self.in_order = True
+
+    def append(self, entry):
+        if self.in_order and self and entry.modified < self[-1].modified:
+            self.in_order = False
+        super().append(entry)
+
+    def sort_by_modified(self):
+        if not self.in_order:
+            # sort() is stable, like the sorted() calls this replaces
+            self.sort(key=lambda entry: entry.modified)
+            self.in_order = True
+        return self
+
+
+def _entry_json(entry):
+    if isinstance(entry, FileEntry):
+        return entry.to_json()
+    return json.dumps(entry)
+
+
+def iter_listing_json(key, entries, extra=None, chunk_size=64 * 1024):
+    """
+    Yields the JSON document {key: [entries...], **extra} in chunks of about
+    `chunk_size` characters, serializing one entry at a time. Entries can be
+    FileEntry objects or dicts.
+    """
+    parts = ['{"' + key + '": [']
+    size = 0
+    for i, entry in enumerate(entries):
+        part = _entry_json(entry) if i == 0 else ", " + _entry_json(entry)
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    parts.append("]")
+    for extra_key, value in (extra or {}).items():
+        parts.append(", " + json.dumps(extra_key) + ": " + json.dumps(value))
+    parts.append("}")
+    yield "".join(parts)
+
+
+class ListingCache(object):
+    """
+    Listings of user folders kept by a worker for a few seconds, and dropped
+    when the folder changes (see invalidation.py). Since a folder can change
+    while it is being listed, a listing is only stored if the folder was not
+    invalidated since token() was called before listing it.
+    """
+
+    def __init__(self, max_entries=10000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        # {folder: (expiry time, listing)}
+        self._entries = {}
+        # invalidation counts, by folder, and of the resets of those counts
+        self._generations = {}
+        self._epoch = 0
+
+    def get(self, folder):
+        with self._lock:
+            entry = self._entries.get(folder)
+            if entry is None:
+                return None
+            if entry[0] <= self._clock():
+                del self._entries[folder]
+                return None
+            return entry[1]
+
+    def token(self, folder):
+        with self._lock:
+            return self._epoch, self._generations.get(folder, 0)
+
+    def put(self, folder, listing, token, ttl):
+        now = self._clock()
+        with self._lock:
+            if token != (self._epoch, self._generations.get(folder, 0)):
+                return
+            if len(self._entries) >= self.max_entries:
+                for key, (expiry, _) in list(self._entries.items()):
+                    if expiry <= now:
+                        del self._entries[key]
+                if len(self._entries) >= self.max_entries:
+                    return
+            self._entries[folder] = (now + ttl, listing)
+
+    def invalidate(self, folder):
+        with self._lock:
+            self._entries.pop(folder, None)
+            if len(self._generations) >= self.max_entries:
+                # listings in progress get a stale token and are not stored
+                self._generations.clear()
+                self._epoch += 1
+            self._generations[folder] = self._generations.get(folder, 0) + 1
+
+
+def get_listing_cache():
+    return storage.app_state("listing_cache", ListingCache)
+
+
+def get_legacy_folder(folder):
+    """
+    Returns the legacy layout equivalent of a folder of the sharded layout, to
+    read the files of users who have not been migrated yet, or None if there
+    is none to read (legacy layout, or key_layout_fallback disabled).
+    """
+    if get_config("key_layout") != "sharded" or not get_config("key_layout_fallback"):
+        return None
+    return layout.legacy_folder(folder, get_config("key_shard_width"))
+
+
+def list_files(bucket_name, folder):
+    """
+    Lists the files of a user folder. Returns (files_by_type, True), where
+    files_by_type is of the form
+    {
+        "manifests:" [
+            # For files in the root of the user folder
+            { "filename": <filename>, "last_modified": <timestamp> }, ...
+        ],
+        "cohorts": [
+            # For files in the cohorts/ folder
+            { "filename": <filename>, "last_modified": <timestamp> }, ...
+        ],
+        "metadata": [
+            # For files in the exported-metadata/ folder
+            { "filename": <filename>, "last_modified": <timestamp> }, ...
+        ],
+    }
+    or (error, False) if the folder cannot be listed.
+    Concurrent listings of the same folder share a single s3 call, so the
+    returned dictionary must not be modified.
+    Raises CircuitOpenError while the s3 circuit breaker is open.
+    """
+    return storage.coalesced(
+        ("list", bucket_name, folder),
+        lambda: list_files_uncoalesced(bucket_name, folder),
+    )
+
+
+def list_files_uncoalesced(bucket_name, folder):
+    """
+    Does the s3 listing for list_files(). Entries are FileEntry objects, which
+    behave like the dicts described above.
+    The files of the legacy folder of the user, if any, are listed too; a file
+    found in both folders is only listed once. Files moved from the legacy
+    folder by the layout migration keep their last modification time.
+    """
+    files_by_type = {
+        "manifests": SortedList(),
+        "cohorts": SortedList(),
+        "metadata": SortedList(),
+    }
+    folders = [folder]
+    legacy_folder = get_legacy_folder(folder)
+    if legacy_folder:
+        folders.append(legacy_folder)
+    listed = set()
+    try:
+        with storage.guarded(), tracing.span("list_files") as span:
+            moved_files = None
+            if get_config("key_layout") == "sharded":
+                moved_files = storage.get_json(
+                    bucket_name, layout.moved_files_key(folder)
+                )
+            object_count = 0
+            for listed_folder in folders:
+                for key, last_modified, size in storage.iter_objects(
+                    bucket_name, listed_folder + "/"
+                ):
+                    object_count += 1
+                    if listed_folder == folder:
+                        last_modified = layout.original_last_modified(
+                            moved_files, folder, key, last_modified
+                        )
+                    file_type, filename = layout.classify_key(key, listed_folder)
+                    if legacy_folder:
+                        if (file_type, filename) in listed:
+                            continue
+                        listed.add((file_type, filename))
+                    files_by_type[file_type].append(
+                        FileEntry(filename, last_modified, size)
+                    )
+            span.set(object_count=object_count)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(
+            f'Failed to list files in bucket "{bucket_name}" folder "{folder}": {e}'
+        )
+        return str(e), False
+
+    for files in files_by_type.values():
+        files.sort_by_modified()
+    return files_by_type, True
@@ -1,18 +1,51 @@
 import json
 import flask
 import html
-import boto3
+import itertools
+import math
 from flask import current_app as app
 import re
-import ntpath
-from datetime import datetime
+import time
 from authutils.token.validate import current_token, validate_request, set_current_token
 from cdislogging import get_logger
 
+from .. import (
+    deadlines,
+    export,
+    files,
+    invalidation,
+    layout,
+    listing,
+    object_index,
+    ratelimit,
+    setops,
+    sidecars,
+    storage,
+    streaming,
+    sync,
+    tracing,
+    uploads,
+    watch,
+)
+from ..config import get_config
+from ..resilience import CircuitOpenError
+
+# filenames are generated by uploads.py; tests use the helper through this module
+from ..uploads import _generate_unique_filename_with_timestamp_and_increment
+
 logger = get_logger("manifestservice_logger", log_level="info")
 
 blueprint = flask.Blueprint("manifests", __name__)
 
+# Maximum number of files deleted by one POST /delete request
+MAX_DELETE_BATCH = 1000
+
+# Maximum number of manifests combined by one POST /combine request
+MAX_COMBINED_MANIFESTS = 20
+
+# Maximum number of files copied by one POST /export request
+MAX_EXPORT_BATCH = 100
+
 
 @blueprint.route("/", methods=["GET"])
 def get_manifests():
@@ -20,30 +53,51 @@ def get_manifests():
     Returns a list of filenames corresponding to the user's manifests.
     We find the appropriate folder ("prefix") in the bucket by asking Fence for
     info about the user's access token.
+    With "include=summary", each manifest also has a "summary" with its record
+    count, size, number of distinct subject_id and sha256 (null for manifests
+    uploaded before summaries were recorded).
+    With "since=<sync_token>", only the manifests added since the listing that
+    returned the token are returned; see _sync_listing().
     ---
+    parameters:
+        - name: include
+          in: query
+          type: string
+          enum: [summary]
+        - name: since
+          in: query
+          type: string
     responses:
         200:
             description: Success
+        400:
+            description: Invalid sync token
         403:
             description: Unauthorized
     """
 
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
     if err is not None:
         return err, code
 
     folder_name = _get_folder_name_from_token(current_token)
 
-    result, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
-    )
-    if not ok:
-        json_to_return = {"error": "Currently unable to connect to s3."}
-        return flask.jsonify(json_to_return), 500
+    result, sync_fields = _sync_listing(folder_name, "manifests")
+    if sync_fields is None:
+        return result
 
-    json_to_return = {"manifests": result["manifests"]}
+    manifests = result["manifests"]
+    if "summary" in flask.request.args.get("include", "").split(","):
+        summaries = sidecars.get_manifest_summaries(folder_name)
+        manifests = [
+            dict(manifest, summary=summaries.get(manifest["filename"]))
+            for manifest in manifests
+        ]
 
-    return flask.jsonify(json_to_return), 200
+    return _listing_response("manifests", manifests, sync_fields)
 
 
 @blueprint.route("/file/<file_name>", methods=["GET"])
@@ -53,7 +107,24 @@ def get_manifest_file(file_name):
     The argument is the filename of the manifest you want to downloaded,
     of the form "manifest-timestamp".json. The user folder prefix is encapsulated from
     the caller -- just provide the basepath.
+    The optional query parameters "fields" (comma-separated), "offset", "limit" and
+    "format" ("json" or "ndjson") return only part of the manifest; the manifest is
+    then parsed and returned as a stream, record by record.
     ---
+    parameters:
+        - name: fields
+          in: query
+          type: string
+        - name: offset
+          in: query
+          type: integer
+        - name: limit
+          in: query
+          type: integer
+        - name: format
+          in: query
+          type: string
+          enum: [json, ndjson]
     responses:
         200:
             description: Success
@@ -61,9 +132,14 @@ def get_manifest_file(file_name):
             description: Unauthorized
         400:
             description: Bad request format
+        404:
+            description: File not found
     """
 
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
     if err is not None:
         return err, code
 
@@ -74,9 +150,21 @@ def get_manifest_file(file_name):
         }
         return flask.jsonify(json_to_return), 400
 
+    slice_args, error = _parse_slice_args(flask.request.args)
+    if error is not None:
+        return flask.jsonify({"error": error}), 400
+
     folder_name = _get_folder_name_from_token(current_token)
 
-    return _get_file_contents(
+    if slice_args is not None:
+        return _sliced_file_response(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            folder_name,
+            file_name,
+            **slice_args,
+        )
+
+    return _file_contents_response(
         flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name, file_name
     )
 
@@ -95,15 +183,49 @@ def put_manifest():
             description: Bad manifest format
     """
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
     if err is not None:
         return err, code
 
-    if not flask.request.json:
-        return flask.jsonify({"error": "Please provide valid JSON."}), 400
+    if not flask.request.is_json:
+        return flask.jsonify({"error": "Please provide valid JSON."}), 415
 
-    manifest_json = flask.request.json
+    # the body is validated as is and stored as sent, without building the
+    # manifest in memory and serializing it again
     required_keys = ["object_id"]
-    is_valid = is_valid_manifest(manifest_json, required_keys)
+    summary = streaming.ManifestSummary()
+    index_ids = None
+    if get_config("object_index"):
+        index_ids = object_index.IdCollector(
+            get_config("object_index_fields"), get_config("object_index_partitions")
+        )
+
+    def validate(record):
+        if not isinstance(record, dict) or not is_valid_manifest(
+            [record], required_keys
+        ):
+            return False
+        if index_ids is not None:
+            index_ids.add(record)
+        return True
+
+    try:
+        body = streaming.as_utf8(flask.request.get_data())
+        with tracing.span("validate", bytes=len(body)) as span:
+            _, offsets = streaming.scan_json_array(
+                body, get_config("manifest_index_stride"), summary, validate
+            )
+            span.set(records=summary.records)
+    except streaming.InvalidRecord:
+        is_valid = False
+    except ValueError:
+        return flask.jsonify({"error": "Please provide valid JSON."}), 400
+    else:
+        if not summary.records:
+            return flask.jsonify({"error": "Please provide valid JSON."}), 400
+        is_valid = True
     if not is_valid:
         return (
             flask.jsonify(
@@ -115,7 +237,17 @@ def put_manifest():
             400,
         )
 
-    result, ok = _add_manifest_to_bucket(current_token, manifest_json)
+    try:
+        result, ok = _add_manifest_to_bucket(
+            current_token,
+            body,
+            summary,
+            offsets,
+            idempotency_key=flask.request.headers.get("Idempotency-Key"),
+            index_ids=index_ids.by_partition() if index_ids is not None else None,
+        )
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
     if not ok:
         json_to_return = {"error": "Currently unable to connect to s3."}
         return flask.jsonify(json_to_return), 500
@@ -131,30 +263,35 @@ def get_cohorts():
     Returns a list of filenames -- which are GUIDs -- corresponding to the user's exported
     PFBs. We find the appropriate folder ("prefix") in the bucket by asking Fence for
     info about the user's access token.
+    Supports delta listings with "since=<sync_token>", like GET /.
     ---
+    parameters:
+        - name: since
+          in: query
+          type: string
     responses:
         200:
             description: Success
+        400:
+            description: Invalid sync token
         403:
             description: Unauthorized
     """
 
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
     if err is not None:
         return err, code
 
     folder_name = _get_folder_name_from_token(current_token)
 
-    result, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
-    )
-    if not ok:
-        json_to_return = {"error": "Currently unable to connect to s3."}
-        return flask.jsonify(json_to_return), 500
+    result, sync_fields = _sync_listing(folder_name, "cohorts")
+    if sync_fields is None:
+        return result
 
-    json_to_return = {"cohorts": result["cohorts"]}
-
-    return flask.jsonify(json_to_return), 200
+    return _listing_response("cohorts", result["cohorts"], sync_fields)
 
 
 @blueprint.route("/cohorts", methods=["PUT", "POST"])
@@ -178,6 +315,9 @@ def put_pfb_guid():
     """
 
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
     if err is not None:
         return err, code
 
@@ -193,7 +333,10 @@ def put_pfb_guid():
             flask.jsonify({"error": f"The provided GUID: {GUID} is invalid."}),
             400,
         )
-    result, ok = _add_GUID_to_bucket(current_token, GUID)
+    try:
+        result, ok = _add_GUID_to_bucket(current_token, GUID)
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
 
     if not ok:
         json_to_return = {"error": "Currently unable to connect to s3."}
@@ -208,28 +351,33 @@ def put_pfb_guid():
 def get_metadata():
     """
     List all exported metadata objects associated with user
+    Supports delta listings with "since=<sync_token>", like GET /.
     ---
+    parameters:
+        - name: since
+          in: query
+          type: string
     responses:
         200:
             description: Success
+        400:
+            description: Invalid sync token
         403:
             description: Unauthorized
     """
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
     if err is not None:
         return err, code
 
     folder_name = _get_folder_name_from_token(current_token)
-    result, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
-    )
-    if not ok:
-        json_to_return = {"error": "Currently unable to connect to s3."}
-        return flask.jsonify(json_to_return), 500
-
-    json_to_return = {"external_file_metadata": result["metadata"]}
+    result, sync_fields = _sync_listing(folder_name, "metadata")
+    if sync_fields is None:
+        return result
 
-    return flask.jsonify(json_to_return), 200
+    return _listing_response("external_file_metadata", result["metadata"], sync_fields)
 
 
 @blueprint.route("/metadata/<file_name>", methods=["GET"])
@@ -247,6 +395,9 @@ def get_metadata_file(file_name):
     """
 
     err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
     if err is not None:
         return err, code
 
@@ -259,7 +410,7 @@ def get_metadata_file(file_name):
 
     folder_name = _get_folder_name_from_token(current_token) + "/exported-metadata"
 
-    return _get_file_contents(
+    return _file_contents_response(
         flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name, file_name
     )
 
@@ -284,12 +435,29 @@ def put_metadata():
     err, code = _authenticate_user()
     if err is not None:
         return err, code
-    if not flask.request.json:
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+    if not flask.request.is_json:
+        return flask.jsonify({"error": "Please provide valid JSON."}), 415
+    # validated, but stored as sent
+    try:
+        body = streaming.as_utf8(flask.request.get_data())
+        with tracing.span("validate", bytes=len(body)):
+            is_valid = bool(json.loads(body))
+    except ValueError:
+        is_valid = False
+    if not is_valid:
         return flask.jsonify({"error": "Please provide valid JSON."}), 400
 
-    metadata_body = flask.request.json
-
-    result, ok = _add_metadata_to_bucket(current_token, metadata_body)
+    try:
+        result, ok = _add_metadata_to_bucket(
+            current_token,
+            body,
+            idempotency_key=flask.request.headers.get("Idempotency-Key"),
+        )
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
 
     if not ok:
         json_to_return = {"error": "Currently unable to connect to s3."}
@@ -300,106 +468,739 @@ def put_metadata():
     return flask.jsonify(ret), 200
 
 
-def _add_metadata_to_bucket(current_token, metadata_body):
+@blueprint.route("/metadata/uploads", methods=["POST"])
+def create_metadata_upload():
     """
-    Creates a new file in the user's folder at user-<id>/metadata/exported-data/
-    with a filename corresponding to the GUID provided by the user.
+    Opens an upload session for a large metadata export, sent as NDJSON chunks
+    with PUT /metadata/uploads/<session>/<part> and committed with
+    POST /metadata/uploads/<session>/commit. The filename of the export is
+    decided now, but the file only appears once the session is committed.
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "session": "<session id>", "filename": "metadata-2024-06-13T17-14-46.026593.json", "min_chunk_size": 5242880, "max_chunk_size": 67108864 }, 200)'
+        403:
+            description: Unauthorized, or quota exceeded
     """
-    session = boto3.Session(
-        region_name="us-east-1",
-    )
-    s3 = session.resource("s3")
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
 
-    folder_name = _get_folder_name_from_token(current_token)
+    try:
+        session, ok = uploads.create_session(_get_folder_name_from_token(current_token))
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
+    if not ok:
+        json_to_return = {"error": "Currently unable to connect to s3."}
+        return flask.jsonify(json_to_return), 500
 
-    result, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
-    )
+    ret = {
+        "session": session.encode(),
+        "filename": session.filename,
+        "min_chunk_size": uploads.MIN_PART_SIZE,
+        "max_chunk_size": get_config("metadata_upload_max_chunk_size"),
+    }
+    return flask.jsonify(ret), 200
 
-    if not ok:
-        return None, False
-    filename = _generate_unique_filename(
-        result["metadata"], file_type="metadata"
-    )
 
-    filepath_in_bucket = folder_name + "/exported-metadata/" + filename
+@blueprint.route("/metadata/uploads/<session_id>/<int:part_number>", methods=["PUT"])
+def put_metadata_upload_part(session_id, part_number):
+    """
+    Uploads part `part_number` of an upload session: an NDJSON chunk, with one
+    JSON record per line. Parts are numbered from 1 and can be sent in any order
+    and in parallel; sending a part again replaces it. Every part must be at
+    least "min_chunk_size" bytes: send the last records with the commit.
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "part": 1, "records": 1000 }, 200)'
+        400:
+            description: Invalid session, part number or chunk
+        404:
+            description: Upload session not found
+        413:
+            description: Chunk larger than "max_chunk_size"
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
     try:
-        obj = s3.Object(
-            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
+        session = uploads.UploadSession.decode(session_id)
+    except uploads.InvalidUploadSession as e:
+        return flask.jsonify({"error": str(e)}), 400
+    if not 1 <= part_number < uploads.MAX_PARTS:
+        error = f"Part numbers must be between 1 and {uploads.MAX_PARTS - 1}."
+        return flask.jsonify({"error": error}), 400
+
+    chunk, error_response = _read_upload_chunk()
+    if error_response is not None:
+        return error_response
+    try:
+        body, records = uploads.encode_chunk(chunk, first=part_number == 1)
+    except uploads.InvalidChunk as e:
+        return flask.jsonify({"error": str(e)}), 400
+    if not records:
+        return flask.jsonify({"error": "The chunk has no records."}), 400
+    if len(body) < uploads.MIN_PART_SIZE:
+        error = (
+            f"Chunks must be at least {uploads.MIN_PART_SIZE} bytes; send the "
+            "last records with the commit."
         )
-        obj.put(Body=bytes(json.dumps(metadata_body).encode('UTF-8')))
+        return flask.jsonify({"error": error}), 400
+
+    folder_name = _get_folder_name_from_token(current_token)
+    try:
+        uploads.upload_session_part(folder_name, session, part_number, body)
+    except Exception as e:
+        return _upload_session_error_response(e, session)
+
+    return flask.jsonify({"part": part_number, "records": records}), 200
+
+
+@blueprint.route("/metadata/uploads/<session_id>/commit", methods=["POST"])
+def commit_metadata_upload(session_id):
+    """
+    Commits an upload session: the optional NDJSON body holds the last records
+    of the export, and the parts sent so far must be numbered from 1 with no
+    gaps. The metadata file is then a JSON array of all the records, in order.
+    A session without any record is aborted.
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "filename": "metadata-2024-06-13T17-14-46.026593.json" }, 200)'
+        400:
+            description: Invalid session or chunk, missing parts, or no records
+        403:
+            description: Unauthorized, or quota exceeded
+        404:
+            description: Upload session not found
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
+    try:
+        session = uploads.UploadSession.decode(session_id)
+    except uploads.InvalidUploadSession as e:
+        return flask.jsonify({"error": str(e)}), 400
+    chunk, error_response = _read_upload_chunk()
+    if error_response is not None:
+        return error_response
+
+    folder_name = _get_folder_name_from_token(current_token)
+    try:
+        filename = uploads.commit_session(folder_name, session, chunk)
+    except (uploads.InvalidChunk, uploads.IncompleteUpload) as e:
+        return flask.jsonify({"error": str(e)}), 400
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
     except Exception as e:
-        return str(e), False
+        return _upload_session_error_response(e, session)
+    return flask.jsonify({"filename": filename}), 200
+
+
+@blueprint.route("/metadata/uploads/<session_id>", methods=["DELETE"])
+def abort_metadata_upload(session_id):
+    """
+    Abandons an upload session and deletes the parts uploaded so far.
+    ---
+    responses:
+        200:
+            description: Success
+        400:
+            description: Invalid session
+        404:
+            description: Upload session not found
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
 
-    return filename, True
+    try:
+        session = uploads.UploadSession.decode(session_id)
+    except uploads.InvalidUploadSession as e:
+        return flask.jsonify({"error": str(e)}), 400
 
+    folder_name = _get_folder_name_from_token(current_token)
+    try:
+        uploads.abort_session(folder_name, session)
+    except Exception as e:
+        return _upload_session_error_response(e, session)
+    return flask.jsonify({"session": session_id}), 200
 
-def _add_manifest_to_bucket(current_token, manifest_json):
+
+@blueprint.route("/watch", methods=["GET"])
+def watch_files():
     """
-    Puts the manifest_json string into a file and uploads it to s3.
-    Generates and returns the name of the new file.
+    Long-poll for changes in the user's folder: returns as soon as manifests,
+    cohorts or metadata files are added or deleted after the "since" sync token
+    (returned by the listing endpoints), or after "timeout" seconds with no
+    changes. The response has the same format as a delta listing, for all 3 file
+    types: "deleted" holds the deleted filenames of each type.
+    ---
+    parameters:
+        - name: since
+          in: query
+          type: string
+          required: true
+        - name: timeout
+          in: query
+          type: number
+    responses:
+        200:
+            description: Success
+        400:
+            description: Missing or invalid sync token or timeout
+        403:
+            description: Unauthorized
+        503:
+            description: Too many requests are already waiting, with no changes to return yet; retry after the Retry-After header
     """
-    session = boto3.Session(
-        region_name="us-east-1",
-    )
-    s3 = session.resource("s3")
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
+    if err is not None:
+        return err, code
 
+    if not flask.request.args.get("since"):
+        return flask.jsonify({"error": 'The "since" sync token is required.'}), 400
+    max_timeout = get_config("watch_timeout")
+    try:
+        timeout = float(flask.request.args.get("timeout", max_timeout))
+    except ValueError:
+        return flask.jsonify({"error": "The timeout must be a number."}), 400
+    timeout = min(max(timeout, 0), max_timeout)
+    # leave time for the last listing before the request's deadline
+    timeout = max(min(timeout, deadlines.remaining(timeout) - 1), 0)
+
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
     folder_name = _get_folder_name_from_token(current_token)
+    # start watching before the first check, so that no upload is missed between
+    # the check and the wait
+    with watch.get_change_notifier().watch(folder_name) as change_watch:
+        result, sync_fields = _sync_listing(folder_name)
+        if sync_fields is None:
+            return result
+        deadline = time.monotonic() + timeout
+        token = sync.SyncToken.decode(sync_fields["sync_token"])
+        while (
+            sync_fields["delta"]
+            and not any(result.values())
+            and not any(sync_fields["deleted"].values())
+        ):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if change_watch is None:
+                # too many requests are waiting in this worker; returning the
+                # empty delta would have the client poll again right away
+                json_to_return = {"error": "Too many watches. Please retry later."}
+                response = flask.jsonify(json_to_return)
+                response.headers["Retry-After"] = str(
+                    math.ceil(get_config("watch_poll_interval"))
+                )
+                return response, 503
+            change_watch.wait(min(get_config("watch_poll_interval"), remaining))
+            changes, ok = sync.list_changes(
+                bucket_name,
+                folder_name,
+                token,
+                int(get_config("sync_overlap") * 1e9),
+            )
+            if not ok:
+                json_to_return = {"error": "Currently unable to connect to s3."}
+                return flask.jsonify(json_to_return), 500
+            result, deleted, token = changes
+            sync_fields = {
+                "sync_token": token.encode(),
+                "delta": True,
+                "deleted": deleted,
+            }
 
-    result, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
+    if "deleted" in sync_fields:
+        deleted = sync_fields["deleted"]
+        sync_fields["deleted"] = {
+            "manifests": deleted["manifests"],
+            "cohorts": deleted["cohorts"],
+            "external_file_metadata": deleted["metadata"],
+        }
+    return (
+        flask.jsonify(
+            {
+                "manifests": [dict(f) for f in result["manifests"]],
+                "cohorts": [dict(f) for f in result["cohorts"]],
+                "external_file_metadata": [dict(f) for f in result["metadata"]],
+                **sync_fields,
+            }
+        ),
+        200,
     )
-    if not ok:
-        return result, False
 
-    filename = _generate_unique_filename(
-        result["manifests"],
-    )
-    filepath_in_bucket = folder_name + "/" + filename
 
+@blueprint.route("/lookup", methods=["GET"])
+def lookup_manifests():
+    """
+    Returns the filenames of the user's manifests that contain a record with the
+    given object_id, or with the given value of another field listed in
+    "object_index_fields" (such as subject_id). Lookups use an index of the
+    user's manifests; manifests missing from it are indexed first, for up to a
+    few seconds: the manifests that could not be searched are listed in
+    "unindexed", and indexed in the background or by the next lookups.
+    ---
+    parameters:
+        - name: object_id
+          in: query
+          type: string
+        - name: subject_id
+          in: query
+          type: string
+    responses:
+        200:
+            description: Success
+            example: '({ "object_id": "dg.1234/1", "manifests": ["manifest-2024-06-13T17-14-46.026593.json"], "unindexed": [] }, 200)'
+        400:
+            description: No indexed field in the query
+        403:
+            description: Unauthorized
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("read")
+    if err is not None:
+        return err, code
+
+    fields = get_config("object_index_fields")
+    query = [field for field in fields if field in flask.request.args]
+    if len(query) != 1:
+        json_to_return = {
+            "error": "Please provide exactly one of the indexed fields: "
+            + ", ".join(fields)
+        }
+        return flask.jsonify(json_to_return), 400
+    field = query[0]
+    value = flask.request.args[field]
+
+    folder_name = _get_folder_name_from_token(current_token)
     try:
-        obj = s3.Object(
-            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
-        )
-        obj.put(Body=bytes(json.dumps(manifest_json).encode('UTF-8')))
+        with tracing.span("lookup") as span:
+            filenames, unindexed = object_index.find_manifests(
+                folder_name, field, value
+            )
+            span.set(results=len(filenames))
     except Exception as e:
-        logger.error(f"Failed to add manifest to bucket: {e}")
-        return str(e), False
+        logger.error(f"Failed to look up {field} {value}: {e}")
+        if isinstance(e, CircuitOpenError):
+            return _s3_read_error_response(e, folder_name, "")
+        return flask.jsonify({"error": "Currently unable to connect to s3."}), 500
 
-    return filename, True
+    json_to_return = {field: value, "manifests": filenames, "unindexed": unindexed}
+    return flask.jsonify(json_to_return), 200
 
 
-def _add_GUID_to_bucket(current_token, GUID):
+@blueprint.route("/lookup/rebuild", methods=["POST"])
+def rebuild_object_index():
     """
-    Creates a new file in the user's folder at user-<id>/cohorts/
-    with a filename corresponding to the GUID provided by the user.
+    Rebuilds the index of the user's manifests used by GET /lookup from the
+    manifests themselves. The index is written as manifests are indexed, so a
+    rebuild that runs out of time is resumed by the next lookups; the manifests
+    that are not indexed yet, or that are not lists of records, are listed in
+    "unindexed".
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "manifests": 3, "unindexed": [] }, 200)'
+        403:
+            description: Unauthorized
     """
-    session = boto3.Session(
-        region_name="us-east-1",
-    )
-    s3 = session.resource("s3")
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
 
     folder_name = _get_folder_name_from_token(current_token)
+    try:
+        count, unindexed = object_index.refresh(
+            folder_name, rebuild=True, budget=deadlines.remaining(math.inf) / 2
+        )
+    except Exception as e:
+        logger.error(f"Failed to rebuild the object index of {folder_name}: {e}")
+        return flask.jsonify({"error": "Currently unable to connect to s3."}), 500
 
-    existing_files, ok = _list_files_in_bucket(
-        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
-    )
+    return flask.jsonify({"manifests": count, "unindexed": unindexed}), 200
 
-    if not ok:
-        return None, False
-    if GUID in existing_files:
-        return GUID, True
 
-    filepath_in_bucket = folder_name + "/cohorts/" + GUID
+@blueprint.route("/combine", methods=["POST"])
+def combine_manifests():
+    """
+    Creates a manifest from a set operation on the object_id of the records of
+    two or more of the user's manifests (see setops.py).
+    Post body: { "manifests": [<filename>, ...], "operation": "union" | "intersection" | "difference" }
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "filename": "manifest-2024-06-13T17-14-46.026593.json" }, 200)'
+        400:
+            description: Invalid request body or filename, a manifest that is not a list of records, or an empty result
+        403:
+            description: Unauthorized
+        404:
+            description: Manifest not found
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
+    body = flask.request.get_json(silent=True)
+    if (
+        not isinstance(body, dict)
+        or body.get("operation") not in setops.OPERATIONS
+        or not isinstance(body.get("manifests"), list)
+        or not 2 <= len(body["manifests"]) <= MAX_COMBINED_MANIFESTS
+    ):
+        json_to_return = {
+            "error": "Please provide a JSON object with the list of 2 to "
+            f"{MAX_COMBINED_MANIFESTS} manifests to combine and the operation: "
+            + ", ".join(setops.OPERATIONS)
+        }
+        return flask.jsonify(json_to_return), 400
+    filenames = body["manifests"]
+    for filename in filenames:
+        error = _invalid_filename_error("manifests", filename)
+        if error:
+            return flask.jsonify({"error": error}), 400
+
     try:
-        obj = s3.Object(
-            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
+        result, ok = setops.combine_manifests(
+            _get_folder_name_from_token(current_token), filenames, body["operation"]
         )
-        obj.put(Body=str.encode(""))
+    except uploads.QuotaExceeded as e:
+        return flask.jsonify({"error": str(e)}), 403
+    except setops.CombineError as e:
+        return flask.jsonify({"error": str(e)}), 400
     except Exception as e:
-        return str(e), False
+        logger.error(f"Failed to combine manifests {filenames}: {e}")
+        if isinstance(e, CircuitOpenError):
+            return _s3_read_error_response(e, "", "")
+        return flask.jsonify({"error": "Currently unable to connect to s3."}), 500
+    if not ok:
+        return flask.jsonify({"error": result}), 404
+
+    return flask.jsonify({"filename": result}), 200
+
+
+@blueprint.route("/export", methods=["POST"])
+def export_files():
+    """
+    Copies manifests and metadata files of the user to the workspace storage
+    configured with "export_bucket" and "export_prefix", with server-side
+    copies: the files do not go through the service.
+    Post body: { "manifests": [<filename>, ...], "metadata": [<filename>, ...] }
+    (every list is optional, up to 100 files in total)
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "bucket": "workspaces", "exported": [{ "type": "manifests", "filename": "manifest-2024-06-13T17-14-46.026593.json", "key": "user-18/manifest-2024-06-13T17-14-46.026593.json" }], "errors": [] }, 200)'
+        400:
+            description: Invalid request body or filename
+        403:
+            description: Unauthorized
+        501:
+            description: No export destination is configured
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
+    if not get_config("export_bucket"):
+        json_to_return = {"error": "No export destination is configured."}
+        return flask.jsonify(json_to_return), 501
+
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not set(body) <= set(export.EXPORTABLE_FILE_TYPES):
+        return (
+            flask.jsonify(
+                {
+                    "error": "Please provide a JSON object with lists of "
+                    + ", ".join(export.EXPORTABLE_FILE_TYPES)
+                    + " to export."
+                }
+            ),
+            400,
+        )
+    files_by_type = {}
+    for file_type, filenames in body.items():
+        if not isinstance(filenames, list):
+            return flask.jsonify({"error": f'"{file_type}" must be a list.'}), 400
+        for filename in filenames:
+            error = _invalid_filename_error(file_type, filename)
+            if error:
+                return flask.jsonify({"error": error}), 400
+        files_by_type[file_type] = list(dict.fromkeys(filenames))
+    if sum(len(filenames) for filenames in files_by_type.values()) > MAX_EXPORT_BATCH:
+        return (
+            flask.jsonify(
+                {"error": f"At most {MAX_EXPORT_BATCH} files can be exported at once."}
+            ),
+            400,
+        )
+
+    folder_name = _get_folder_name_from_token(current_token)
+    result, ok = export.export_files(folder_name, current_token["sub"], files_by_type)
+    if not ok:
+        json_to_return = {"error": "Currently unable to connect to s3."}
+        return flask.jsonify(json_to_return), 500
+    exported, errors = result
+    return (
+        flask.jsonify(
+            {
+                "bucket": get_config("export_bucket"),
+                "exported": exported,
+                "errors": errors,
+            }
+        ),
+        200,
+    )
+
+
+@blueprint.route("/file/<file_name>", methods=["DELETE"])
+def delete_manifest_file(file_name):
+    """
+    Deletes a manifest from the user's folder. Deleting a file that does not
+    exist is not an error.
+    ---
+    responses:
+        200:
+            description: Success
+        400:
+            description: Invalid filename
+        403:
+            description: Unauthorized
+    """
+    return _delete_file_response("manifests", file_name)
+
+
+@blueprint.route("/cohorts/<path:guid>", methods=["DELETE"])
+def delete_cohort(guid):
+    """
+    Deletes a cohort GUID from the user's folder. Deleting a GUID that does not
+    exist is not an error.
+    ---
+    responses:
+        200:
+            description: Success
+        400:
+            description: Invalid GUID
+        403:
+            description: Unauthorized
+    """
+    return _delete_file_response("cohorts", guid)
+
+
+@blueprint.route("/metadata/<file_name>", methods=["DELETE"])
+def delete_metadata_file(file_name):
+    """
+    Deletes an exported metadata object from the user's folder. Deleting a file
+    that does not exist is not an error.
+    ---
+    responses:
+        200:
+            description: Success
+        400:
+            description: Invalid filename
+        403:
+            description: Unauthorized
+    """
+    return _delete_file_response("metadata", file_name)
+
+
+@blueprint.route("/delete", methods=["POST"])
+def delete_files():
+    """
+    Deletes a batch of files from the user's folder.
+    Post body: { "manifests": [<filename>, ...], "cohorts": [<GUID>, ...], "metadata": [<filename>, ...] }
+    (every list is optional, up to 1000 files in total)
+    ---
+    responses:
+        200:
+            description: Success
+            example: '({ "deleted": { "manifests": [...], "cohorts": [...], "metadata": [...] }, "errors": [] }, 200)'
+        400:
+            description: Invalid request body or filename
+        403:
+            description: Unauthorized
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not set(body) <= set(files.DELETABLE_FILE_TYPES):
+        return (
+            flask.jsonify(
+                {
+                    "error": "Please provide a JSON object with lists of "
+                    + ", ".join(files.DELETABLE_FILE_TYPES)
+                    + " to delete."
+                }
+            ),
+            400,
+        )
+    files_by_type = {}
+    for file_type, filenames in body.items():
+        if not isinstance(filenames, list):
+            return flask.jsonify({"error": f'"{file_type}" must be a list.'}), 400
+        for filename in filenames:
+            error = _invalid_filename_error(file_type, filename)
+            if error:
+                return flask.jsonify({"error": error}), 400
+        files_by_type[file_type] = filenames
+    if sum(len(filenames) for filenames in files_by_type.values()) > MAX_DELETE_BATCH:
+        return (
+            flask.jsonify(
+                {"error": f"At most {MAX_DELETE_BATCH} files can be deleted at once."}
+            ),
+            400,
+        )
+
+    folder_name = _get_folder_name_from_token(current_token)
+    result, ok = files.delete_files(folder_name, files_by_type)
+    if not ok:
+        json_to_return = {"error": "Currently unable to connect to s3."}
+        return flask.jsonify(json_to_return), 500
+    deleted, errors = result
+    return flask.jsonify({"deleted": deleted, "errors": errors}), 200
+
+
+def _delete_file_response(file_type, filename):
+    """
+    Returns the response of the routes deleting a single file.
+    """
+    err, code = _authenticate_user()
+    if err is not None:
+        return err, code
+    err, code = _check_rate_limit("write")
+    if err is not None:
+        return err, code
+
+    error = _invalid_filename_error(file_type, filename)
+    if error:
+        return flask.jsonify({"error": error}), 400
+
+    folder_name = _get_folder_name_from_token(current_token)
+    result, ok = files.delete_files(folder_name, {file_type: [filename]})
+    if not ok or result[1]:
+        json_to_return = {"error": "Currently unable to connect to s3."}
+        return flask.jsonify(json_to_return), 500
+    return flask.jsonify({"filename": filename}), 200
+
+
+def _invalid_filename_error(file_type, filename):
+    """
+    Returns an error message if `filename` cannot be the name of a file of type
+    `file_type` in a user folder, so that deletions cannot reach other files.
+    """
+    if not isinstance(filename, str) or not filename:
+        return "Filenames must be non-empty strings."
+    if file_type == "cohorts":
+        valid = is_valid_GUID(filename) and ".." not in filename.split("/")
+    else:
+        valid = "/" not in filename and not filename.startswith(".")
+    if not valid:
+        return f"Invalid {file_type} filename: {html.escape(filename)}"
+    return None
+
+
+def _add_metadata_to_bucket(current_token, body, idempotency_key=None):
+    """
+    Stores `body`, the JSON bytes of the request, as a new metadata file in the
+    user's folder; see uploads.add_metadata().
+    """
+    folder_name = _get_folder_name_from_token(current_token)
+    return uploads.add_metadata(folder_name, body, idempotency_key)
+
+
+def _read_upload_chunk():
+    """
+    Reads the NDJSON chunk in the body of an upload session request, without
+    reading more than metadata_upload_max_chunk_size bytes. Returns (chunk, None),
+    or (None, error_response) if the chunk is too large.
+    """
+    max_size = get_config("metadata_upload_max_chunk_size")
+    chunk = b""
+    if (flask.request.content_length or 0) <= max_size:
+        chunk = flask.request.stream.read(max_size + 1)
+    if (flask.request.content_length or 0) > max_size or len(chunk) > max_size:
+        error = f"Chunks must be at most {max_size} bytes."
+        return None, (flask.jsonify({"error": error}), 413)
+    return chunk, None
+
+
+def _upload_session_error_response(e, session):
+    """
+    Returns the JSON error response for an exception raised by an s3 call on
+    the multipart upload of an upload session.
+    """
+    if storage.is_not_found(e):
+        return flask.jsonify({"error": "Upload session not found."}), 404
+    if isinstance(e, CircuitOpenError):
+        return _s3_read_error_response(e, "exported-metadata", session.filename)
+    logger.error(f"Failed to upload {session.filename} to s3: {e}")
+    return flask.jsonify({"error": "Currently unable to connect to s3."}), 500
+
+
+def _add_manifest_to_bucket(
+    current_token, body, summary, offsets, idempotency_key=None, index_ids=None
+):
+    """
+    Stores a validated manifest as a new file in the user's folder; see
+    uploads.add_manifest().
+    """
+    folder_name = _get_folder_name_from_token(current_token)
+    return uploads.add_manifest(
+        folder_name, body, summary, offsets, idempotency_key, index_ids
+    )
+
 
-    return GUID, True
+def _add_GUID_to_bucket(current_token, GUID):
+    """
+    Creates a new file in the user's folder at user-<id>/cohorts/
+    with a filename corresponding to the GUID provided by the user.
+    Raises uploads.QuotaExceeded if the user's folder is full.
+    """
+    folder_name = _get_folder_name_from_token(current_token)
+    return uploads.add_guid(folder_name, GUID)
 
 
 def _get_folder_name_from_token(user_info):
@@ -410,11 +1211,18 @@ def _get_folder_name_from_token(user_info):
     their ID (integer).
 
     According to the revproxy's helpers.js, it looks like the user_id is stored in a variable called "sub". Hm.
+    With the "sharded" key_layout, the folder is under a shard of the user's id
+    ("<shard>/user-x"); see layout.py.
     """
-    result = "user-" + str(user_info["sub"])
+    root = ""
     if "PREFIX" in app.config:
-        result = app.config["PREFIX"] + "/user-" + str(user_info["sub"])
-    return result
+        root = app.config["PREFIX"] + "/"
+    return layout.user_folder(
+        root,
+        str(user_info["sub"]),
+        sharded=get_config("key_layout") == "sharded",
+        width=get_config("key_shard_width"),
+    )
 
 
 def is_valid_manifest(manifest_json, required_keys):
@@ -431,126 +1239,237 @@ def is_valid_manifest(manifest_json, required_keys):
     return True
 
 
-def _generate_unique_filename(
-    users_existing_manifest_or_metadata_files, file_type="manifest"
-):
+def _list_files_in_bucket(bucket_name, folder):
     """
-    Returns a filename of the form manifest-<timestamp>-<optional-increment>.json that is
-    unique among the files in the user's manifest folder.
+    Lists the files of a user folder; see listing.list_files() for the format
+    of the result.
     """
-    timestamp = datetime.now().isoformat()
-    existing_filenames = map(
-        lambda x: x["filename"], users_existing_manifest_or_metadata_files
-    )
-    filename = _generate_unique_filename_with_timestamp_and_increment(
-        timestamp, existing_filenames, file_type
+    return listing.list_files(bucket_name, folder)
+
+
+def _listing_response(key, entries, extra=None):
+    """
+    Returns a 200 response with the JSON document {key: entries, **extra},
+    streamed one entry at a time instead of being built in memory with
+    flask.jsonify, in a "serialize" span.
+    """
+    chunks = listing.iter_listing_json(key, entries, extra)
+    return flask.Response(
+        tracing.stream("serialize", chunks, records=len(entries)),
+        mimetype="application/json",
     )
-    return filename
 
 
-def _generate_unique_filename_with_timestamp_and_increment(
-    timestamp, users_existing_manifest_files, file_type="manifest"
-):
+def _sync_listing(folder_name, file_type=None):
     """
-    A helper function for _generate_unique_manifest_filename(), which facilitates unit testing.
-    Adds an increment to the filename if there happens to be another timestamped file with the same name
-    (unlikely, but good to check).
+    Lists the user's files for the listing endpoints. Returns
+    (files_by_type, sync_fields), where sync_fields are added to the response:
+    - "sync_token": pass it as "since" to list the files added after this listing
+    - "delta": true if only the files added since the "since" token are listed,
+    false for a full listing (no "since", or a token older than
+    sync_token_max_age: the client must then resync).
+    - "deleted", in deltas only: the filenames of the files of `file_type`
+    deleted since the "since" token, or of every type ({file type: [filenames]})
+    if `file_type` is None.
+    A delta can repeat files returned by the previous full listing, so clients
+    should merge deltas by filename.
+    Returns (error_response, None) if the files cannot be listed.
     """
-    filename_prefix="manifest-"
-    if file_type=="metadata":
-        filename_prefix="metadata-"
-    filename_without_extension = filename_prefix + timestamp.replace(":", "-")
-    extension = ".json"
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    overlap_ns = int(get_config("sync_overlap") * 1e9)
+    since = flask.request.args.get("since")
+    if since:
+        try:
+            token = sync.SyncToken.decode(since)
+        except sync.InvalidSyncToken as e:
+            return (flask.jsonify({"error": str(e)}), 400), None
+        if token.age() <= get_config("sync_token_max_age"):
+            result, ok = sync.list_changes(bucket_name, folder_name, token, overlap_ns)
+            if not ok:
+                json_to_return = {"error": "Currently unable to connect to s3."}
+                return (flask.jsonify(json_to_return), 500), None
+            files_by_type, deleted, token = result
+            sync_fields = {"sync_token": token.encode(), "delta": True}
+            sync_fields["deleted"] = deleted[file_type] if file_type else deleted
+            return files_by_type, sync_fields
+
+    token = sync.SyncToken(time.time_ns() - overlap_ns)
+    result, ok = _list_files_in_bucket_cached(bucket_name, folder_name)
+    if not ok:
+        json_to_return = {"error": "Currently unable to connect to s3."}
+        return (flask.jsonify(json_to_return), 500), None
+    return result, {"sync_token": token.encode(), "delta": False}
 
-    filename = filename_without_extension + extension
-    i = 1
-    while filename in users_existing_manifest_files:
-        filename = filename_without_extension + extension
-        if filename in users_existing_manifest_files:
-            filename = filename_without_extension + "-" + str(i) + extension
-        i += 1
 
-    return filename
+def _list_files_in_bucket_cached(bucket_name, folder_name):
+    """
+    Like _list_files_in_bucket(), but returns the listing cached by this worker
+    in the last "listing_cache_ttl" seconds, if the folder did not change since.
+    The cache is not used while the invalidation bus is unhealthy. Uploads
+    still list the folder from s3, to check for quotas and duplicates.
+    """
+    ttl = get_config("listing_cache_ttl")
+    if not ttl or not invalidation.get_invalidation_bus().healthy:
+        return _list_files_in_bucket(bucket_name, folder_name)
+    cache = listing.get_listing_cache()
+    result = cache.get(folder_name)
+    if result is not None:
+        return result, True
+    token = cache.token(folder_name)
+    result, ok = _list_files_in_bucket(bucket_name, folder_name)
+    if ok:
+        cache.put(folder_name, result, token, ttl)
+    return result, ok
 
 
-def _list_files_in_bucket(bucket_name, folder):
+def _get_file_contents(bucket_name, folder, filename):
     """
-    Lists the files in an s3 bucket. Returns a dictionary.
-    The return value is of the form
-    {
-        "manifests:" [
-            # For files in the root of the user folder
-            { "filename": <filename>, "last_modified": <timestamp> }, ...
-        ],
-        "cohorts": [
-            # For files in the cohorts/ folder
-            { "filename": <filename>, "last_modified": <timestamp> }, ...
-        ],
-        "metadata": [
-            # For files in the exported-metadata/ folder
-            { "filename": <filename>, "last_modified": <timestamp> }, ...
-        ],
-    }
+    Returns the body of a requested file as a string; see files.read_file().
+    Raises if the file cannot be read from s3; see _file_contents_response().
     """
-    session = boto3.Session(
-        region_name="us-east-1",
-    )
-    s3 = session.resource("s3")
+    return files.read_file(bucket_name, folder, filename)
 
-    manifests = []
-    guids = []
-    metadata = []
-    bucket = s3.Bucket(bucket_name)
 
+def _file_contents_response(bucket_name, folder, filename):
+    """
+    Returns the response for a file download: the body of the file, or a JSON
+    error if s3 could not provide it.
+    """
     try:
-        bucket_objects = bucket.objects.filter(Prefix=folder + "/")
-        for object_summary in bucket_objects:
-            file_marker = {
-                "last_modified": object_summary.last_modified.strftime(
-                    "%Y-%m-%d %H:%M:%S"
-                ),
-                "last_modified_timestamp": datetime.timestamp(
-                    object_summary.last_modified
-                ),
-            }
-            if "cohorts/" in object_summary.key:
-                file_marker["filename"] = object_summary.key.split("cohorts/")[1]
-                guids.append(file_marker)
-            elif "metadata/" in object_summary.key:
-                file_marker["filename"] = object_summary.key.split("metadata/")[1]
-                metadata.append(file_marker)
-            else:
-                file_marker["filename"] = ntpath.basename(object_summary.key)
-                manifests.append(file_marker)
+        return _get_file_contents(bucket_name, folder, filename)
     except Exception as e:
-        logger.error(
-            f'Failed to list files in bucket "{bucket_name}" folder "{folder}": {e}'
-        )
-        return str(e), False
+        legacy_folder = listing.get_legacy_folder(folder)
+        if legacy_folder and storage.is_not_found(e):
+            return _file_contents_response(bucket_name, legacy_folder, filename)
+        return _s3_read_error_response(e, folder, filename)
 
-    manifests_sorted = sorted(manifests, key=lambda i: i["last_modified_timestamp"])
-    guids_sorted = sorted(guids, key=lambda i: i["last_modified_timestamp"])
-    metadata_sorted = sorted(metadata, key=lambda i: i["last_modified_timestamp"])
 
-    rv = {
-        "manifests": manifests_sorted,
-        "cohorts": guids_sorted,
-        "metadata": metadata_sorted,
-    }
-    return rv, True
+def _s3_read_error_response(e, folder, filename):
+    """
+    Returns the JSON error response for an exception raised while reading
+    folder/filename from s3.
+    """
+    if isinstance(e, CircuitOpenError):
+        logger.warning(f"Not reading {folder}/{filename}: {e}")
+        response = flask.jsonify({"error": "Currently unable to connect to s3."})
+        response.headers["Retry-After"] = str(max(1, int(e.retry_after + 0.5)))
+        return response, 503
+    if storage.is_not_found(e):
+        return flask.jsonify({"error": f"File {filename} not found."}), 404
+    logger.error(f"Failed to read {folder}/{filename} from s3: {e}")
+    return flask.jsonify({"error": "Currently unable to connect to s3."}), 500
+
+
+@blueprint.errorhandler(CircuitOpenError)
+def _handle_circuit_open(e):
+    """
+    Answers the requests failing because the s3 circuit breaker is open with a
+    503 and Retry-After: the listing and write helpers let CircuitOpenError
+    through instead of reporting a failure to connect to s3.
+    """
+    return _s3_read_error_response(e, _get_folder_name_from_token(current_token), "")
 
 
-def _get_file_contents(bucket_name, folder, filename):
+def _parse_slice_args(args):
+    """
+    Parses the projection and slicing query parameters of the file endpoint.
+    Returns (None, None) if none were provided, (slice_args, None) if they are
+    valid, and (None, error_message) otherwise.
+    """
+    if not any(arg in args for arg in ("fields", "offset", "limit", "format")):
+        return None, None
+
+    fields = None
+    if args.get("fields"):
+        fields = [field for field in args["fields"].split(",") if field]
+
+    slice_args = {"fields": fields}
+    for name, default in (("offset", 0), ("limit", None)):
+        value = args.get(name)
+        if value is None or value == "":
+            slice_args[name] = default
+            continue
+        if not value.isdigit():
+            return None, f"'{name}' must be a non-negative integer."
+        slice_args[name] = int(value)
+
+    output_format = args.get("format") or "json"
+    if output_format not in ("json", "ndjson"):
+        return None, "'format' must be one of: json, ndjson."
+    slice_args["output_format"] = output_format
+
+    return slice_args, None
+
+
+def _sliced_file_response(
+    bucket_name, folder, filename, fields, offset, limit, output_format
+):
     """
-    Returns the body of a requested file as a string.
+    Streams the selected records and fields of a manifest, parsing the s3 object
+    as it is received rather than loading the whole manifest in memory.
     """
-    client = boto3.client(
-        "s3",
+    try:
+        response, offset = files.open_manifest_slice(
+            bucket_name, folder, filename, offset, limit
+        )
+    except Exception as e:
+        return _s3_read_error_response(e, folder, filename)
+
+    body = response["Body"]
+    records = streaming.project_and_slice(
+        streaming.iter_json_array(
+            body.iter_chunks(),
+            quote_fix=True,
+            partial="ContentRange" in response,
+            max_record_size=get_config("manifest_max_record_size"),
+        ),
+        fields,
+        offset,
+        limit,
     )
-    obj = client.get_object(Bucket=bucket_name, Key=folder + "/" + filename)
-    as_bytes = obj["Body"].read()
-    as_string = as_bytes.decode("utf-8")
-    return as_string.replace("'", '"')
+    # read up to the first record now, so that a file that is not a manifest can
+    # still get an error status code
+    try:
+        first = next(records, None)
+    except Exception as e:
+        body.close()
+        logger.error(f"Unable to parse {folder}/{filename} as a manifest: {e}")
+        return (
+            flask.jsonify({"error": f"File {filename} is not a list of records."}),
+            400,
+        )
+    if first is not None:
+        records = itertools.chain([first], records)
+
+    def generate():
+        try:
+            yield from streaming.serialize_records(records, output_format)
+        except Exception as e:
+            # the status code was sent already: re-raise so that the server drops
+            # the connection and the client sees a truncated response, rather
+            # than a complete one missing records
+            logger.error(f"Failed while streaming {folder}/{filename}: {e}")
+            raise
+        finally:
+            body.close()
+
+    mimetype = "application/json"
+    if output_format == "ndjson":
+        mimetype = "application/x-ndjson"
+    return flask.Response(generate(), mimetype=mimetype)
+
+
+def _check_rate_limit(budget):
+    """
+    Takes a token from the user's "read" or "write" budget. If the budget is
+    exhausted, returns a 429 response telling the user when to retry.
+    """
+    retry_after = ratelimit.get_rate_limiter().check(str(current_token["sub"]), budget)
+    if not retry_after:
+        return None, None
+    response = flask.jsonify({"error": "Too many requests. Please retry later."})
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response, 429
 
 
 def _authenticate_user():
@@ -560,7 +1479,8 @@ def _authenticate_user():
     """
     audience = flask.current_app.config["OIDC_ISSUER"]
     try:
-        set_current_token(validate_request(scope={"user"}, audience=audience))
+        with tracing.span("auth"):
+            set_current_token(validate_request(scope={"user"}, audience=audience))
     except Exception as e:
         logger.error(e)
         json_to_return = {"error": "Please log in."}
@@ -0,0 +1,249 @@
+"""
+Migration of the manifest bucket from the legacy key layout (PREFIX/user-<sub>/)
+to the sharded layout (PREFIX/<shard>/user-<sub>/); see layout.py.
+
+Set "key_layout" to "sharded" first: new files then go to the sharded folders,
+and the service keeps reading the legacy folders of the users who have not been
+migrated yet ("key_layout_fallback"). Then run:
+
+    manifestservice-migrate-layout --workers 32
+
+Every object of a legacy user folder, and of its sidecar folder, is copied to
+the user's sharded folders with a server-side copy, and deleted from the legacy
+folders once copied. Objects that already exist in the sharded folder are not
+overwritten, except for the manifest summaries, which are merged. The last
+modification times of the moved files are recorded in the sidecar folder, so
+that listings keep returning them (see layout.original_last_modified()). User
+folders are migrated by a bounded pool of workers, and the job can be run again
+to retry the objects it could not move. Once no legacy folder is left,
+"key_layout_fallback" can be disabled.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent import futures
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from . import layout
+from .config import DEFAULTS
+from .scan import _load_config, iter_user_folders
+from .storage import copy_object, delete_objects, update_json
+
+
+def _list_objects(client, bucket, folder):
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder + "/"):
+        for obj in page.get("Contents", []):
+            yield obj["Key"], obj["Size"], obj["LastModified"]
+
+
+def migrate_user_folder(client, bucket, folder, width, dry_run=False):
+    """
+    Moves the objects of the legacy user folder `folder`, and of its sidecar
+    folder, to its sharded folders.
+    Returns a dict with the number of objects and bytes moved, and the
+    (key, error message) of the objects that could not be moved.
+    """
+    target = layout.sharded_folder(folder, width)
+    folders = [
+        (folder, target),
+        (layout.sidecar_folder(folder), layout.sidecar_folder(target)),
+    ]
+    summaries_key = f"{layout.sidecar_folder(folder)}/summaries/manifests.json"
+    objects = [
+        (key, size, last_modified, target_folder + key[len(source) :])
+        for source, target_folder in folders
+        for key, size, last_modified in _list_objects(client, bucket, source)
+    ]
+    result = {
+        "user": folder.rpartition("/")[2],
+        "target": target,
+        "objects": len(objects),
+        "bytes": sum(size for _, size, _, _ in objects),
+        "errors": [],
+    }
+    if dry_run or not objects:
+        return result
+
+    existing = set(
+        key
+        for _, target_folder in folders
+        for key, _, _ in _list_objects(client, bucket, target_folder)
+    )
+    moved = []
+    # last modification times of the user files copied to the sharded folder
+    copied_files = {}
+    for key, size, last_modified, target_key in objects:
+        try:
+            if key == summaries_key:
+                _merge_summaries(client, bucket, key, target_key)
+            elif target_key not in existing:
+                copy_object(bucket, key, bucket, target_key, size, client=client)
+                if key.startswith(folder + "/"):
+                    copied_files[target_key] = (key, last_modified)
+        except ClientError as e:
+            result["errors"].append((key, str(e)))
+            continue
+        moved.append(key)
+    if copied_files:
+        try:
+            _record_moved_files(client, bucket, target, copied_files)
+        except ClientError as e:
+            # keep the legacy files, which still have their times, for a rerun
+            not_recorded = set(key for key, _ in copied_files.values())
+            result["errors"].extend((key, str(e)) for key in sorted(not_recorded))
+            moved = [key for key in moved if key not in not_recorded]
+    result["errors"].extend(delete_objects(bucket, moved, client=client))
+    return result
+
+
+def _record_moved_files(client, bucket, target, copied_files):
+    """
+    Records the last modification times of the files copied to the sharded
+    folder `target` ({target key: (legacy key, last modified)}) in its
+    layout.MOVED_FILES sidecar file, along with the times of the copies.
+    """
+    moved_times = {
+        key: last_modified
+        for key, _, last_modified in _list_objects(client, bucket, target)
+        if key in copied_files
+    }
+    files = {
+        target_key[len(target) + 1 :]: {
+            "moved": moved_times[target_key].isoformat(),
+            "last_modified": last_modified.isoformat(),
+        }
+        for target_key, (_, last_modified) in copied_files.items()
+        if target_key in moved_times
+    }
+
+    def add(moved_files):
+        moved_files = moved_files or {"version": 1, "files": {}}
+        moved_files["files"].update(files)
+        return moved_files
+
+    update_json(bucket, layout.moved_files_key(target), add, client=client)
+
+
+def _merge_summaries(client, bucket, key, target_key):
+    """
+    Adds the manifest summaries of the legacy folder to those of the sharded
+    folder, which win for manifests that have both.
+    """
+    response = client.get_object(Bucket=bucket, Key=key)
+    legacy_files = json.loads(response["Body"].read()).get("files", {})
+
+    def merge(summaries):
+        summaries = summaries or {"version": 1, "files": {}}
+        summaries["files"] = dict(legacy_files, **summaries["files"])
+        return summaries
+
+    update_json(bucket, target_key, merge, client=client)
+
+
+def migrate(client, bucket, root, on_result, width, workers=16, dry_run=False):
+    """
+    Migrates every legacy user folder under `root`, `workers` folders at a
+    time, and calls `on_result` with the result of each folder.
+    """
+    lock = threading.Lock()
+
+    def migrate_folder(folder):
+        result = migrate_user_folder(client, bucket, folder, width, dry_run)
+        with lock:
+            on_result(result)
+
+    with futures.ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="migrate-layout"
+    ) as pool:
+        pending = set()
+        for folder in iter_user_folders(client, bucket, root):
+            if "/" in folder[len(root) :]:
+                # already in the sharded layout
+                continue
+            pending.add(pool.submit(migrate_folder, folder))
+            if len(pending) >= 2 * workers:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+        for future in futures.as_completed(pending):
+            future.result()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Move the user folders of the manifest bucket to the sharded key layout."
+    )
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("MANIFEST_SERVICE_CONFIG_PATH", "config.json"),
+        help="config.json to read the bucket name, prefix and shard width from",
+    )
+    parser.add_argument("--bucket", help="defaults to manifest_bucket_name")
+    parser.add_argument("--prefix", help="defaults to the configured prefix")
+    parser.add_argument("--shard-width", type=int, help="defaults to key_shard_width")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--region", help="defaults to s3_region")
+    args = parser.parse_args(args)
+
+    config = _load_config(args.config)
+    bucket = args.bucket or config.get("manifest_bucket_name")
+    if not bucket:
+        parser.error("no bucket provided and none configured")
+    prefix = args.prefix if args.prefix is not None else config.get("prefix", "")
+    root = prefix + "/" if prefix else ""
+    width = args.shard_width or config.get(
+        "key_shard_width", DEFAULTS["key_shard_width"]
+    )
+
+    region = args.region or config.get("s3_region", DEFAULTS["s3_region"])
+    client = boto3.Session(region_name=region).client(
+        "s3",
+        config=Config(
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            max_pool_connections=args.workers + 1,
+        ),
+    )
+    totals = {"users": 0, "objects": 0, "bytes": 0, "errors": 0}
+
+    def on_result(result):
+        totals["users"] += 1
+        totals["objects"] += result["objects"]
+        totals["bytes"] += result["bytes"]
+        totals["errors"] += len(result["errors"])
+        print(
+            "{user} -> {target}: {objects} objects, {bytes} bytes, {} errors".format(
+                len(result["errors"]), **result
+            )
+        )
+        for key, message in result["errors"]:
+            print(f"  could not move {key}: {message}", file=sys.stderr)
+
+    migrate(
+        client,
+        bucket,
+        root,
+        on_result,
+        width,
+        workers=args.workers,
+        dry_run=args.dry_run,
+    )
+    print(
+        "{}{users} user folders: moved {objects} objects ({bytes} bytes), "
+        "{errors} errors".format("[dry run] " if args.dry_run else "", **totals),
+        file=sys.stderr,
+    )
+    return totals
+
+
+if __name__ == "__main__":
+    main()
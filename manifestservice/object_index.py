@@ -0,0 +1,366 @@
+"""
+Inverted index of a user's manifests: which manifests contain a given object_id
+(or other indexed field, such as subject_id).
+
+The index is stored in sidecar files of the user's folder, split into
+"object_index_partitions" partition files by a hash of the indexed value, so
+that a lookup reads one small file whatever the number and size of the
+manifests. A partition holds the indexed filenames and, for each field, a map
+from value to the positions of the manifests containing it in that list:
+
+    {
+        "version": 1,
+        "files": ["manifest-a.json", "manifest-b.json"],
+        "ids": {"object_id": {"dg.1234/1": [0, 1], "dg.1234/2": [1]}}
+    }
+
+A separate file lists the manifests that were indexed, so that the ones missing
+from the index (uploaded while indexing was disabled, or whose indexing failed)
+are indexed on demand, and deleted ones are pruned.
+"""
+
+import hashlib
+import math
+import time
+
+import flask
+from cdislogging import get_logger
+
+from . import deadlines, layout, listing, storage, streaming, tasks
+from .config import get_config
+from .files import open_manifest_stream
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+VERSION = 1
+
+# Number of manifests indexed between two writes of the index, and the seconds
+# a lookup spends indexing the manifests missing from the index before answering
+# from the ones that are indexed
+INDEX_BATCH = 20
+LOOKUP_BUDGET = 10
+
+
+def partition(value, partitions):
+    """
+    Returns the name of the partition holding `value` (a string).
+    """
+    digest = hashlib.sha256(value.encode("utf-8")).digest()
+    return str(int.from_bytes(digest[:4], "big") % partitions)
+
+
+def index_value(value):
+    """
+    Returns the indexed form of a field value: its string form for strings and
+    numbers, or None for values that are not indexed (lists, objects, null).
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+class IdCollector(object):
+    """
+    Collects the values of the indexed `fields` of the records of a manifest,
+    grouped by partition.
+    """
+
+    def __init__(self, fields, partitions):
+        self.fields = fields
+        self.partitions = partitions
+        self._ids = {}
+
+    def add(self, record):
+        for field in self.fields:
+            value = index_value(record.get(field))
+            if value is None:
+                continue
+            ids = self._ids.setdefault(partition(value, self.partitions), {})
+            ids.setdefault(field, set()).add(value)
+
+    def by_partition(self):
+        """
+        Returns {partition: {field: [values]}}, JSON-serializable.
+        """
+        return {
+            name: {field: sorted(values) for field, values in fields.items()}
+            for name, fields in self._ids.items()
+        }
+
+
+def add(document, filename, ids):
+    """
+    Adds the manifest `filename`, which contains the values `ids` ({field:
+    [values]}), to the partition `document` (None for a new partition), and
+    returns the updated partition.
+    """
+    document = document or {"version": VERSION, "files": [], "ids": {}}
+    files = document["files"]
+    if filename in files:
+        position = files.index(filename)
+    else:
+        position = len(files)
+        files.append(filename)
+    for field, values in ids.items():
+        entries = document["ids"].setdefault(field, {})
+        for value in values:
+            positions = entries.setdefault(value, [])
+            if position not in positions:
+                positions.append(position)
+    return document
+
+
+def remove(document, filenames, fields=None):
+    """
+    Removes the manifests `filenames` from the partition `document`, and the
+    fields not in `fields` if it is not None. Returns the updated partition.
+    """
+    if document is None:
+        return None
+    filenames = set(filenames)
+    positions = {}
+    files = []
+    for position, filename in enumerate(document["files"]):
+        if filename not in filenames:
+            positions[position] = len(files)
+            files.append(filename)
+    ids = {}
+    for field, entries in document["ids"].items():
+        if fields is not None and field not in fields:
+            continue
+        ids[field] = {}
+        for value, old_positions in entries.items():
+            new_positions = [positions[p] for p in old_positions if p in positions]
+            if new_positions:
+                ids[field][value] = new_positions
+    return {"version": VERSION, "files": files, "ids": ids}
+
+
+def lookup(document, field, value):
+    """
+    Returns the filenames of the manifests of the partition `document` that
+    contain `value` in `field`.
+    """
+    if document is None:
+        return []
+    positions = document["ids"].get(field, {}).get(value, [])
+    return [document["files"][position] for position in positions]
+
+
+@tasks.task
+def add_to_index(folder_name, filename, ids):
+    """
+    Adds a new manifest, whose indexed values were collected while its upload
+    was validated, to the user's object index.
+    Runs as a background task: a manifest missing from the index is indexed
+    by the next lookup.
+    """
+    _write_index(folder_name, {filename: ids})
+
+
+def _get_index_key(folder_name, name):
+    """
+    Returns the key of a partition of the user's object index, or of the list of
+    indexed manifests if `name` is None. Partitions are stored by partition
+    count, so that changing "object_index_partitions" starts a new index.
+    """
+    if name is None:
+        return layout.sidecar_key(folder_name, "objects", "files.json")
+    partitions = get_config("object_index_partitions")
+    return layout.sidecar_key(folder_name, f"objects/{partitions}", f"{name}.json")
+
+
+def _write_index(folder_name, additions, stale=(), rewrite=False, unreadable=()):
+    """
+    Adds the manifests of `additions` ({filename: {partition: {field: [values]}}})
+    to the user's object index and removes the `stale` manifests from it. With
+    `rewrite`, the index is rewritten from `additions` only. The `unreadable`
+    files, which are not lists of records, are recorded so that they are not
+    read again until the index is rebuilt.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    partitions = get_config("object_index_partitions")
+    fields = get_config("object_index_fields")
+
+    by_partition = {}
+    for filename, ids in additions.items():
+        for name, values in ids.items():
+            by_partition.setdefault(name, []).append((filename, values))
+    # removing manifests touches every partition, adding them only their own
+    names = by_partition
+    if stale or rewrite:
+        names = [str(i) for i in range(partitions)]
+
+    for name in names:
+
+        def update(document, added=by_partition.get(name, [])):
+            if rewrite:
+                document = None
+            elif stale:
+                document = remove(document, stale)
+            for filename, values in added:
+                document = add(document, filename, values)
+            return document or (
+                {"version": VERSION, "files": [], "ids": {}} if rewrite else None
+            )
+
+        storage.update_json(bucket_name, _get_index_key(folder_name, name), update)
+
+    def update_files(files_document):
+        if rewrite:
+            files_document = None
+        elif files_document is not None and _is_outdated(files_document):
+            # left for the next lookup to rebuild
+            return None
+        files_document = files_document or {
+            "version": VERSION,
+            "partitions": partitions,
+            "fields": fields,
+            "files": [],
+        }
+        indexed = (set(files_document["files"]) | set(additions)) - set(stale)
+        files_document["files"] = sorted(indexed)
+        unreadable_files = set(files_document.get("unreadable", [])) | set(unreadable)
+        files_document["unreadable"] = sorted(unreadable_files - indexed - set(stale))
+        return files_document
+
+    storage.update_json(bucket_name, _get_index_key(folder_name, None), update_files)
+
+
+def _is_outdated(files_document):
+    return (
+        files_document.get("version") != VERSION
+        or files_document.get("partitions") != get_config("object_index_partitions")
+        or files_document.get("fields") != get_config("object_index_fields")
+    )
+
+
+def refresh(folder_name, listed=None, rebuild=False, budget=None):
+    """
+    Brings the user's object index up to date with the user's manifests
+    (`listed`, a set of filenames, or listed from s3 if None): indexes the
+    manifests missing from it and prunes the deleted ones once they are more
+    than a quarter of the index. The index is rebuilt from scratch if `rebuild`
+    is set, if it does not exist or if its configuration changed.
+
+    Manifests are indexed by batches of INDEX_BATCH, each written to the index
+    before the next one is read, so that work is not lost when a request runs
+    out of time. With a `budget`, no batch is started after `budget` seconds
+    and the remaining manifests are left for later.
+
+    Returns the number of manifests in the index, and the sorted filenames of
+    the manifests that are not in it: left for later, or not lists of records.
+    """
+    start = time.monotonic()
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    if listed is None:
+        result, ok = listing.list_files(bucket_name, folder_name)
+        if not ok:
+            raise Exception(f"Unable to list the files of {folder_name}: {result}")
+        listed = set(f["filename"] for f in result["manifests"])
+
+    files_document = storage.get_json(bucket_name, _get_index_key(folder_name, None))
+    if files_document is None and not listed:
+        return 0, []
+    rewrite = rebuild or files_document is None or _is_outdated(files_document)
+    indexed = set() if rewrite else set(files_document["files"])
+    unreadable = set() if rewrite else set(files_document.get("unreadable", []))
+    missing = sorted(listed - indexed - unreadable)
+    stale = (indexed | unreadable) - listed
+    if len(stale) * 4 <= len(indexed):
+        stale = set()
+    if not rewrite and not missing and not stale:
+        return len(indexed), sorted(listed - indexed)
+
+    logger.info(
+        f"Indexing {len(missing)} manifests of {folder_name}"
+        f" ({len(stale)} deleted, rewrite: {rewrite})"
+    )
+    indexed -= stale
+    # rewriting or pruning the index takes a write even without new manifests
+    for position in range(0, max(len(missing), 1), INDEX_BATCH):
+        if position and budget is not None and time.monotonic() - start >= budget:
+            break
+        additions = {}
+        failed = []
+        for filename in missing[position : position + INDEX_BATCH]:
+            ids = _collect_manifest_ids(folder_name, filename)
+            if ids is None:
+                failed.append(filename)
+            else:
+                additions[filename] = ids
+        _write_index(folder_name, additions, sorted(stale), rewrite, failed)
+        indexed |= set(additions)
+        rewrite = False
+        stale = set()
+
+    return len(indexed), sorted(listed - indexed)
+
+
+@tasks.task
+def index_missing_manifests(folder_name):
+    """
+    Indexes the manifests missing from the user's object index, which a lookup
+    did not have the time to index.
+    """
+    try:
+        refresh(folder_name)
+    finally:
+        storage.app_state("object_index_indexing", set).discard(folder_name)
+
+
+def _collect_manifest_ids(folder_name, filename):
+    """
+    Reads a manifest from s3 and returns the values of its indexed fields, as
+    returned by IdCollector.by_partition(), or None if the file is not a list
+    of records.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    collector = IdCollector(
+        get_config("object_index_fields"), get_config("object_index_partitions")
+    )
+    body = open_manifest_stream(bucket_name, folder_name, filename)["Body"]
+    try:
+        for record in streaming.iter_json_array(
+            body.iter_chunks(),
+            quote_fix=True,
+            max_record_size=get_config("manifest_max_record_size"),
+        ):
+            if isinstance(record, dict):
+                collector.add(record)
+    except ValueError as e:
+        logger.warning(f"Not indexing {filename}, which is not a manifest: {e}")
+        return None
+    finally:
+        body.close()
+    return collector.by_partition()
+
+
+def find_manifests(folder_name, field, value):
+    """
+    Returns the sorted filenames of the user's manifests that contain `value`
+    in `field`, after indexing the manifests missing from the index for up to
+    LOOKUP_BUDGET seconds, and the sorted filenames of the manifests that are
+    still not indexed. Those are indexed in the background if
+    "background_tasks" is enabled, and by the next lookups otherwise.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    result, ok = listing.list_files(bucket_name, folder_name)
+    if not ok:
+        raise Exception(f"Unable to list the files of {folder_name}: {result}")
+    listed = set(f["filename"] for f in result["manifests"])
+    budget = min(LOOKUP_BUDGET, deadlines.remaining(math.inf) / 2)
+    _, unindexed = refresh(folder_name, listed, budget=budget)
+
+    indexing = storage.app_state("object_index_indexing", set)
+    if unindexed and get_config("background_tasks") and folder_name not in indexing:
+        indexing.add(folder_name)
+        tasks.run(index_missing_manifests, folder_name)
+
+    name = partition(value, get_config("object_index_partitions"))
+    document = storage.get_json(bucket_name, _get_index_key(folder_name, name))
+    # deleted manifests are only pruned from the index from time to time
+    filenames = sorted(set(lookup(document, field, value)) & listed)
+    return filenames, unindexed
@@ -0,0 +1,160 @@
+"""
+Per-user token-bucket rate limiting, with separate budgets for reads and writes.
+
+Each user gets a bucket of `burst` tokens per budget, refilled at `rate` tokens
+per second; a request takes one token and is rejected if there is none left.
+Buckets are kept in process by default. In deployments with several workers or
+pods, the optional Redis backend (the `redis` package must be installed) shares
+the buckets between them; if Redis is unavailable the in-process buckets are
+used instead.
+"""
+
+import threading
+import time
+
+from cdislogging import get_logger
+
+from . import storage
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+
+class InProcessBackend(object):
+    """
+    Token buckets stored in a dict: {key: (tokens, last_refill_time, full_time)},
+    where full_time is when the bucket will have refilled completely, at the
+    rate and burst it was last used with.
+    """
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_eviction = 0
+
+    def acquire(self, key, rate, burst):
+        """
+        Takes a token from the bucket of `key`. Returns 0 if a token was taken,
+        or the number of seconds until one is available.
+        """
+        now = self._clock()
+        with self._lock:
+            tokens, last, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.max_keys and now >= self._next_eviction:
+                self._evict_full_buckets(now)
+                self._next_eviction = now + 1
+        return 0 if allowed else (1 - tokens) / rate
+
+    def _evict_full_buckets(self, now):
+        # a bucket that has had time to refill completely is the same as no bucket
+        for key, (_, _, full_time) in list(self._buckets.items()):
+            if now >= full_time:
+                del self._buckets[key]
+
+
+class RedisBackend(object):
+    """
+    Token buckets stored in Redis hashes, updated atomically by a Lua script so
+    that every worker and pod shares the same buckets.
+    """
+
+    # KEYS[1]: bucket key. ARGV: rate, burst, now.
+    # Returns the number of milliseconds until a token is available (0 if taken).
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "last")
+    local tokens = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = math.ceil((1 - tokens) / rate * 1000)
+    end
+    redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "last", tostring(now))
+    redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return wait
+    """
+
+    def __init__(self, client, key_prefix="manifestservice:ratelimit:"):
+        self.client = client
+        self.key_prefix = key_prefix
+        self._script = client.register_script(self.SCRIPT)
+        self._fallback = InProcessBackend()
+        self._retry_redis_at = 0
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+
+        return cls(redis.Redis.from_url(url, socket_timeout=0.05))
+
+    def acquire(self, key, rate, burst):
+        if time.monotonic() < self._retry_redis_at:
+            return self._fallback.acquire(key, rate, burst)
+        try:
+            wait_ms = self._script(
+                keys=[self.key_prefix + key], args=[rate, burst, time.time()]
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit backend unavailable, limiting locally: {e}")
+            # do not wait on an unavailable Redis for every request
+            self._retry_redis_at = time.monotonic() + 5
+            return self._fallback.acquire(key, rate, burst)
+        return int(wait_ms) / 1000.0
+
+
+class RateLimiter(object):
+    """
+    Applies the configured read and write budgets. `limits` is a dict of
+    budget name to (rate, burst); budgets with a rate of 0 are not limited.
+    """
+
+    def __init__(self, limits, backend=None):
+        self.limits = {
+            budget: (rate, burst) for budget, (rate, burst) in limits.items() if rate
+        }
+        self.backend = backend or InProcessBackend()
+
+    def check(self, user, budget):
+        """
+        Returns 0 if `user` may make a request that costs from `budget`, or the
+        number of seconds after which they may retry.
+        """
+        limit = self.limits.get(budget)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        return self.backend.acquire(f"{budget}:{user}", rate, max(burst, 1))
+
+
+def get_rate_limiter():
+    def create():
+        backend = None
+        if get_config("rate_limit_redis_url"):
+            backend = RedisBackend.from_url(get_config("rate_limit_redis_url"))
+        return RateLimiter(
+            {
+                "read": (
+                    get_config("rate_limit_read_per_second"),
+                    get_config("rate_limit_read_burst"),
+                ),
+                "write": (
+                    get_config("rate_limit_write_per_second"),
+                    get_config("rate_limit_write_burst"),
+                ),
+            },
+            backend,
+        )
+
+    return storage.app_state("rate_limiter", create)
@@ -0,0 +1,167 @@
+"""
+Failure-handling primitives used around s3 calls: a circuit breaker that fails
+fast while s3 is unavailable, and a latency tracker used to decide when a hedged
+(duplicate) read should be sent.
+"""
+
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Error codes returned by s3 that mean "s3 is struggling", as opposed to
+# "the caller asked for something wrong" (NoSuchKey, AccessDenied...)
+TRANSIENT_ERROR_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling s3 while the circuit breaker is open.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(
+            "s3 circuit breaker is open; retry in {:.1f}s".format(retry_after)
+        )
+        self.retry_after = retry_after
+
+
+def is_transient_failure(e):
+    """
+    Returns True if the exception means s3 (or the network to it) is unhealthy.
+    Client errors such as a missing key do not count against the circuit breaker.
+    """
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return error.get("Code") in TRANSIENT_ERROR_CODES or status >= 500
+    return isinstance(e, (BotoCoreError, OSError))
+
+
+class CircuitBreaker(object):
+    """
+    Classic closed / open / half-open circuit breaker.
+
+    After `failure_threshold` consecutive transient failures the circuit opens and
+    every call fails immediately with CircuitOpenError for `reset_timeout` seconds.
+    Then a single trial call is let through: if it succeeds the circuit closes,
+    otherwise it opens again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if (
+                self._state == self.OPEN
+                and self._clock() - self._opened_at >= self.reset_timeout
+            ):
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError if the call must not be attempted.
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            elapsed = self._clock() - self._opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.reset_timeout - elapsed)
+            if self._trial_in_flight:
+                # only one trial call at a time while half-open
+                raise CircuitOpenError(0)
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self, e):
+        if not is_transient_failure(e):
+            # the call went through, so s3 itself is reachable
+            self.record_success()
+            return
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state != self.CLOSED or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+    def guard(self):
+        """
+        Context manager running a block of code under the circuit breaker.
+        """
+        return _BreakerGuard(self)
+
+
+class _BreakerGuard(object):
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        self.breaker.before_call()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.breaker.record_success()
+        elif isinstance(exc, Exception):
+            self.breaker.record_failure(exc)
+        return False
+
+
+class LatencyTracker(object):
+    """
+    Keeps a sliding window of recent call latencies (in seconds) and reports
+    percentiles over it.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        """
+        Returns the p-th percentile (0-100) of the window, or None if there are not
+        enough samples yet to make a meaningful estimate.
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
@@ -0,0 +1,324 @@
+"""
+Retention job: deletes, in every user folder of the manifest bucket, the files
+older than a number of days and/or beyond the newest K files of each type
+(manifests, cohorts, metadata), along with their sidecar files, and records the
+deletions in the folder's change journal so that delta listings report them.
+Change journal entries older than the sync token lifetime are deleted too, since
+delta listings never read them again, as well as the upload records of upload
+deduplication (Idempotency-Key and content hashes) older than
+"upload_record_max_age_days": uploads are only deduplicated against recent ones.
+
+User folders are processed by a bounded pool of workers and files are deleted
+with batched DeleteObjects calls:
+
+    manifestservice-retention --max-age-days 365 --keep 500 --dry-run
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent import futures
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from . import layout, sync
+from .config import DEFAULTS
+from .files import DELETABLE_FILE_TYPES
+from .scan import _load_config, get_moved_files, iter_user_folders
+from .storage import delete_objects
+
+
+def select_expired(entries, max_age_days=None, keep=None, now=None):
+    """
+    Returns the keys to delete among `entries`, a list of (key, last_modified)
+    of one type of file: the files older than `max_age_days` and the files
+    beyond the `keep` newest ones.
+    """
+    now = now or datetime.now(timezone.utc)
+    # newest first; s3 times are to the second, and filenames of files uploaded
+    # within the same second sort by time
+    entries = sorted(entries, key=lambda entry: (entry[1], entry[0]), reverse=True)
+    expired = set()
+    if keep:
+        expired.update(key for key, _ in entries[keep:])
+    if max_age_days:
+        cutoff = now - timedelta(days=max_age_days)
+        expired.update(key for key, modified in entries if modified < cutoff)
+    return expired
+
+
+def prune_user_folder(
+    client,
+    bucket,
+    folder,
+    max_age_days,
+    keep,
+    journal_max_age,
+    upload_record_max_age=None,
+    dry_run=False,
+):
+    """
+    Deletes the expired files of one user folder. Returns a dict with the
+    number of files and bytes deleted, and the keys that could not be deleted.
+    """
+    entries = {file_type: [] for file_type in DELETABLE_FILE_TYPES}
+    sizes = {}
+    moved_files = get_moved_files(client, bucket, folder)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder + "/"):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            file_type, _ = layout.classify_key(key, folder)
+            last_modified = layout.original_last_modified(
+                moved_files, folder, key, obj["LastModified"]
+            )
+            entries[file_type].append((key, last_modified))
+            sizes[key] = obj["Size"]
+
+    journal_keys = []
+    journal_prefix = layout.sidecar_key(folder, "changes", "")
+    journal_cutoff = time.time_ns() - int(journal_max_age * 1e9)
+    for page in paginator.paginate(Bucket=bucket, Prefix=journal_prefix):
+        for obj in page.get("Contents", []):
+            time_ns, _, _ = sync.parse_change_name(obj["Key"][len(journal_prefix) :])
+            if time_ns < journal_cutoff:
+                journal_keys.append(obj["Key"])
+
+    # the upload records of deleted files are not deleted with them, since
+    # their keys are derived from the uploads rather than the filenames
+    upload_keys = []
+    if upload_record_max_age:
+        upload_cutoff = datetime.now(timezone.utc) - timedelta(
+            seconds=upload_record_max_age
+        )
+        upload_prefix = layout.sidecar_key(folder, "uploads", "")
+        for page in paginator.paginate(Bucket=bucket, Prefix=upload_prefix):
+            for obj in page.get("Contents", []):
+                if obj["LastModified"] < upload_cutoff:
+                    upload_keys.append(obj["Key"])
+
+    keys = []
+    deleted_manifests = []
+    deleted_files = {}
+    for file_type, type_entries in entries.items():
+        sub_folder, sidecar_kinds = DELETABLE_FILE_TYPES[file_type]
+        for key in sorted(select_expired(type_entries, max_age_days, keep)):
+            keys.append(key)
+            filename = key[len(f"{folder}/{sub_folder}") :]
+            deleted_files.setdefault(file_type, []).append((key, filename))
+            if file_type == "manifests":
+                deleted_manifests.append(filename)
+            for kind in sidecar_kinds:
+                keys.append(layout.sidecar_key(folder, kind, filename))
+
+    result = {
+        "user": folder.rpartition("/")[2],
+        "files": sum(1 for key in keys if key in sizes),
+        "bytes": sum(sizes.get(key, 0) for key in keys),
+        "journal_entries": len(journal_keys),
+        "upload_records": len(upload_keys),
+        "errors": [],
+    }
+    if dry_run or not keys + journal_keys + upload_keys:
+        return result
+    result["errors"] = delete_objects(
+        bucket, keys + journal_keys + upload_keys, client=client
+    )
+    if deleted_manifests:
+        _remove_summaries(client, bucket, folder, deleted_manifests)
+    _record_deletion(client, bucket, folder, deleted_files, result["errors"])
+    return result
+
+
+def _record_deletion(client, bucket, folder, deleted_files, errors):
+    """
+    Records the deleted files ({file type: [(key, filename)]}) in the folder's
+    change journal, so that delta listings report them.
+    """
+    failed = set(key for key, _ in errors)
+    deleted = {
+        file_type: [filename for key, filename in files if key not in failed]
+        for file_type, files in deleted_files.items()
+    }
+    if not any(deleted.values()):
+        return
+    key = layout.sidecar_key(folder, "changes", sync.deletion_name())
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps(deleted).encode("utf-8"),
+            ContentType="application/json",
+        )
+    except ClientError as e:
+        print(f"Could not record deleted files in {key}: {e}", file=sys.stderr)
+
+
+def _remove_summaries(client, bucket, folder, filenames):
+    """
+    Removes the summaries of deleted manifests from the folder's summaries file,
+    if it was not modified concurrently (the next run cleans up otherwise).
+    """
+    key = layout.sidecar_key(folder, "summaries", "manifests.json")
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return
+    summaries = json.loads(response["Body"].read())
+    for filename in filenames:
+        summaries.get("files", {}).pop(filename, None)
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps(summaries).encode("utf-8"),
+            ContentType="application/json",
+            IfMatch=response["ETag"],
+        )
+    except ClientError as e:
+        print(f"Could not update {key}: {e}", file=sys.stderr)
+
+
+def prune(client, bucket, root, on_result, workers=16, **options):
+    """
+    Prunes every user folder under `root`, `workers` folders at a time, and
+    calls `on_result` with the result of each folder.
+    """
+    lock = threading.Lock()
+
+    def prune_folder(folder):
+        result = prune_user_folder(client, bucket, folder, **options)
+        with lock:
+            on_result(result)
+
+    with futures.ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="retention"
+    ) as pool:
+        pending = set()
+        for folder in iter_user_folders(client, bucket, root):
+            pending.add(pool.submit(prune_folder, folder))
+            if len(pending) >= 2 * workers:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+        for future in futures.as_completed(pending):
+            future.result()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Delete old files from the user folders of the manifest bucket."
+    )
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("MANIFEST_SERVICE_CONFIG_PATH", "config.json"),
+        help="config.json to read the bucket name, prefix and retention from",
+    )
+    parser.add_argument("--bucket", help="defaults to manifest_bucket_name")
+    parser.add_argument("--prefix", help="defaults to the configured prefix")
+    parser.add_argument(
+        "--max-age-days",
+        type=float,
+        help="delete files older than this; defaults to retention_max_age_days",
+    )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        help="keep the newest files of each type; defaults to retention_keep_newest",
+    )
+    parser.add_argument(
+        "--upload-record-max-age-days",
+        type=float,
+        help="delete upload deduplication records older than this; defaults to "
+        "upload_record_max_age_days",
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--region", help="defaults to s3_region")
+    args = parser.parse_args(args)
+
+    config = _load_config(args.config)
+    bucket = args.bucket or config.get("manifest_bucket_name")
+    if not bucket:
+        parser.error("no bucket provided and none configured")
+    prefix = args.prefix if args.prefix is not None else config.get("prefix", "")
+    root = prefix + "/" if prefix else ""
+    max_age_days = args.max_age_days
+    if max_age_days is None:
+        max_age_days = config.get("retention_max_age_days")
+    keep = args.keep if args.keep is not None else config.get("retention_keep_newest")
+    journal_max_age = config.get(
+        "sync_token_max_age", DEFAULTS["sync_token_max_age"]
+    ) + config.get("sync_overlap", DEFAULTS["sync_overlap"])
+    upload_record_max_age_days = args.upload_record_max_age_days
+    if upload_record_max_age_days is None:
+        upload_record_max_age_days = config.get(
+            "upload_record_max_age_days", DEFAULTS["upload_record_max_age_days"]
+        )
+
+    region = args.region or config.get("s3_region", DEFAULTS["s3_region"])
+    client = boto3.Session(region_name=region).client(
+        "s3",
+        config=Config(
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            max_pool_connections=args.workers + 1,
+        ),
+    )
+    totals = {
+        "users": 0,
+        "files": 0,
+        "bytes": 0,
+        "journal_entries": 0,
+        "upload_records": 0,
+        "errors": 0,
+    }
+
+    def on_result(result):
+        totals["users"] += 1
+        totals["files"] += result["files"]
+        totals["bytes"] += result["bytes"]
+        totals["journal_entries"] += result["journal_entries"]
+        totals["upload_records"] += result["upload_records"]
+        totals["errors"] += len(result["errors"])
+        if result["files"] or result["errors"]:
+            print(
+                "{user}: {files} files, {bytes} bytes, {} errors".format(
+                    len(result["errors"]), **result
+                )
+            )
+        for key, message in result["errors"]:
+            print(f"  could not delete {key}: {message}", file=sys.stderr)
+
+    prune(
+        client,
+        bucket,
+        root,
+        on_result,
+        workers=args.workers,
+        max_age_days=max_age_days,
+        keep=keep,
+        journal_max_age=journal_max_age,
+        upload_record_max_age=(upload_record_max_age_days or 0) * 86400,
+        dry_run=args.dry_run,
+    )
+    print(
+        "{}{users} user folders: deleted {files} files ({bytes} bytes), "
+        "{journal_entries} change journal entries and {upload_records} upload "
+        "records, {errors} errors".format(
+            "[dry run] " if args.dry_run else "", **totals
+        ),
+        file=sys.stderr,
+    )
+    return totals
+
+
+if __name__ == "__main__":
+    main()
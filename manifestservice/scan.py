@@ -0,0 +1,345 @@
+"""
+Usage report over the whole manifest bucket: number of files and bytes per user
+folder, oldest and newest file, and bucket-wide totals.
+
+Each user folder (PREFIX/user-<sub>/, or PREFIX/<shard>/user-<sub>/ in the
+sharded key layout) is a shard listed by one of a bounded pool of workers, and
+per-user rows are written as soon as their shard is done, so memory does not
+grow with the size of the bucket. Progress is saved to an
+optional checkpoint file, and an interrupted scan resumes from it:
+
+    manifestservice-scan --format csv --output usage.csv --checkpoint scan.ckpt
+
+The checkpoint records the size of the output file along with the folders done,
+and a resumed scan truncates the output file to that size, so the rows of the
+folders done after the last checkpoint are written once, when they are scanned
+again. Output written to stdout cannot be truncated: those rows are repeated.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent import futures
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from . import layout
+from .config import DEFAULTS
+
+FIELDS = [
+    "user",
+    "manifests",
+    "cohorts",
+    "metadata",
+    "files",
+    "bytes",
+    "sidecar_bytes",
+    "oldest",
+    "newest",
+]
+
+
+def _empty_usage(user):
+    return {
+        "user": user,
+        "manifests": 0,
+        "cohorts": 0,
+        "metadata": 0,
+        "files": 0,
+        "bytes": 0,
+        "sidecar_bytes": 0,
+        "oldest": None,
+        "newest": None,
+    }
+
+
+def _merge_usage(total, usage):
+    for field in ("manifests", "cohorts", "metadata", "files", "bytes"):
+        total[field] += usage[field]
+    total["sidecar_bytes"] += usage["sidecar_bytes"]
+    if usage["oldest"] and (not total["oldest"] or usage["oldest"] < total["oldest"]):
+        total["oldest"] = usage["oldest"]
+    if usage["newest"] and (not total["newest"] or usage["newest"] > total["newest"]):
+        total["newest"] = usage["newest"]
+
+
+def iter_user_folders(client, bucket, root, start_after=None):
+    """
+    Yields the user folders of the bucket in key order, without their trailing
+    slash, starting after `start_after`: the folders of the legacy layout
+    ("<root>user-<sub>") and of the sharded layout ("<root><shard>/user-<sub>").
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket, "Prefix": root, "Delimiter": "/"}
+    shard_start_after = None
+    if start_after:
+        first, _, rest = start_after[len(root) :].partition("/")
+        if rest:
+            # resume within the shard of `start_after`
+            kwargs["StartAfter"] = root + first
+            shard_start_after = start_after
+        else:
+            kwargs["StartAfter"] = start_after + "/"
+    for page in paginator.paginate(**kwargs):
+        for prefix in page.get("CommonPrefixes", []):
+            name = prefix["Prefix"][len(root) : -1]
+            if name.startswith("user-"):
+                yield root + name
+            elif layout.is_shard(name):
+                shard_root = f"{root}{name}/"
+                if shard_start_after and shard_start_after.startswith(shard_root):
+                    yield from iter_user_folders(
+                        client, bucket, shard_root, shard_start_after
+                    )
+                else:
+                    yield from iter_user_folders(client, bucket, shard_root)
+
+
+def get_moved_files(client, bucket, folder):
+    """
+    Returns the layout.MOVED_FILES sidecar file of a user folder, or None.
+    """
+    try:
+        response = client.get_object(Bucket=bucket, Key=layout.moved_files_key(folder))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def scan_user_folder(client, bucket, folder):
+    """
+    Lists one user folder, and its sidecar folder, and returns its usage.
+    """
+    usage = _empty_usage(folder.rpartition("/")[2])
+    paginator = client.get_paginator("list_objects_v2")
+    sidecar_prefix = layout.sidecar_folder(folder) + "/"
+    for page in paginator.paginate(Bucket=bucket, Prefix=sidecar_prefix):
+        for obj in page.get("Contents", []):
+            usage["sidecar_bytes"] += obj["Size"]
+    moved_files = get_moved_files(client, bucket, folder)
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder + "/"):
+        for obj in page.get("Contents", []):
+            file_type, _ = layout.classify_key(obj["Key"], folder)
+            usage[file_type] += 1
+            usage["files"] += 1
+            usage["bytes"] += obj["Size"]
+            last_modified = layout.original_last_modified(
+                moved_files, folder, obj["Key"], obj["LastModified"]
+            ).isoformat()
+            if not usage["oldest"] or last_modified < usage["oldest"]:
+                usage["oldest"] = last_modified
+            if not usage["newest"] or last_modified > usage["newest"]:
+                usage["newest"] = last_modified
+    return usage
+
+
+class Checkpoint(object):
+    """
+    Scan progress: every folder up to and including `after` is done, as well as
+    the folders in `done` (completed out of order, after `after`). The totals so
+    far are saved too, so that a resumed scan reports bucket-wide totals, and
+    the size of the output file holding the rows of those folders.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.after = None
+        self.done = set()
+        self.totals = _empty_usage(None)
+        self.output_offset = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.after = saved["after"]
+            self.done = set(saved["done"])
+            self.totals = saved["totals"]
+            self.output_offset = saved.get("output_offset")
+
+    @property
+    def resuming(self):
+        return self.after is not None or bool(self.done)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "after": self.after,
+                    "done": sorted(self.done),
+                    "totals": self.totals,
+                    "output_offset": self.output_offset,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+
+class _Writer(object):
+    def __init__(self, out, output_format, write_header):
+        self.out = out
+        self.output_format = output_format
+        if output_format == "csv":
+            self.csv = csv.DictWriter(out, fieldnames=FIELDS)
+            if write_header:
+                self.csv.writeheader()
+
+    def write(self, row):
+        if self.output_format == "csv":
+            self.csv.writerow(row)
+        else:
+            self.out.write(json.dumps(row) + "\n")
+        self.out.flush()
+
+    def tell(self):
+        """
+        Returns the size of the output written so far, or None if the output
+        is not a file.
+        """
+        return self.out.tell() if self.out.seekable() else None
+
+
+def scan(
+    client,
+    bucket,
+    root,
+    writer,
+    checkpoint,
+    workers=16,
+    checkpoint_every=100,
+):
+    """
+    Scans every user folder under `root` with `workers` concurrent listings,
+    writes one row per user folder and returns the bucket-wide totals.
+    At most 2 * `workers` folders are in flight at once.
+    """
+    # folders in the order they were submitted, with whether they are done, to
+    # move the checkpoint forward over contiguous completed folders
+    in_flight = OrderedDict()
+    lock = threading.Lock()
+    completed_since_save = 0
+
+    def on_done(folder, usage):
+        nonlocal completed_since_save
+        with lock:
+            writer.write(usage)
+            _merge_usage(checkpoint.totals, usage)
+            in_flight[folder] = True
+            checkpoint.done.add(folder)
+            while in_flight and next(iter(in_flight.values())):
+                done_folder, _ = in_flight.popitem(last=False)
+                checkpoint.after = done_folder
+                checkpoint.done.discard(done_folder)
+            completed_since_save += 1
+            if completed_since_save >= checkpoint_every:
+                checkpoint.output_offset = writer.tell()
+                checkpoint.save()
+                completed_since_save = 0
+
+    def scan_folder(folder):
+        usage = scan_user_folder(client, bucket, folder)
+        on_done(folder, usage)
+
+    try:
+        with futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="scan"
+        ) as pool:
+            pending = set()
+            for folder in iter_user_folders(client, bucket, root, checkpoint.after):
+                if folder in checkpoint.done:
+                    continue
+                with lock:
+                    in_flight[folder] = False
+                pending.add(pool.submit(scan_folder, folder))
+                if len(pending) >= 2 * workers:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        # stop the scan on errors; it can resume from the checkpoint
+                        future.result()
+            for future in futures.as_completed(pending):
+                future.result()
+    finally:
+        with lock:
+            checkpoint.output_offset = writer.tell()
+            checkpoint.save()
+    return checkpoint.totals
+
+
+def _load_config(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Report per-user and bucket-wide usage of the manifest bucket."
+    )
+    parser.add_argument(
+        "--config",
+        default=os.environ.get("MANIFEST_SERVICE_CONFIG_PATH", "config.json"),
+        help="config.json to read the bucket name and prefix from",
+    )
+    parser.add_argument("--bucket", help="defaults to manifest_bucket_name")
+    parser.add_argument("--prefix", help="defaults to the configured prefix")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--output", help="defaults to stdout")
+    parser.add_argument("--checkpoint", help="file to save progress to/resume from")
+    parser.add_argument("--region", help="defaults to s3_region")
+    args = parser.parse_args(args)
+
+    config = _load_config(args.config)
+    bucket = args.bucket or config.get("manifest_bucket_name")
+    if not bucket:
+        parser.error("no bucket provided and none configured")
+    prefix = args.prefix if args.prefix is not None else config.get("prefix", "")
+    root = prefix + "/" if prefix else ""
+
+    region = args.region or config.get("s3_region", DEFAULTS["s3_region"])
+    client = boto3.Session(region_name=region).client(
+        "s3",
+        config=Config(
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            max_pool_connections=args.workers + 1,
+        ),
+    )
+    checkpoint = Checkpoint(args.checkpoint)
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "a" if checkpoint.resuming else "w", newline="")
+        if checkpoint.resuming and checkpoint.output_offset is not None:
+            # drop the rows written after the checkpoint was saved
+            out.truncate(checkpoint.output_offset)
+            out.seek(0, os.SEEK_END)
+    try:
+        writer = _Writer(out, args.format, write_header=not checkpoint.resuming)
+        totals = scan(client, bucket, root, writer, checkpoint, workers=args.workers)
+        totals = dict(totals, user="TOTAL")
+        writer.write(totals)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(
+        "Scanned bucket {}: {} files, {} bytes".format(
+            bucket, totals["files"], totals["bytes"]
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Set operations on the object_id of manifests (union, intersection, difference),
+computed with an external sort-merge so that memory use is bounded whatever the
+size of the manifests.
+
+The records of every manifest are tagged with their manifest's position and
+sorted by object_id in runs of at most `run_size` records, which are spilled to
+temporary files; the runs are then merged, and all the records with the same
+object_id come together:
+
+- union: the records of every object_id found in any manifest;
+- intersection: the records of the first manifest whose object_id is found in
+  every manifest;
+- difference: the records of the first manifest whose object_id is found in no
+  other manifest.
+
+Each object_id appears once in the result, with its first record (in manifest
+order, then record order), and the result is sorted by object_id.
+
+combine_manifests() runs an operation on manifests of a user folder and stores
+the result as a new manifest of the folder.
+"""
+
+import heapq
+import itertools
+import json
+import tempfile
+
+import flask
+from cdislogging import get_logger
+
+from . import files, listing, object_index, streaming, tracing, uploads
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+OPERATIONS = ("union", "intersection", "difference")
+
+# Size of a combined manifest above which it is written to disk before being
+# uploaded
+COMBINE_MEMORY_BUFFER = 8 * 1024 * 1024
+
+
+class CombineError(Exception):
+    """
+    Raised when manifests cannot be combined: one of them is not a list of
+    records, or the result has no records.
+    """
+
+
+def _sort_key(object_id):
+    # a total order over the JSON values object_id can take, keeping 1 and "1"
+    # apart
+    return json.dumps(object_id, sort_keys=True, ensure_ascii=False)
+
+
+def _write_run(entries):
+    entries.sort()
+    run = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+    for entry in entries:
+        run.write(json.dumps(entry))
+        run.write("\n")
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    try:
+        for line in run:
+            yield tuple(json.loads(line))
+    finally:
+        run.close()
+
+
+def sorted_entries(sources, run_size=100000):
+    """
+    Returns an iterator of (key, source, position, record) for the records of
+    `sources`, a list of iterables of records, sorted by key (the object_id)
+    then source and position. Records without an object_id are skipped.
+    At most `run_size` records are held in memory at once.
+    """
+    runs = []
+    entries = []
+    for source, records in enumerate(sources):
+        for position, record in enumerate(records):
+            if not isinstance(record, dict) or "object_id" not in record:
+                continue
+            entries.append((_sort_key(record["object_id"]), source, position, record))
+            if len(entries) >= run_size:
+                runs.append(_read_run(_write_run(entries)))
+                entries = []
+    entries.sort()
+    if not runs:
+        return iter(entries)
+    return heapq.merge(*runs, iter(entries))
+
+
+def combine(sources, operation, run_size=100000):
+    """
+    Yields the records resulting from `operation` (one of OPERATIONS) on the
+    object_id of the records of `sources`, a list of iterables of records
+    (consumed one after the other).
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}")
+    count = len(sources)
+    entries = sorted_entries(sources, run_size)
+    for _, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+        first = next(group)
+        found_in = {first[1]} | {entry[1] for entry in group}
+        if operation == "union":
+            yield first[3]
+        elif operation == "intersection":
+            if len(found_in) == count:
+                yield first[3]
+        elif found_in == {0}:
+            yield first[3]
+
+
+def combine_manifests(folder_name, filenames, operation):
+    """
+    Computes `operation` on the manifests `filenames` of the user's folder,
+    reading them one after the other, and stores the result as a new manifest
+    like uploads.add_manifest() does. The result is written to a temporary file,
+    so memory use is bounded.
+    Returns (filename, True), or (error, False) if a manifest does not exist.
+    Raises CombineError if a manifest cannot be parsed or the result is empty,
+    which POST / would reject, and uploads.QuotaExceeded if the user's folder is
+    full.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+
+    result, ok = listing.list_files(bucket_name, folder_name)
+    if not ok:
+        raise Exception(f"Unable to list the files of {folder_name}: {result}")
+    listed = set(f["filename"] for f in result["manifests"])
+    for filename in filenames:
+        if filename not in listed:
+            return f"Manifest {filename} not found.", False
+
+    def read(filename):
+        body = files.open_manifest_stream(bucket_name, folder_name, filename)["Body"]
+        try:
+            yield from streaming.iter_json_array(
+                body.iter_chunks(),
+                quote_fix=True,
+                max_record_size=get_config("manifest_max_record_size"),
+            )
+        except ValueError as e:
+            logger.error(f"Unable to parse {folder_name}/{filename}: {e}")
+            raise CombineError(f"Manifest {filename} is not a list of records.")
+        finally:
+            body.close()
+
+    index_ids = None
+    if get_config("object_index"):
+        index_ids = object_index.IdCollector(
+            get_config("object_index_fields"), get_config("object_index_partitions")
+        )
+
+    def collect(records):
+        for record in records:
+            if index_ids is not None:
+                index_ids.add(record)
+            yield record
+
+    summary = streaming.ManifestSummary()
+    with tempfile.SpooledTemporaryFile(max_size=COMBINE_MEMORY_BUFFER) as output:
+        with tracing.span("combine", manifests=len(filenames)) as span:
+            records = combine(
+                [read(filename) for filename in filenames],
+                operation,
+                get_config("combine_sort_run_size"),
+            )
+            offsets = streaming.write_with_offsets(
+                collect(records), output, get_config("manifest_index_stride"), summary
+            )
+            span.set(records=summary.records, bytes=summary.size)
+        if not summary.records:
+            raise CombineError(
+                f"The {operation} of these manifests has no records; "
+                "no manifest was created."
+            )
+        output.seek(0)
+        return uploads.add_manifest(
+            folder_name,
+            output,
+            summary,
+            offsets,
+            index_ids=index_ids.by_partition() if index_ids is not None else None,
+        )
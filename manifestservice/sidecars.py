@@ -0,0 +1,181 @@
+"""
+Bookkeeping files stored in the sidecars of a user folder (see layout.py) along
+with the user's files:
+
+- upload records, mapping the content hash or idempotency key of an upload to
+  the file it was stored as, so that the same upload is not stored twice;
+- offset indexes of manifests, for ranged reads of a slice of records;
+- manifest summaries, so that listings include summaries without reading every
+  manifest.
+
+They are optimizations: failing to write them does not fail the upload.
+"""
+
+import hashlib
+
+import flask
+from cdislogging import get_logger
+
+from . import layout, listing, storage, tasks
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+
+def _upload_record_keys(folder_name, file_type, digest, idempotency_key):
+    """
+    Returns the keys of the sidecar files mapping an upload to the file it was
+    stored as: one for its content hash if deduplication is enabled, and one for
+    its idempotency key if the client sent one.
+    """
+    keys = []
+    if idempotency_key:
+        hashed_key = hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest()
+        keys.append(
+            layout.sidecar_key(folder_name, "uploads", f"{file_type}-key-{hashed_key}")
+        )
+    if get_config("deduplicate_uploads"):
+        keys.append(
+            layout.sidecar_key(folder_name, "uploads", f"{file_type}-sha256-{digest}")
+        )
+    return keys
+
+
+def find_previous_upload(
+    folder_name, file_type, digest, idempotency_key, existing_files
+):
+    """
+    Returns the filename under which the same upload was already stored in the
+    user's folder, or None. An upload is the same if it was sent with the same
+    idempotency key (client retries), or, if "deduplicate_uploads" is enabled, if
+    it has the same content. The file must still exist: existing_files is the
+    listing of the user's files of that type.
+    """
+    keys = _upload_record_keys(folder_name, file_type, digest, idempotency_key)
+    if not keys:
+        return None
+    existing_filenames = set(f["filename"] for f in existing_files)
+    for key in keys:
+        try:
+            previous = storage.get_json(
+                flask.current_app.config.get("MANIFEST_BUCKET_NAME"), key
+            )
+        except Exception as e:
+            logger.warning(f"Unable to look up previous upload {key}: {e}")
+            continue
+        if (
+            previous
+            and previous.get("sha256") == digest
+            and previous.get("filename") in existing_filenames
+        ):
+            logger.info(f"Reusing {previous['filename']} for identical upload")
+            return previous["filename"]
+    return None
+
+
+def record_upload(folder_name, file_type, digest, idempotency_key, filename):
+    """
+    Remembers that this upload was stored as `filename`, for
+    find_previous_upload(). Failures are only logged: at worst, a later
+    identical upload is stored again.
+    """
+    for key in _upload_record_keys(folder_name, file_type, digest, idempotency_key):
+        try:
+            storage.put_json(
+                flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+                key,
+                {"filename": filename, "sha256": digest},
+            )
+        except Exception as e:
+            logger.warning(f"Unable to record upload of {filename}: {e}")
+
+
+@tasks.task
+def put_offset_index(folder_name, filename, index):
+    """
+    Stores the offset index of a manifest. The index is an optimization, run as
+    a background task (see tasks.py), so failing to store it does not fail the
+    upload.
+    """
+    storage.put_json(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+        layout.sidecar_key(folder_name, "index", filename),
+        index,
+    )
+
+
+def get_offset_index(folder_name, filename):
+    """
+    Returns the offset index of a manifest, or None if it has none.
+    """
+    try:
+        return storage.get_json(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            layout.sidecar_key(folder_name, "index", filename),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to read offset index of {filename}: {e}")
+        return None
+
+
+@tasks.task
+def add_manifest_summary(folder_name, filename, summary):
+    """
+    Adds the summary of a new manifest to the summaries file of the user's folder.
+    Runs as a background task (see tasks.py): failing to store the summary does
+    not fail the upload.
+    """
+
+    def add(summaries):
+        summaries = summaries or {"version": 1, "files": {}}
+        summaries["files"][filename] = summary
+        return summaries
+
+    storage.update_json(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+        layout.sidecar_key(folder_name, "summaries", "manifests.json"),
+        add,
+    )
+
+
+def remove_manifest_summaries(folder_name, filenames):
+    """
+    Removes the summaries of deleted manifests from the summaries file of the
+    user's folder.
+    """
+
+    def remove(summaries):
+        if summaries is None:
+            return None
+        for filename in filenames:
+            summaries["files"].pop(filename, None)
+        return summaries
+
+    try:
+        storage.update_json(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            layout.sidecar_key(folder_name, "summaries", "manifests.json"),
+            remove,
+        )
+    except Exception as e:
+        logger.warning(f"Failed to remove the summaries of deleted manifests: {e}")
+
+
+def get_manifest_summaries(folder_name):
+    """
+    Returns a dict of the summaries of the user's manifests, by filename.
+    Manifests uploaded before summaries were introduced have no summary.
+    """
+    files = {}
+    legacy_folder = listing.get_legacy_folder(folder_name)
+    for folder in [legacy_folder, folder_name] if legacy_folder else [folder_name]:
+        try:
+            summaries = storage.get_json(
+                flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+                layout.sidecar_key(folder, "summaries", "manifests.json"),
+            )
+        except Exception as e:
+            logger.warning(f"Failed to read manifest summaries of {folder}: {e}")
+            continue
+        files.update((summaries or {}).get("files", {}))
+    return files
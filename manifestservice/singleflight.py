@@ -0,0 +1,99 @@
+"""
+Request coalescing ("single-flight"): concurrent callers asking for the same key
+share a single execution of the underlying call instead of each making their own.
+"""
+
+import threading
+
+from . import deadlines
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "error", "expired")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # whether the caller running the call ran out of its own time
+        self.expired = False
+
+
+def _copy_error(error):
+    """
+    Returns a copy of `error` with the same type, arguments and attributes.
+    Raising an exception sets its traceback and context, so callers in different
+    threads must not raise the same exception object.
+    """
+    copied = type(error).__new__(type(error), *error.args)
+    copied.__dict__.update(error.__dict__)
+    return copied
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls by key. The first caller for a key runs the call;
+    callers arriving while it is in flight wait for it and get the same result, or
+    their own copy of the same exception, chained to the original. Nothing is kept
+    once the call completes, so this is not a cache: a caller arriving after
+    completion runs the call again.
+
+    Callers wait no longer than the deadline of their own request. A call cut short
+    by the deadline of the caller running it is not an answer for the others: they
+    run it again, one of them in turn leading.
+
+    Results are shared between callers and must be treated as read-only.
+
+    At most `max_keys` calls are tracked at once; beyond that, calls simply run
+    without being coalesced, which keeps memory bounded.
+    """
+
+    def __init__(self, max_keys=1024):
+        self.max_keys = max_keys
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is not None:
+                    self.coalesced += 1
+                    leader = False
+                elif len(self._calls) >= self.max_keys:
+                    leader = None
+                else:
+                    call = self._calls[key] = _Call()
+                    leader = True
+
+            if leader is None:
+                return fn()
+            if leader:
+                return self._lead(key, call, fn)
+
+            while not call.done.wait(deadlines.remaining()):
+                deadlines.check()
+            if call.expired:
+                deadlines.check()
+                continue
+            if call.error is not None:
+                raise _copy_error(call.error) from call.error
+            return call.result
+
+    def _lead(self, key, call, fn):
+        deadline = deadlines.current_deadline()
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # fn may also have turned DeadlineExceeded into an error result
+            call.expired = isinstance(call.error, deadlines.DeadlineExceeded) or (
+                deadline is not None and deadline.exceeded
+            )
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
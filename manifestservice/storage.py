@@ -0,0 +1,511 @@
+"""
+Access to the manifest bucket. Every s3 call made by the service goes through
+the helpers in this module so that timeouts, retries, the circuit breaker and
+hedged reads are applied consistently.
+
+Timeouts, retries, the circuit breaker, hedged reads and request coalescing
+are tuned with optional config.json keys; see config.py and the README.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent import futures
+
+import boto3
+import flask
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from cdislogging import get_logger
+
+from . import deadlines
+from .config import get_config
+from .resilience import CircuitBreaker, LatencyTracker
+from .singleflight import SingleFlight
+from .tracing import instrument_s3_client
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+_state_lock = threading.Lock()
+
+# objects larger than this cannot be copied with a single CopyObject call, and
+# are copied in parts of this size
+MAX_COPY_OBJECT_SIZE = 5 * 1024**3
+COPY_PART_SIZE = 256 * 1024**2
+
+
+def app_state(name, factory):
+    """
+    Returns the object stored under `name` for the current app, creating it with
+    `factory()` the first time. State lives on the app (not in module globals) so
+    that each app, and each test, gets its own breaker, pools and caches.
+    """
+    extensions = flask.current_app.extensions.setdefault("manifestservice", {})
+    if name not in extensions:
+        with _state_lock:
+            if name not in extensions:
+                extensions[name] = factory()
+    return extensions[name]
+
+
+def _botocore_config(read_timeout=None):
+    read_timeout = read_timeout or get_config("s3_read_timeout")
+    return Config(
+        connect_timeout=min(get_config("s3_connect_timeout"), read_timeout),
+        read_timeout=read_timeout,
+        retries={
+            "max_attempts": get_config("s3_max_attempts"),
+            "mode": get_config("s3_retry_mode"),
+        },
+    )
+
+
+def get_s3_resource():
+    """
+    Returns a new boto3 s3 resource. Resources are not thread-safe, so callers
+    should not share them between requests. Like clients, resources fit the
+    deadline of the current request.
+    """
+    session = boto3.Session(
+        region_name=get_config("s3_region"),
+    )
+    read_timeout = deadlines.read_timeout(get_config("s3_read_timeout"))
+    resource = session.resource("s3", config=_botocore_config(read_timeout))
+    instrument_s3_client(resource.meta.client)
+    deadlines.instrument_s3_client(resource.meta.client)
+    return resource
+
+
+def get_s3_client(region=None):
+    """
+    Returns the s3 client of the current app for `region` (by default, the
+    region of the manifest bucket). Clients are thread-safe, so one client (and
+    its connection pool) per region is shared by every request; in a request
+    with a deadline, the client has a read timeout that fits in the remaining
+    time (see deadlines.py).
+    """
+    region = region or get_config("s3_region")
+    read_timeout = deadlines.read_timeout(get_config("s3_read_timeout"))
+
+    def create():
+        client = boto3.Session(region_name=region).client(
+            "s3", config=_botocore_config(read_timeout)
+        )
+        return deadlines.instrument_s3_client(instrument_s3_client(client))
+
+    return app_state(f"s3_client:{region}:{read_timeout}", create)
+
+
+def get_circuit_breaker():
+    return app_state(
+        "circuit_breaker",
+        lambda: CircuitBreaker(
+            failure_threshold=get_config("circuit_breaker_failure_threshold"),
+            reset_timeout=get_config("circuit_breaker_reset_timeout"),
+        ),
+    )
+
+
+def guarded():
+    """
+    Context manager to wrap any block of s3 calls with the circuit breaker:
+
+        with storage.guarded():
+            for obj in bucket.objects.filter(Prefix=folder):
+                ...
+    """
+    return get_circuit_breaker().guard()
+
+
+def _nearest_replicas(bucket_name):
+    """
+    Returns the (bucket, region) of the read replicas of `bucket_name` that are
+    nearer than the primary bucket, nearest first: replicas in the region the
+    service runs in ("s3_local_region", or the AWS_REGION environment variable),
+    then the other replicas in the configured order, unless the primary bucket
+    is itself in the local region.
+    """
+    replicas = get_config("s3_read_replicas")
+    if not replicas or bucket_name != flask.current_app.config.get(
+        "MANIFEST_BUCKET_NAME"
+    ):
+        return []
+    primary_region = get_config("s3_region")
+    local_region = (
+        get_config("s3_local_region") or os.environ.get("AWS_REGION") or primary_region
+    )
+    if primary_region == local_region:
+        return []
+    replicas = [
+        (replica["bucket"], replica.get("region") or primary_region)
+        for replica in replicas
+    ]
+    return sorted(replicas, key=lambda replica: replica[1] != local_region)
+
+
+def get_replica_circuit_breaker(bucket_name):
+    return app_state(
+        "circuit_breaker:" + bucket_name,
+        lambda: CircuitBreaker(
+            failure_threshold=get_config("circuit_breaker_failure_threshold"),
+            reset_timeout=get_config("circuit_breaker_reset_timeout"),
+        ),
+    )
+
+
+def read_nearest(bucket_name, read):
+    """
+    Calls `read(client, bucket)` with the nearest healthy read replica of
+    `bucket_name` and returns its result. Replicas are guarded by their own
+    circuit breaker. If the read fails on a replica, because replication has
+    not caught up yet (missing object) or because the replica is unavailable,
+    the next replica is tried, and finally the primary bucket.
+    Only use it for objects that are never modified: a replica can return an
+    older version of an object that was overwritten.
+    """
+    for replica_bucket, region in _nearest_replicas(bucket_name):
+        try:
+            with get_replica_circuit_breaker(replica_bucket).guard():
+                return read(get_s3_client(region), replica_bucket)
+        except Exception as e:
+            if not is_not_found(e):
+                logger.warning(f"Failed to read from replica {replica_bucket}: {e}")
+    with guarded():
+        return read(get_s3_client(), bucket_name)
+
+
+def get_single_flight():
+    return app_state(
+        "single_flight",
+        lambda: SingleFlight(max_keys=get_config("single_flight_max_keys")),
+    )
+
+
+def coalesced(key, fn):
+    """
+    Runs `fn()`, sharing its result with any identical call (same `key`) that is
+    already in flight in this worker. The result must be treated as read-only.
+    """
+    if not get_config("single_flight"):
+        return fn()
+    single_flight = get_single_flight()
+    before = single_flight.coalesced
+    result = single_flight.do(key, fn)
+    if single_flight.coalesced != before:
+        logger.debug(
+            f"Coalesced s3 call {key}; {single_flight.coalesced} coalesced so far"
+        )
+    return result
+
+
+def get_object_body(bucket_name, key, from_replica=False):
+    """
+    Returns the contents of an s3 object as bytes.
+    If hedged reads are enabled and the GET takes longer than the configured
+    percentile of recent GET latencies, a second identical GET is sent and the
+    first one to complete wins. Concurrent reads of the same key are coalesced.
+    With `from_replica`, the object is read from the nearest read replica; see
+    read_nearest().
+    """
+    tracker = app_state("get_latency", LatencyTracker)
+
+    def _get(client, bucket):
+        start = time.monotonic()
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        tracker.record(time.monotonic() - start)
+        return body
+
+    def _hedged_get(client, bucket):
+        if not get_config("hedged_reads"):
+            return _get(client, bucket)
+        return _hedged_call(
+            lambda: _get(client, bucket),
+            tracker.percentile(get_config("hedged_read_percentile")),
+        )
+
+    def _routed_get():
+        if from_replica:
+            return read_nearest(bucket_name, _hedged_get)
+        with guarded():
+            return _hedged_get(get_s3_client(), bucket_name)
+
+    return coalesced(("get_object", bucket_name, key), _routed_get)
+
+
+def _hedged_call(fn, hedge_after):
+    """
+    Runs `fn` and, if it has not completed after `hedge_after` seconds, runs it a
+    second time in parallel. Returns the result of whichever completes first
+    successfully; raises if both fail.
+    """
+    if hedge_after is None:
+        # not enough latency samples yet to know what "slow" means
+        return fn()
+
+    pool = app_state(
+        "hedge_pool",
+        lambda: futures.ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="s3-hedge"
+        ),
+    )
+    # the calls see the deadline and trace of the request
+    pending = {pool.submit(contextvars.copy_context().run, fn)}
+    done, pending = futures.wait(pending, timeout=hedge_after)
+    if not done:
+        pending.add(pool.submit(contextvars.copy_context().run, fn))
+
+    error = None
+    while pending or done:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            break
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+    raise error
+
+
+def iter_objects(bucket_name, prefix, start_after=None):
+    """
+    Yields the (key, last_modified, size) of every object under `prefix`, one
+    page of 1000 objects at a time. If `start_after` is provided, only keys that
+    sort after it are listed.
+    """
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get("Contents", ()):
+            yield obj["Key"], obj["LastModified"], obj["Size"]
+
+
+def open_object_stream(bucket_name, key, byte_range=None, from_replica=False):
+    """
+    Starts reading an s3 object and returns the get_object response; the caller
+    reads `response["Body"]` with `.iter_chunks()` and closes it. `byte_range` is
+    an optional (first_byte, last_byte) tuple, both inclusive, for a ranged GET.
+    The GET is made before this function returns, so errors such as a missing
+    key are raised here rather than while reading. With `from_replica`, the
+    object is read from the nearest read replica; see read_nearest().
+    """
+    kwargs = {}
+    if byte_range is not None:
+        kwargs["Range"] = "bytes={}-{}".format(*byte_range)
+
+    def _open(client, bucket):
+        return client.get_object(Bucket=bucket, Key=key, **kwargs)
+
+    if from_replica:
+        return read_nearest(bucket_name, _open)
+    with guarded():
+        return _open(get_s3_client(), bucket_name)
+
+
+def put_object(bucket_name, key, body, **kwargs):
+    """
+    Uploads `body` (bytes) to the given key. Extra arguments are passed on to
+    the s3 put_object call.
+    """
+    with guarded():
+        return get_s3_client().put_object(
+            Bucket=bucket_name, Key=key, Body=body, **kwargs
+        )
+
+
+def copy_object(
+    bucket_name, key, target_bucket, target_key, size, region=None, client=None
+):
+    """
+    Copies an object of `size` bytes to `target_bucket`, in `region` if it is
+    not the bucket's, with a server-side copy: a CopyObject call, or a multipart
+    copy (UploadPartCopy calls) for objects larger than MAX_COPY_OBJECT_SIZE.
+    The data does not go through the service. With an explicit `client`, the
+    circuit breaker is not used.
+    """
+    guard = guarded() if client is None else contextlib.nullcontext()
+    client = client or get_s3_client(region)
+    source = {"Bucket": bucket_name, "Key": key}
+    with guard:
+        if size > MAX_COPY_OBJECT_SIZE:
+            client.copy(
+                source,
+                target_bucket,
+                target_key,
+                Config=TransferConfig(
+                    multipart_threshold=MAX_COPY_OBJECT_SIZE,
+                    multipart_chunksize=COPY_PART_SIZE,
+                ),
+            )
+        else:
+            client.copy_object(Bucket=target_bucket, Key=target_key, CopySource=source)
+
+
+def delete_objects(bucket_name, keys, client=None):
+    """
+    Deletes `keys` with DeleteObjects calls of up to 1000 keys each, and returns
+    the (key, error message) of the keys that could not be deleted. Deleting a
+    key that does not exist is not an error. Raises if a DeleteObjects call fails.
+    With an explicit `client` (outside of the app, e.g. the retention job), the
+    circuit breaker is not used.
+    """
+    guard = guarded() if client is None else contextlib.nullcontext()
+    client = client or get_s3_client()
+    keys = list(keys)
+    errors = []
+    with guard:
+        for i in range(0, len(keys), 1000):
+            response = client.delete_objects(
+                Bucket=bucket_name,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[i : i + 1000]],
+                    "Quiet": True,
+                },
+            )
+            for error in response.get("Errors", []):
+                errors.append((error["Key"], error.get("Message", error["Code"])))
+    return errors
+
+
+def create_multipart_upload(bucket_name, key, **kwargs):
+    """
+    Starts a multipart upload to the given key and returns its upload id.
+    """
+    with guarded():
+        return get_s3_client().create_multipart_upload(
+            Bucket=bucket_name, Key=key, **kwargs
+        )["UploadId"]
+
+
+def upload_part(bucket_name, key, upload_id, part_number, body):
+    """
+    Uploads (or replaces) one part of a multipart upload and returns its ETag.
+    """
+    with guarded():
+        return get_s3_client().upload_part(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )["ETag"]
+
+
+def list_parts(bucket_name, key, upload_id):
+    """
+    Returns the {"PartNumber", "ETag", "Size"} of the parts of a multipart
+    upload, by part number.
+    """
+    parts = []
+    with guarded():
+        paginator = get_s3_client().get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+            parts.extend(page.get("Parts", ()))
+    return sorted(parts, key=lambda part: part["PartNumber"])
+
+
+def complete_multipart_upload(bucket_name, key, upload_id, parts):
+    """
+    Assembles the parts, a list of (part number, ETag), into the object.
+    """
+    with guarded():
+        return get_s3_client().complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": etag} for number, etag in parts
+                ]
+            },
+        )
+
+
+def abort_multipart_upload(bucket_name, key, upload_id):
+    with guarded():
+        return get_s3_client().abort_multipart_upload(
+            Bucket=bucket_name, Key=key, UploadId=upload_id
+        )
+
+
+def is_not_found(e):
+    return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in (
+        "NoSuchKey",
+        "NoSuchUpload",
+        "404",
+        "NotFound",
+    )
+
+
+def get_json(bucket_name, key):
+    """
+    Returns the parsed JSON contents of an s3 object, or None if it does not
+    exist.
+    """
+    try:
+        return json.loads(get_object_body(bucket_name, key))
+    except ClientError as e:
+        if is_not_found(e):
+            return None
+        raise
+
+
+def put_json(bucket_name, key, value, **kwargs):
+    return put_object(
+        bucket_name,
+        key,
+        json.dumps(value).encode("utf-8"),
+        ContentType="application/json",
+        **kwargs,
+    )
+
+
+def update_json(bucket_name, key, update, attempts=5, client=None):
+    """
+    Read-modify-write of a JSON s3 object, safe against concurrent updates:
+    `update` is called with the current value (None if the object does not exist)
+    and returns the new value, which is only written if the object was not
+    modified in the meantime (s3 conditional writes). Otherwise the update is
+    retried with the new current value. If `update` returns None, nothing is
+    written. With an explicit `client` (outside of the app), the circuit breaker
+    is not used.
+    """
+    guard = guarded if client is None else contextlib.nullcontext
+    client = client or get_s3_client()
+    for attempt in range(attempts):
+        condition = {"IfNoneMatch": "*"}
+        current = None
+        try:
+            with guard():
+                response = client.get_object(Bucket=bucket_name, Key=key)
+                current = json.loads(response["Body"].read())
+            condition = {"IfMatch": response["ETag"]}
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+
+        value = update(current)
+        if value is None:
+            return None
+        try:
+            with guard():
+                return client.put_object(
+                    Bucket=bucket_name,
+                    Key=key,
+                    Body=json.dumps(value).encode("utf-8"),
+                    ContentType="application/json",
+                    **condition,
+                )
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            if attempt == attempts - 1:
+                raise
+            logger.info(f"Concurrent update of {key}, retrying")
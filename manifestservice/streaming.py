@@ -0,0 +1,365 @@
+"""
+Incremental parsing and serialization of manifests, so that large manifests can
+be processed record by record without holding the whole document in memory.
+"""
+
+import codecs
+import hashlib
+import io
+import json
+import re
+
+_decoder = json.JSONDecoder()
+# default bound of iter_json_array() on the size of one element
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+_WHITESPACE = " \t\n\r"
+_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# the start of a record written by older versions of the service
+_SINGLE_QUOTED_RE = re.compile(r"\{[ \t\n\r]*'")
+_SINGLE_QUOTED_DOCUMENT_RE = re.compile(r"[ \t\n\r]*(\[[ \t\n\r]*)?\{[ \t\n\r]*'")
+
+
+class ManifestFormatError(ValueError):
+    """
+    Raised when a streamed document is not a JSON array.
+    """
+
+
+class InvalidRecord(ManifestFormatError):
+    """
+    Raised when an element of a JSON array is rejected by a validation function.
+    """
+
+
+def is_single_quoted(text):
+    """
+    Returns whether `text` starts like a document stored by older versions of
+    the service, with single quotes, which is not valid JSON.
+    """
+    return _SINGLE_QUOTED_DOCUMENT_RE.match(text) is not None
+
+
+def iter_json_array(
+    chunks, quote_fix=False, partial=False, max_record_size=MAX_RECORD_SIZE
+):
+    """
+    Yields the elements of the top-level JSON array contained in `chunks`, an
+    iterable of bytes, as soon as each element has been fully received.
+    Memory use is bounded by the chunk size plus the size of one element:
+    ManifestFormatError is raised as soon as more than `max_record_size`
+    characters are buffered without completing an element, whether the element
+    is that large or the document is invalid.
+
+    If `quote_fix` is set, documents stored by older versions of the service,
+    which used single quotes, are accepted too: if the first element starts with
+    a single-quoted key, which is not valid JSON, single quotes are replaced by
+    double quotes from there on, which is how _get_file_contents() has always
+    returned file bodies. Valid JSON is parsed as is.
+
+    If `partial` is set, `chunks` is a byte range of an array that starts at the
+    beginning of an element (after the opening bracket) and may end after any
+    element, as served by a ranged GET located with an offset index.
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = partial
+    expect_value = True
+    eof = False
+    single_quoted = False
+    first_value = True
+    chunks = iter(chunks)
+
+    while True:
+        # skip whitespace and separators we already know about
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+
+        if pos < len(buffer):
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ManifestFormatError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if char == "]":
+                return
+            if not expect_value:
+                if char != ",":
+                    raise ManifestFormatError(
+                        "Expected ',' or ']' in JSON array, got {!r}".format(char)
+                    )
+                expect_value = True
+                pos += 1
+                continue
+            try:
+                value, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                value, end = None, None
+                if quote_fix and first_value and _SINGLE_QUOTED_RE.match(buffer, pos):
+                    single_quoted = True
+                    buffer = buffer[pos:].replace("'", '"')
+                    pos = 0
+                    continue
+            # a value that reaches the end of the buffer may continue in the next
+            # chunk (e.g. a number), so it is only trusted at the end of the input
+            if end is not None and (end < len(buffer) or eof):
+                yield value
+                pos = end
+                expect_value = False
+                first_value = False
+                continue
+            if eof:
+                raise ManifestFormatError("Truncated or invalid JSON array")
+
+        if eof:
+            if partial:
+                return
+            raise ManifestFormatError("Truncated JSON array")
+        if len(buffer) - pos > max_record_size:
+            raise ManifestFormatError(
+                f"Invalid JSON array, or element larger than {max_record_size} bytes"
+            )
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            text = text_decoder.decode(b"", final=True)
+        else:
+            text = text_decoder.decode(chunk)
+        if single_quoted:
+            text = text.replace("'", '"')
+        buffer = buffer[pos:] + text
+        pos = 0
+
+
+def project_and_slice(records, fields=None, offset=0, limit=None):
+    """
+    Skips the first `offset` records, stops after `limit` records and keeps only
+    `fields` of each record (all fields if None). Consumes `records` lazily and
+    stops consuming it as soon as `limit` records have been produced.
+    """
+    if limit == 0:
+        return
+    produced = 0
+    for i, record in enumerate(records):
+        if i < offset:
+            continue
+        if fields is not None:
+            record = {k: record[k] for k in fields if k in record}
+        yield record
+        produced += 1
+        if limit is not None and produced >= limit:
+            return
+
+
+def serialize_records(records, output_format="json"):
+    """
+    Yields the serialized records as text chunks: either a JSON array, or
+    newline-delimited JSON (one record per line) if `output_format` is "ndjson".
+    """
+    if output_format == "ndjson":
+        for record in records:
+            yield json.dumps(record) + "\n"
+        return
+
+    yield "["
+    first = True
+    for record in records:
+        if first:
+            first = False
+            yield json.dumps(record)
+        else:
+            yield ", " + json.dumps(record)
+    yield "]"
+
+
+class ManifestSummary(object):
+    """
+    Accumulates the summary of a manifest while it is serialized: record count,
+    byte size, number of distinct subject_id values and sha256 of the contents.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.size = 0
+        self._subjects = set()
+        self._sha256 = hashlib.sha256()
+
+    def add_bytes(self, data):
+        self.size += len(data)
+        self._sha256.update(data)
+
+    def add_record(self, record):
+        self.records += 1
+        if isinstance(record, dict) and "subject_id" in record:
+            subject_id = record["subject_id"]
+            if isinstance(subject_id, (dict, list)):
+                subject_id = json.dumps(subject_id, sort_keys=True)
+            self._subjects.add(subject_id)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def to_dict(self):
+        return {
+            "record_count": self.records,
+            "size": self.size,
+            "subject_count": len(self._subjects),
+            "sha256": self.sha256,
+        }
+
+
+def serialize_with_offsets(records, stride, summary=None):
+    """
+    Serializes `records` as a JSON array, byte for byte like
+    `json.dumps(records)`, and returns (body, offsets) where `offsets` holds the
+    byte offset at which every `stride`-th record starts (records 0, stride,
+    2*stride...). `offsets` is empty if `stride` is 0.
+
+    If a ManifestSummary is provided, it is updated as the body is produced, so
+    that summarizing needs no extra pass over the manifest.
+    """
+    output = io.BytesIO()
+    offsets = write_with_offsets(records, output, stride, summary)
+    return output.getvalue(), offsets
+
+
+def write_with_offsets(records, output, stride, summary=None):
+    """
+    Like serialize_with_offsets(), but writes the body to `output`, a binary
+    file, as records are consumed, and returns the offsets.
+    """
+    if summary is None:
+        summary = ManifestSummary()
+    output.write(b"[")
+    summary.add_bytes(b"[")
+    offsets = []
+    position = 1
+    for i, record in enumerate(records):
+        if i:
+            output.write(b", ")
+            summary.add_bytes(b", ")
+            position += 2
+        if stride and i % stride == 0:
+            offsets.append(position)
+        encoded = json.dumps(record).encode("utf-8")
+        output.write(encoded)
+        summary.add_bytes(encoded)
+        summary.add_record(record)
+        position += len(encoded)
+    output.write(b"]")
+    summary.add_bytes(b"]")
+    return offsets
+
+
+def as_utf8(body):
+    """
+    Returns `body`, JSON bytes in any encoding accepted by json.loads(), as
+    UTF-8 bytes without a byte order mark. UTF-8 bodies are returned as is.
+    """
+    encoding = json.detect_encoding(body)
+    if encoding == "utf-8":
+        return body
+    return body.decode(encoding).encode("utf-8")
+
+
+def scan_json_array(body, stride=0, summary=None, validate=None):
+    """
+    Validates `body`, the UTF-8 bytes of a JSON array, one element at a time
+    without building the list, and returns (count, offsets) where `offsets`
+    holds the byte offset in `body` at which every `stride`-th element starts,
+    like serialize_with_offsets() does for the bytes it produces. This lets a
+    request body be stored as sent, instead of parsed and serialized again.
+
+    The elements are decoded from a str copy of the whole body, since the json
+    module only decodes str: the same size as `body` when it is ASCII, but up to
+    four times as large when it has non-ASCII characters.
+
+    If `validate` is provided, it is called with every element and
+    InvalidRecord is raised if it returns False. If a ManifestSummary is
+    provided, it is updated with `body` and its elements. Raises ValueError
+    (ManifestFormatError, or a decoding error) if `body` is not a JSON array.
+    """
+    if summary is None:
+        summary = ManifestSummary()
+    text = body.decode("utf-8")
+    # character positions are byte offsets unless the body has multibyte
+    # characters; then the bytes before each indexed element are counted
+    ascii_only = len(text) == len(body)
+    char_pos = byte_pos = 0
+
+    def byte_offset(pos):
+        nonlocal char_pos, byte_pos
+        if ascii_only:
+            return pos
+        byte_pos += len(text[char_pos:pos].encode("utf-8"))
+        char_pos = pos
+        return byte_pos
+
+    pos = _WHITESPACE_RE.match(text, 0).end()
+    if not text.startswith("[", pos):
+        raise ManifestFormatError("Expected a JSON array")
+    pos = _WHITESPACE_RE.match(text, pos + 1).end()
+    offsets = []
+    count = 0
+    if text.startswith("]", pos):
+        pos += 1
+    else:
+        while True:
+            if stride and count % stride == 0:
+                offsets.append(byte_offset(pos))
+            record, pos = _decoder.raw_decode(text, pos)
+            if validate is not None and not validate(record):
+                raise InvalidRecord(f"Invalid element at index {count}")
+            summary.add_record(record)
+            count += 1
+            pos = _WHITESPACE_RE.match(text, pos).end()
+            if text.startswith("]", pos):
+                pos += 1
+                break
+            if not text.startswith(",", pos):
+                raise ManifestFormatError("Expected ',' or ']' in JSON array")
+            pos = _WHITESPACE_RE.match(text, pos + 1).end()
+    if _WHITESPACE_RE.match(text, pos).end() != len(text):
+        raise ManifestFormatError("Extra data after the JSON array")
+    summary.add_bytes(body)
+    return count, offsets
+
+
+def build_offset_index(offsets, stride, count, size):
+    """
+    Returns the offset index of a manifest: the byte offset of every `stride`-th
+    record, plus the record count and total size of the manifest it describes.
+    """
+    return {
+        "version": 1,
+        "stride": stride,
+        "count": count,
+        "size": size,
+        "offsets": offsets,
+    }
+
+
+def byte_range_for_records(index, offset, limit=None):
+    """
+    Uses an offset index to find the smallest indexed byte range that contains
+    records [offset, offset + limit). Returns (first_byte, last_byte, skip), where
+    `skip` is the number of records to discard at the start of the range, or None
+    if the range is past the end of the manifest.
+    """
+    stride = index["stride"]
+    offsets = index["offsets"]
+    if offset >= index["count"] or not offsets:
+        return None
+    start_entry = offset // stride
+    first_byte = offsets[start_entry]
+    last_byte = index["size"] - 1
+    if limit is not None:
+        end_entry = (offset + limit - 1) // stride + 1
+        if end_entry < len(offsets):
+            # stop right before the first record we do not need
+            last_byte = offsets[end_entry] - 1
+    return first_byte, last_byte, offset - start_entry * stride
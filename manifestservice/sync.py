@@ -0,0 +1,215 @@
+"""
+Sync tokens for delta listings.
+
+Every file added to a user folder is also recorded in a change journal: an empty
+object in the folder's sidecars, named "<time in ns>-<file type>/<filename>".
+Names sort by time, so listing the journal from a point in time (with s3's
+StartAfter) only returns the files added since then, and the cost of a delta
+listing grows with the number of new files rather than with the folder size.
+
+Deletions are recorded too, one entry per deletion request: an object named
+"<time in ns>-deleted/<id>" listing the deleted files, {file type: [filenames]},
+so that delta listings report deleted files along with added ones.
+
+A sync token tells the service where a client's last listing stopped: the
+"watermark" time and the journal entries seen at or after it. The watermark is
+kept a few seconds in the past ("overlap") because journal entries are named
+before they are written, so an upload that started just before a listing can
+appear in the journal just after it; the entries already returned within the
+overlap are not returned again.
+"""
+
+import base64
+import json
+import time
+import uuid
+
+import flask
+from cdislogging import get_logger
+
+from . import invalidation, layout, listing, storage
+from .resilience import CircuitOpenError
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+# file type of the journal entries recording deletions
+DELETED = "deleted"
+
+
+class InvalidSyncToken(ValueError):
+    pass
+
+
+def change_name(file_type, filename, time_ns=None):
+    """
+    Returns the journal entry name recording that `filename` was added to the
+    `file_type` ("manifests", "cohorts" or "metadata") files of a folder.
+    """
+    if time_ns is None:
+        time_ns = time.time_ns()
+    return f"{time_ns:020d}-{file_type}/{filename}"
+
+
+def deletion_name(time_ns=None):
+    """
+    Returns a new journal entry name recording a deletion.
+    """
+    return change_name(DELETED, uuid.uuid4().hex, time_ns)
+
+
+def parse_change_name(name):
+    """
+    Returns the (time_ns, file_type, filename) of a journal entry name.
+    """
+    prefix, _, filename = name.partition("/")
+    time_ns, _, file_type = prefix.partition("-")
+    return int(time_ns), file_type, filename
+
+
+class SyncToken(object):
+    VERSION = 1
+
+    def __init__(self, watermark, seen=()):
+        self.watermark = watermark
+        self.seen = set(seen)
+
+    @property
+    def start_after(self):
+        """
+        Journal entry name to list the journal after: every entry named at or
+        after the watermark sorts after it.
+        """
+        return f"{self.watermark:020d}"
+
+    def age(self, now_ns=None):
+        """
+        Returns the age of the token in seconds.
+        """
+        if now_ns is None:
+            now_ns = time.time_ns()
+        return (now_ns - self.watermark) / 1e9
+
+    def encode(self):
+        value = {"v": self.VERSION, "w": self.watermark, "s": sorted(self.seen)}
+        encoded = base64.urlsafe_b64encode(json.dumps(value).encode("utf-8"))
+        return encoded.decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, token):
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            value = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+            if value["v"] != cls.VERSION:
+                raise ValueError(f"unsupported version {value['v']}")
+            return cls(int(value["w"]), value["s"])
+        except Exception as e:
+            raise InvalidSyncToken(f"Invalid sync token: {e}")
+
+
+def list_changes(bucket_name, folder, token, overlap_ns):
+    """
+    Lists the change journal of a user folder after a sync token. Returns
+    ((files_by_type, deleted, new_token), True), where files_by_type holds the
+    files added since the token, in the same format as listing.list_files(),
+    and `deleted` the filenames of the files deleted since the token, by type.
+    A file added and deleted since the token is only listed as of its last
+    change.
+    """
+    files_by_type = {
+        "manifests": listing.SortedList(),
+        "cohorts": listing.SortedList(),
+        "metadata": listing.SortedList(),
+    }
+    deleted = {file_type: [] for file_type in files_by_type}
+    watermark = max(token.watermark, time.time_ns() - overlap_ns)
+    seen = []
+    # (time_ns, file_type, filename, last_modified or None for a deletion)
+    changes = []
+    deletions = []
+    folders = [folder]
+    legacy_folder = listing.get_legacy_folder(folder)
+    if legacy_folder:
+        folders.append(legacy_folder)
+    try:
+        with storage.guarded():
+            for journal_folder in folders:
+                prefix = layout.sidecar_key(journal_folder, "changes", "")
+                for key, last_modified, _ in storage.iter_objects(
+                    bucket_name, prefix, start_after=prefix + token.start_after
+                ):
+                    name = key[len(prefix) :]
+                    time_ns, file_type, filename = parse_change_name(name)
+                    if time_ns >= watermark:
+                        seen.append(name)
+                    if name in token.seen:
+                        continue
+                    if file_type == DELETED:
+                        deletions.append((time_ns, key))
+                    elif file_type in files_by_type:
+                        changes.append((time_ns, file_type, filename, last_modified))
+        for time_ns, key in deletions:
+            recorded = storage.get_json(bucket_name, key) or {}
+            for file_type, filenames in recorded.items():
+                changes.extend(
+                    (time_ns, file_type, filename, None) for filename in filenames
+                )
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f'Failed to list changes in folder "{folder}": {e}')
+        return str(e), False
+
+    last_changes = {}
+    for time_ns, file_type, filename, last_modified in sorted(
+        changes, key=lambda change: change[0]
+    ):
+        last_changes[(file_type, filename)] = last_modified
+    for (file_type, filename), last_modified in last_changes.items():
+        if file_type not in files_by_type:
+            continue
+        if last_modified is None:
+            deleted[file_type].append(filename)
+        else:
+            files_by_type[file_type].append(listing.FileEntry(filename, last_modified))
+    for files in files_by_type.values():
+        files.sort_by_modified()
+    for filenames in deleted.values():
+        filenames.sort()
+    return (files_by_type, deleted, SyncToken(watermark, seen)), True
+
+
+def record_change(folder_name, file_type, filename):
+    """
+    Records a new file in the change journal of the user's folder, which delta
+    listings read. A file missing from the journal is still returned by full
+    listings, so failing to record it does not fail the upload.
+    """
+    try:
+        storage.put_object(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            layout.sidecar_key(
+                folder_name, "changes", change_name(file_type, filename)
+            ),
+            b"",
+        )
+    except Exception as e:
+        logger.error(f"Failed to record {filename} in the change journal: {e}")
+    invalidation.get_invalidation_bus().publish(folder_name)
+
+
+def record_deletion(folder_name, deleted):
+    """
+    Records deleted files ({file type: [filenames]}) in the change journal of the
+    user's folder, so that delta listings report them. Without it, clients
+    syncing with delta listings keep listing the files until their next full
+    listing, so failing to record it does not fail the deletion.
+    """
+    try:
+        storage.put_json(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            layout.sidecar_key(folder_name, "changes", deletion_name()),
+            deleted,
+        )
+    except Exception as e:
+        logger.error(f"Failed to record deleted files in the change journal: {e}")
+    invalidation.get_invalidation_bus().publish(folder_name)
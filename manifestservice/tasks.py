@@ -0,0 +1,379 @@
+"""
+Background tasks: work derived from an upload (offset indexes, summaries...)
+that does not have to be done before the upload's response is sent.
+
+With "background_tasks" enabled, tasks are queued to a pool of worker threads
+in the same process; otherwise they run inline, as before. Failed tasks are
+retried with exponential backoff. When the queue is full, tasks run inline, so
+that a backlog slows uploads down instead of losing work.
+
+On shutdown, queued tasks are drained for up to "background_task_drain_timeout"
+seconds. With "background_task_queue_path", every queued task is also written
+to a local directory until it is done, and the tasks of a worker process that
+exited before finishing them are run by the next worker to start.
+
+Tasks are functions registered with @task, and their arguments must be
+JSON-serializable so that they can be written to the durable queue:
+
+    @tasks.task
+    def put_offset_index(folder_name, filename, index):
+        ...
+
+    tasks.run(sidecars.put_offset_index, folder_name, filename, index)
+"""
+
+import atexit
+import collections
+import heapq
+import json
+import os
+import threading
+import time
+
+import flask
+from cdislogging import get_logger
+
+from .config import get_config
+from .resilience import LatencyTracker
+from .storage import app_state
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+_TASKS = {}
+
+
+def task(fn):
+    """
+    Registers `fn` as a task that can be run with run().
+    """
+    _TASKS[_task_name(fn)] = fn
+    return fn
+
+
+def _task_name(fn):
+    return f"{fn.__module__}.{fn.__qualname__}"
+
+
+class _Task(object):
+    __slots__ = ("id", "name", "args", "submitted", "attempts")
+
+    def __init__(self, name, args, submitted=None, task_id=None):
+        self.submitted = submitted or time.time()
+        self.id = task_id or f"{time.time_ns():020d}-{os.urandom(4).hex()}"
+        self.name = name
+        self.args = list(args)
+        self.attempts = 0
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "args": self.args,
+            "submitted": self.submitted,
+        }
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value["name"], value["args"], value["submitted"], value["id"])
+
+
+class TaskExecutor(object):
+    """
+    A bounded queue of tasks run by a pool of worker threads, within the app
+    context of `app`.
+    """
+
+    def __init__(
+        self,
+        app,
+        workers=4,
+        max_queue=1000,
+        max_attempts=3,
+        retry_delay=1.0,
+        queue_path=None,
+    ):
+        self.app = app
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        # seconds from submission to completion
+        self.latency = LatencyTracker(window=1000, min_samples=1)
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        # retries waiting for their backoff: (due, task id, task)
+        self._delayed = []
+        self._running = 0
+        self._closed = False
+        self._durable_queue = DurableQueue(queue_path) if queue_path else None
+        if self._durable_queue:
+            recovered = self._durable_queue.recover()
+            if recovered:
+                logger.info(f"Recovered {len(recovered)} queued background tasks")
+            self._ready.extend(recovered)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"task-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        return len(self._ready) + len(self._delayed)
+
+    def submit(self, name, args):
+        """
+        Queues the task `name` and returns True, or returns False if the queue
+        is full or the executor is shut down; the caller then runs the task.
+        """
+        new_task = _Task(name, args)
+        with self._cond:
+            if self._closed or self.depth >= self.max_queue:
+                return False
+        if self._durable_queue:
+            try:
+                self._durable_queue.write(new_task)
+            except Exception as e:
+                logger.warning(f"Failed to write task {name} to the durable queue: {e}")
+        with self._cond:
+            self._ready.append(new_task)
+            self._cond.notify()
+        return True
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                # when shutting down, retries are not delayed
+                if self._delayed and (self._delayed[0][0] <= now or self._closed):
+                    return heapq.heappop(self._delayed)[2]
+                if self._ready:
+                    return self._ready.popleft()
+                if self._closed:
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _work(self):
+        while True:
+            next_task = self._next()
+            if next_task is None:
+                return
+            with self._cond:
+                self._running += 1
+            try:
+                self._run(next_task)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+
+    def _run(self, current):
+        current.attempts += 1
+        try:
+            with self.app.app_context():
+                _TASKS[current.name](*current.args)
+        except Exception as e:
+            if current.attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (current.attempts - 1)
+                logger.warning(
+                    f"Task {current.name} failed, retrying in {delay:.1f}s: {e}"
+                )
+                with self._cond:
+                    self.retried += 1
+                    heapq.heappush(
+                        self._delayed, (time.monotonic() + delay, current.id, current)
+                    )
+                    self._cond.notify()
+                return
+            logger.error(
+                f"Task {current.name} failed after {current.attempts} attempts: {e}"
+            )
+            with self._cond:
+                self.failed += 1
+        else:
+            with self._cond:
+                self.completed += 1
+        self.latency.record(time.time() - current.submitted)
+        if self._durable_queue:
+            self._durable_queue.remove(current)
+
+    def shutdown(self, timeout=30):
+        """
+        Stops accepting tasks and waits up to `timeout` seconds for the queued
+        tasks to be done. Returns the number of tasks left; they are run by the
+        next worker process if the durable queue is enabled.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        with self._cond:
+            left = self.depth + self._running
+        if left:
+            logger.warning(f"{left} background tasks were not done before shutdown")
+        return left
+
+    def stats(self):
+        with self._cond:
+            stats = {
+                "queued": self.depth,
+                "running": self._running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+            }
+        stats["latency_p50"] = self.latency.percentile(50)
+        stats["latency_p95"] = self.latency.percentile(95)
+        return stats
+
+
+class DurableQueue(object):
+    """
+    Local directory holding one JSON file per queued task, in a sub-directory
+    per worker process, until the task is done.
+    """
+
+    def __init__(self, path):
+        self.root = path
+        self.path = os.path.join(path, str(os.getpid()))
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, queued_task):
+        return os.path.join(self.path, queued_task.id + ".json")
+
+    def write(self, queued_task):
+        path = self._file(queued_task)
+        with open(path + ".tmp", "w") as f:
+            json.dump(queued_task.to_dict(), f)
+        os.replace(path + ".tmp", path)
+
+    def remove(self, queued_task):
+        try:
+            os.remove(self._file(queued_task))
+        except FileNotFoundError:
+            pass
+
+    def recover(self):
+        """
+        Moves the tasks left by worker processes that are no longer running to
+        this process's directory, and returns them with the tasks already in
+        it (left by a previous process with the same pid), oldest first.
+        """
+        recovered = []
+        for name in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, name)
+            if not name.isdigit() or not os.path.isdir(directory):
+                continue
+            if directory != self.path and _is_running(int(name)):
+                continue
+            for filename in os.listdir(directory):
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(self.path, filename)
+                if directory != self.path:
+                    try:
+                        os.rename(os.path.join(directory, filename), path)
+                    except FileNotFoundError:
+                        # recovered by another worker
+                        continue
+                try:
+                    with open(path) as f:
+                        recovered.append(_Task.from_dict(json.load(f)))
+                except Exception as e:
+                    logger.error(f"Dropping unreadable queued task {path}: {e}")
+                    os.remove(path)
+            if directory != self.path:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        return sorted(recovered, key=lambda recovered_task: recovered_task.id)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_executor():
+    return app_state("task_executor", _create_executor)
+
+
+def _create_executor():
+    executor = TaskExecutor(
+        flask.current_app._get_current_object(),
+        workers=get_config("background_task_workers"),
+        max_queue=get_config("background_task_queue_size"),
+        max_attempts=get_config("background_task_max_attempts"),
+        retry_delay=get_config("background_task_retry_delay"),
+        queue_path=get_config("background_task_queue_path"),
+    )
+    atexit.register(executor.shutdown, get_config("background_task_drain_timeout"))
+    return executor
+
+
+def run(fn, *args):
+    """
+    Runs the task `fn(*args)` in the background if "background_tasks" is
+    enabled, and inline otherwise. Failures are logged, never raised.
+    """
+    name = _task_name(fn)
+    if name not in _TASKS:
+        raise ValueError(f"{name} is not a registered task")
+    if get_config("background_tasks") and get_executor().submit(name, args):
+        return
+    try:
+        fn(*args)
+    except Exception as e:
+        logger.warning(f"Task {name} failed: {e}")
+
+
+def get_stats(app):
+    """
+    Returns the queue depth, task counts and latency of the background tasks of
+    `app`, or None if no task was queued yet.
+    """
+    executor = app.extensions.get("manifestservice", {}).get("task_executor")
+    return executor.stats() if executor else None
+
+
+def shutdown(app, timeout=None):
+    """
+    Drains the background tasks of `app`, e.g. from a gunicorn worker_exit hook.
+    """
+    executor = app.extensions.get("manifestservice", {}).get("task_executor")
+    if executor:
+        with app.app_context():
+            if timeout is None:
+                timeout = get_config("background_task_drain_timeout")
+        executor.shutdown(timeout)
+
+
+def _status():
+    """
+    Background task queue depth, task counts and latency (in seconds, from
+    submission to completion) of this worker
+    ---
+    tags:
+      - system
+    responses:
+        200:
+            description: Success
+    """
+    stats = get_stats(flask.current_app) or {"queued": 0, "running": 0}
+    return flask.jsonify(stats), 200
+
+
+def init_app(app):
+    app.add_url_rule("/_status/tasks", "task_status", _status, methods=["GET"])
@@ -0,0 +1,503 @@
+"""
+Request tracing: a span for each request, for each phase of the work done for it
+(authentication, listing, serialization, upload...) and for each s3 call, with
+attributes such as object counts, bytes and retries.
+
+Requests are traced with probability `tracing_sample_rate`, and the spans of
+sampled requests go to the configured exporter: the service log, a JSON lines
+file, or an OpenTelemetry collector (OTLP over HTTP). With `server_timing`,
+every request is traced and the time spent in each phase is returned in a
+Server-Timing header, which browser developer tools display.
+
+Spans are created with:
+
+    with tracing.span("serialize", records=len(manifest)) as span:
+        ...
+        span.set(bytes=len(body))
+
+When the request is not traced, span() returns a shared no-op span, so
+instrumented code costs a context variable lookup.
+
+Streamed response bodies are produced after the request handler has returned;
+stream() wraps them in a span, and the trace of a streamed response is exported
+once the response is closed. Those spans cannot be part of the Server-Timing
+header, which is sent before the body.
+
+The innermost open span, parent of new spans, is kept in a context variable
+rather than on the trace, so that threads working for a request (run with
+contextvars.copy_context().run) each nest their spans under the span that was
+open when they were started, without sharing state.
+"""
+
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+
+import flask
+from cdislogging import get_logger
+
+from .config import get_config
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+_current_trace = contextvars.ContextVar("manifestservice_trace", default=None)
+_current_span = contextvars.ContextVar("manifestservice_span", default=None)
+_exporter_lock = threading.Lock()
+
+
+class Span(object):
+    __slots__ = (
+        "trace",
+        "name",
+        "span_id",
+        "parent_id",
+        "start",
+        "end",
+        "attributes",
+        "_token",
+    )
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.time_ns()
+        return (end - self.start) / 1e6
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time_ns()
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        self.finish()
+        if self._token is not None and _current_span.get() is self:
+            _current_span.reset(self._token)
+            self._token = None
+        return False
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+        }
+
+
+class _NullSpan(object):
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace(object):
+    """
+    The spans of one request. `sampled` traces are exported; the others are
+    only used for the Server-Timing header.
+    """
+
+    def __init__(self, name, sampled=True, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.root = Span(self, name, None, attributes)
+        self.spans = [self.root]
+        self._lock = threading.Lock()
+
+    def current_span(self):
+        """
+        Returns the innermost span of this trace open in the current context.
+        """
+        span = _current_span.get()
+        return span if span is not None and span.trace is self else self.root
+
+    def span(self, name, **attributes):
+        span = Span(self, name, self.current_span().span_id, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def server_timing(self):
+        """
+        Returns the value of a Server-Timing header with the total time spent in
+        each kind of span, and the duration of the request so far.
+        """
+        durations = {}
+        for span in self.spans[1:]:
+            durations[span.name] = durations.get(span.name, 0) + span.duration_ms
+        durations["total"] = self.root.duration_ms
+        return ", ".join(
+            f"{name};dur={duration:.1f}" for name, duration in durations.items()
+        )
+
+
+def span(name, **attributes):
+    """
+    Returns a new span, child of the innermost open span of the current trace,
+    to use as a context manager. Returns a no-op span if there is no trace.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return trace.span(name, **attributes)
+
+
+def current_span():
+    """
+    Returns the innermost open span of the current trace, to add attributes to.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return trace.current_span()
+
+
+def stream(name, chunks, **attributes):
+    """
+    Returns `chunks`, the body of a streamed response, wrapped in a span child
+    of the innermost open span, which starts when the first chunk is requested
+    and ends when the response is closed. Returns `chunks` if there is no trace.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return chunks
+    return _traced_chunks(trace, trace.current_span().span_id, name, chunks, attributes)
+
+
+def _traced_chunks(trace, parent_id, name, chunks, attributes):
+    # the body is consumed outside of the request context: the span is added to
+    # the trace directly
+    span = Span(trace, name, parent_id, attributes)
+    with trace._lock:
+        trace.spans.append(span)
+    try:
+        yield from chunks
+    except Exception as e:
+        span.set(error=repr(e))
+        raise
+    finally:
+        span.finish()
+
+
+def start_trace(name, sampled=True, **attributes):
+    """
+    Starts tracing the current context and returns the new Trace.
+    """
+    trace = Trace(name, sampled, **attributes)
+    trace.token = _current_trace.set(trace)
+    return trace
+
+
+def end_trace(trace):
+    trace.root.finish()
+    _current_trace.reset(trace.token)
+
+
+# s3 calls are traced with botocore event hooks; see instrument_s3_client()
+
+
+def _before_s3_call(params, model, context, **kwargs):
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    attributes = {"operation": model.name, "bucket": params.get("Bucket")}
+    if "Key" in params:
+        attributes["key"] = params["Key"]
+    if params.get("Body") is not None:
+        attributes["bytes_sent"] = _body_size(params["Body"])
+    s3_span = trace.span("s3." + model.name, **attributes)
+    context["manifestservice_span"] = s3_span
+
+
+def _body_size(body):
+    # botocore turns bytes bodies into file objects before the call
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    try:
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    except Exception:
+        return None
+
+
+def _after_s3_call(http_response, parsed, context, **kwargs):
+    s3_span = context.pop("manifestservice_span", None)
+    if s3_span is None:
+        return
+    metadata = parsed.get("ResponseMetadata", {})
+    s3_span.set(
+        status=metadata.get("HTTPStatusCode"),
+        retries=metadata.get("RetryAttempts", 0),
+    )
+    if "KeyCount" in parsed:
+        s3_span.set(object_count=parsed["KeyCount"])
+    if "ContentLength" in parsed:
+        s3_span.set(bytes_received=parsed["ContentLength"])
+    s3_span.finish()
+
+
+def _after_s3_call_error(exception, context, **kwargs):
+    s3_span = context.pop("manifestservice_span", None)
+    if s3_span is None:
+        return
+    s3_span.set(error=repr(exception))
+    s3_span.finish()
+
+
+def instrument_s3_client(client):
+    """
+    Adds a span for each call made by a boto3 s3 client (or resource, through
+    `resource.meta.client`) in a traced request.
+    """
+    events = client.meta.events
+    # "before-parameter-build" has the parameters of the call, "before-call" only
+    # has the serialized request
+    events.register("before-parameter-build.s3", _before_s3_call)
+    events.register("after-call.s3", _after_s3_call)
+    events.register("after-call-error.s3", _after_s3_call_error)
+    return client
+
+
+class LogExporter(object):
+    """
+    Writes each trace to the service log, as one JSON line.
+    """
+
+    def export(self, trace):
+        logger.info(
+            "trace " + json.dumps([s.to_dict() for s in trace.spans], default=str)
+        )
+
+
+class FileExporter(object):
+    """
+    Appends the spans of each trace to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        lines = "".join(
+            json.dumps(s.to_dict(), default=str) + "\n" for s in trace.spans
+        )
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+
+class OTLPExporter(object):
+    """
+    Sends spans to an OpenTelemetry collector with OTLP/HTTP JSON, in batches,
+    from a background thread. Traces are dropped rather than slowing requests
+    down when the collector cannot keep up.
+    """
+
+    def __init__(self, endpoint, max_queue=1000, batch_size=100, timeout=5):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(
+            target=self._run, name="otlp-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception as e:
+                logger.warning(f"Failed to export {len(batch)} traces: {e}")
+
+    def _send(self, traces):
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            _otlp_attribute("service.name", "manifestservice")
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "manifestservice"},
+                            "spans": [
+                                _otlp_span(s) for trace in traces for s in trace.spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def _otlp_span(span):
+    otlp_span = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SERVER for the request, INTERNAL for its phases
+        "kind": 2 if span.parent_id is None else 1,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end or span.start),
+        "attributes": [
+            _otlp_attribute(key, value)
+            for key, value in span.attributes.items()
+            if value is not None
+        ],
+    }
+    if span.parent_id:
+        otlp_span["parentSpanId"] = span.parent_id
+    if "error" in span.attributes:
+        otlp_span["status"] = {"code": 2, "message": span.attributes["error"]}
+    return otlp_span
+
+
+def create_exporter():
+    exporter = get_config("tracing_exporter")
+    if exporter == "log":
+        return LogExporter()
+    if exporter == "file":
+        return FileExporter(get_config("tracing_file_path"))
+    if exporter == "otlp":
+        return OTLPExporter(get_config("tracing_otlp_endpoint"))
+    raise ValueError(f"Unknown tracing exporter: {exporter}")
+
+
+def get_exporter():
+    extensions = flask.current_app.extensions.setdefault("manifestservice", {})
+    if "tracing_exporter" not in extensions:
+        with _exporter_lock:
+            if "tracing_exporter" not in extensions:
+                extensions["tracing_exporter"] = create_exporter()
+    return extensions["tracing_exporter"]
+
+
+def _before_request():
+    sampled = random.random() < get_config("tracing_sample_rate")
+    if sampled or get_config("server_timing"):
+        flask.g.manifestservice_trace = start_trace(
+            "request",
+            sampled,
+            method=flask.request.method,
+            route=flask.request.url_rule.rule if flask.request.url_rule else None,
+        )
+
+
+def _after_request(response):
+    trace = flask.g.get("manifestservice_trace")
+    if trace is not None:
+        trace.root.set(status=response.status_code)
+        if get_config("server_timing"):
+            response.headers["Server-Timing"] = trace.server_timing()
+        if response.is_streamed:
+            # the body, and its spans, are produced once the request has returned
+            exporter = _get_trace_exporter(trace)
+            response.call_on_close(lambda: _export(trace, exporter))
+            flask.g.manifestservice_trace_streamed = True
+    return response
+
+
+def _teardown_request(exc):
+    trace = flask.g.pop("manifestservice_trace", None)
+    if trace is None:
+        return
+    if flask.g.pop("manifestservice_trace_streamed", False):
+        _current_trace.reset(trace.token)
+        return
+    end_trace(trace)
+    _export(trace, _get_trace_exporter(trace))
+
+
+def _get_trace_exporter(trace):
+    if not trace.sampled:
+        return None
+    try:
+        return get_exporter()
+    except Exception as e:
+        logger.warning(f"Failed to export trace: {e}")
+        return None
+
+
+def _export(trace, exporter):
+    trace.root.finish()
+    if exporter is None:
+        return
+    try:
+        exporter.export(trace)
+    except Exception as e:
+        logger.warning(f"Failed to export trace: {e}")
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,460 @@
+"""
+Uploads of manifests, cohorts and metadata files to user folders, and upload
+sessions for metadata exports too large for a single request.
+
+Every upload lists the user's folder first, to check its quota and to reuse the
+file of an identical earlier upload (see sidecars.py), and records the new file
+in the folder's change journal (see sync.py).
+
+A session is an s3 multipart upload of the metadata file. The client appends
+NDJSON chunks (one JSON record per line) as numbered parts, in any number of
+requests, and commits the session; the file is then a JSON array of the records,
+in part order. A failed chunk is retried on its own by sending the same part
+number again, which replaces the part.
+
+Parts are written so that their concatenation is a JSON array: the first part
+starts with "[", the others with ",", and the commit adds a last part with the
+remaining records and the closing "]". Since every part but the last must be at
+least 5 MiB (an s3 limit), so must every chunk; small exports send everything
+with the commit.
+
+Session ids are opaque to clients and encode the filename and the s3 upload id;
+the upload is always looked up in the folder of the user making the request.
+"""
+
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+import flask
+from cdislogging import get_logger
+
+from . import listing, object_index, sidecars, storage, streaming, sync, tasks, tracing
+from .config import get_config
+from .resilience import CircuitOpenError
+
+logger = get_logger("manifestservice_logger", log_level="info")
+
+# s3 limits on multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+class InvalidUploadSession(ValueError):
+    pass
+
+
+class InvalidChunk(ValueError):
+    pass
+
+
+class IncompleteUpload(ValueError):
+    """
+    Raised when an upload session cannot be committed: parts are missing, or
+    it has no records.
+    """
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class UploadSession(object):
+    VERSION = 1
+
+    def __init__(self, filename, upload_id):
+        self.filename = filename
+        self.upload_id = upload_id
+
+    def encode(self):
+        value = {"v": self.VERSION, "f": self.filename, "u": self.upload_id}
+        encoded = base64.urlsafe_b64encode(json.dumps(value).encode("utf-8"))
+        return encoded.decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, session_id):
+        try:
+            padded = session_id + "=" * (-len(session_id) % 4)
+            value = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+            if value["v"] != cls.VERSION:
+                raise ValueError(f"unsupported version {value['v']}")
+            filename, upload_id = value["f"], value["u"]
+        except Exception as e:
+            raise InvalidUploadSession(f"Invalid upload session: {e}")
+        if not isinstance(filename, str) or "/" in filename:
+            raise InvalidUploadSession("Invalid upload session: bad filename")
+        return cls(filename, upload_id)
+
+
+def encode_chunk(chunk, first):
+    """
+    Returns the part body for an NDJSON chunk (bytes) and its number of records.
+    Each line is validated as JSON but written as sent. Raises InvalidChunk.
+    """
+    records = []
+    for line_number, line in enumerate(chunk.split(b"\n"), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            json.loads(line)
+        except ValueError as e:
+            raise InvalidChunk(f"Line {line_number} is not valid JSON: {e}")
+        records.append(line)
+    if not records:
+        return b"", 0
+    return (b"[" if first else b",") + b",".join(records), len(records)
+
+
+def last_part(chunk, first):
+    """
+    Returns the body of the part closing the array, with the records of the
+    NDJSON chunk sent with the commit, and its number of records.
+    """
+    body, count = encode_chunk(chunk, first)
+    if not body and first:
+        body = b"["
+    return body + b"]", count
+
+
+def check_quota(files_by_type, new_bytes):
+    """
+    Raises QuotaExceeded if adding a file of `new_bytes` bytes to a user folder
+    holding `files_by_type` (as returned by listing.list_files) would go over
+    the quota_max_files or quota_max_bytes limits. The listing is already made
+    by every upload, so checking costs no s3 call.
+    """
+    max_files = get_config("quota_max_files")
+    max_bytes = get_config("quota_max_bytes")
+    if not max_files and not max_bytes:
+        return
+    files = [f for files in files_by_type.values() for f in files]
+    if max_files and len(files) + 1 > max_files:
+        raise QuotaExceeded(
+            f"You have reached the maximum number of files ({max_files}). "
+            "Please delete some files before uploading more."
+        )
+    if max_bytes and sum(f.size for f in files) + new_bytes > max_bytes:
+        raise QuotaExceeded(
+            f"This upload would exceed your storage quota ({max_bytes} bytes). "
+            "Please delete some files before uploading more."
+        )
+
+
+def add_manifest(
+    folder_name, body, summary, offsets, idempotency_key=None, index_ids=None
+):
+    """
+    Uploads `body`, the JSON bytes of a manifest validated with
+    streaming.scan_json_array() or a binary file holding them, to the user's
+    folder with its ManifestSummary (which gives its size and hash), and stores
+    its offset index built from `offsets`, and its `index_ids` (see
+    object_index.IdCollector) in the user's object index if provided.
+    Generates and returns the name of the new file.
+    If the same upload was already stored (see sidecars.find_previous_upload),
+    returns the existing filename instead.
+    Raises QuotaExceeded if the user's folder is full.
+    """
+    s3 = storage.get_s3_resource()
+
+    result, ok = listing.list_files(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
+    )
+    if not ok:
+        return result, False
+
+    stride = get_config("manifest_index_stride")
+    digest = summary.sha256
+    previous = sidecars.find_previous_upload(
+        folder_name, "manifest", digest, idempotency_key, result["manifests"]
+    )
+    if previous is not None:
+        return previous, True
+    check_quota(result, summary.size)
+
+    with tracing.span("generate_filename"):
+        filename = _generate_unique_filename(
+            result["manifests"],
+        )
+    filepath_in_bucket = folder_name + "/" + filename
+
+    try:
+        obj = s3.Object(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
+        )
+        with storage.guarded(), tracing.span("upload", bytes=summary.size):
+            obj.put(
+                Body=body,
+                Metadata={
+                    key.replace("_", "-"): str(value)
+                    for key, value in summary.to_dict().items()
+                },
+            )
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to add manifest to bucket: {e}")
+        return str(e), False
+
+    if stride:
+        tasks.run(
+            sidecars.put_offset_index,
+            folder_name,
+            filename,
+            streaming.build_offset_index(
+                offsets, stride, summary.records, summary.size
+            ),
+        )
+    sidecars.record_upload(folder_name, "manifest", digest, idempotency_key, filename)
+    tasks.run(sidecars.add_manifest_summary, folder_name, filename, summary.to_dict())
+    if index_ids is not None:
+        tasks.run(object_index.add_to_index, folder_name, filename, index_ids)
+    sync.record_change(folder_name, "manifests", filename)
+
+    return filename, True
+
+
+def add_metadata(folder_name, body, idempotency_key=None):
+    """
+    Creates a new metadata file in the user's folder at
+    user-<id>/exported-metadata/, holding `body`, the JSON bytes of the request.
+    If the same upload was already stored (see sidecars.find_previous_upload),
+    returns the existing filename instead.
+    Raises QuotaExceeded if the user's folder is full.
+    """
+    s3 = storage.get_s3_resource()
+
+    result, ok = listing.list_files(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
+    )
+
+    if not ok:
+        return None, False
+
+    digest = hashlib.sha256(body).hexdigest()
+    previous = sidecars.find_previous_upload(
+        folder_name, "metadata", digest, idempotency_key, result["metadata"]
+    )
+    if previous is not None:
+        return previous, True
+    check_quota(result, len(body))
+
+    with tracing.span("generate_filename"):
+        filename = _generate_unique_filename(result["metadata"], file_type="metadata")
+
+    filepath_in_bucket = folder_name + "/exported-metadata/" + filename
+    try:
+        obj = s3.Object(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
+        )
+        with storage.guarded(), tracing.span("upload", bytes=len(body)):
+            obj.put(Body=body)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return str(e), False
+
+    sidecars.record_upload(folder_name, "metadata", digest, idempotency_key, filename)
+    sync.record_change(folder_name, "metadata", filename)
+    return filename, True
+
+
+def add_guid(folder_name, GUID):
+    """
+    Creates a new file in the user's folder at user-<id>/cohorts/
+    with a filename corresponding to the GUID provided by the user.
+    Raises QuotaExceeded if the user's folder is full.
+    """
+    s3 = storage.get_s3_resource()
+
+    existing_files, ok = listing.list_files(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"), folder_name
+    )
+
+    if not ok:
+        return None, False
+    if any(cohort["filename"] == GUID for cohort in existing_files["cohorts"]):
+        return GUID, True
+    check_quota(existing_files, 0)
+
+    filepath_in_bucket = folder_name + "/cohorts/" + GUID
+    try:
+        obj = s3.Object(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"), filepath_in_bucket
+        )
+        with storage.guarded(), tracing.span("upload", bytes=0):
+            obj.put(Body=str.encode(""))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return str(e), False
+
+    sync.record_change(folder_name, "cohorts", GUID)
+    return GUID, True
+
+
+def create_session(folder_name):
+    """
+    Picks the filename of a new metadata file and starts the multipart upload
+    of an upload session. Returns (UploadSession, True).
+    Raises QuotaExceeded if the user's folder is full.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+
+    result, ok = listing.list_files(bucket_name, folder_name)
+    if not ok:
+        return None, False
+    check_quota(result, 0)
+
+    filename = _generate_unique_filename(result["metadata"], file_type="metadata")
+    session = UploadSession(filename, None)
+    try:
+        session.upload_id = storage.create_multipart_upload(
+            bucket_name,
+            _session_key(folder_name, session),
+            ContentType="application/json",
+        )
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to start the upload of {filename}: {e}")
+        return None, False
+    return session, True
+
+
+def upload_session_part(folder_name, session, part_number, body):
+    """
+    Uploads `body`, as returned by encode_chunk(), as part `part_number` of an
+    upload session. Raises if the part cannot be uploaded.
+    """
+    with tracing.span("upload", bytes=len(body)):
+        storage.upload_part(
+            flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+            _session_key(folder_name, session),
+            session.upload_id,
+            part_number,
+            body,
+        )
+
+
+def commit_session(folder_name, session, chunk):
+    """
+    Uploads the last part of an upload session, with `chunk` (the last records)
+    and the end of the JSON array, and completes the multipart upload. The last
+    part always has the highest part number, so that a commit can be retried.
+    Raises InvalidChunk or IncompleteUpload if the session cannot be committed,
+    and QuotaExceeded if the user's folder is full; the upload is then aborted,
+    except for missing parts, which can still be sent. Raises if s3 fails.
+    """
+    bucket_name = flask.current_app.config.get("MANIFEST_BUCKET_NAME")
+    key = _session_key(folder_name, session)
+    parts = [
+        part
+        for part in storage.list_parts(bucket_name, key, session.upload_id)
+        if part["PartNumber"] != MAX_PARTS
+    ]
+    if [part["PartNumber"] for part in parts] != list(range(1, len(parts) + 1)):
+        missing = sorted(
+            set(range(1, parts[-1]["PartNumber"]))
+            - set(part["PartNumber"] for part in parts)
+        )
+        raise IncompleteUpload(f"Missing parts: {', '.join(str(n) for n in missing)}.")
+
+    body, count = last_part(chunk, first=not parts)
+    if not parts and not count:
+        # an empty array, which POST /metadata does not accept either
+        _abort_quietly(bucket_name, key, session)
+        raise IncompleteUpload("The upload has no records.")
+
+    existing_files, ok = listing.list_files(bucket_name, folder_name)
+    if not ok:
+        raise Exception(f"Unable to list the files of {folder_name}: {existing_files}")
+    try:
+        check_quota(existing_files, sum(part["Size"] for part in parts) + len(body))
+    except QuotaExceeded:
+        _abort_quietly(bucket_name, key, session)
+        raise
+
+    with tracing.span("upload", bytes=len(body)):
+        etag = storage.upload_part(bucket_name, key, session.upload_id, MAX_PARTS, body)
+        storage.complete_multipart_upload(
+            bucket_name,
+            key,
+            session.upload_id,
+            [(part["PartNumber"], part["ETag"]) for part in parts]
+            + [(MAX_PARTS, etag)],
+        )
+
+    sync.record_change(folder_name, "metadata", session.filename)
+    return session.filename
+
+
+def abort_session(folder_name, session):
+    """
+    Abandons an upload session and deletes the parts uploaded so far. Raises if
+    the upload cannot be aborted.
+    """
+    storage.abort_multipart_upload(
+        flask.current_app.config.get("MANIFEST_BUCKET_NAME"),
+        _session_key(folder_name, session),
+        session.upload_id,
+    )
+
+
+def _abort_quietly(bucket_name, key, session):
+    """
+    Aborts the multipart upload of an upload session that cannot be committed.
+    Failures are only logged: the parts are left to the lifecycle rule aborting
+    incomplete multipart uploads recommended in the README.
+    """
+    try:
+        storage.abort_multipart_upload(bucket_name, key, session.upload_id)
+    except Exception as e:
+        logger.warning(f"Failed to abort the upload of {key}: {e}")
+
+
+def _session_key(folder_name, session):
+    return f"{folder_name}/exported-metadata/{session.filename}"
+
+
+def _generate_unique_filename(
+    users_existing_manifest_or_metadata_files, file_type="manifest"
+):
+    """
+    Returns a filename of the form manifest-<timestamp>-<optional-increment>.json that is
+    unique among the files in the user's manifest folder.
+    """
+    timestamp = datetime.now().isoformat()
+    existing_filenames = map(
+        lambda x: x["filename"], users_existing_manifest_or_metadata_files
+    )
+    filename = _generate_unique_filename_with_timestamp_and_increment(
+        timestamp, existing_filenames, file_type
+    )
+    return filename
+
+
+def _generate_unique_filename_with_timestamp_and_increment(
+    timestamp, users_existing_manifest_files, file_type="manifest"
+):
+    """
+    A helper function for _generate_unique_manifest_filename(), which facilitates unit testing.
+    Adds an increment to the filename if there happens to be another timestamped file with the same name
+    (unlikely, but good to check).
+    """
+    filename_prefix = "manifest-"
+    if file_type == "metadata":
+        filename_prefix = "metadata-"
+    filename_without_extension = filename_prefix + timestamp.replace(":", "-")
+    extension = ".json"
+
+    filename = filename_without_extension + extension
+    i = 1
+    while filename in users_existing_manifest_files:
+        filename = filename_without_extension + extension
+        if filename in users_existing_manifest_files:
+            filename = filename_without_extension + "-" + str(i) + extension
+        i += 1
+
+    return filename
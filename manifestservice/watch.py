@@ -0,0 +1,103 @@
+"""
+In-process notifications of new files, for the long-poll watch endpoint.
+
+A request watching a user folder blocks on a condition variable until an upload
+to that folder completes in the same worker, instead of listing s3 in a loop.
+Uploads handled by other workers or pods are not notified here; watchers also
+re-read the folder's change journal every few seconds to pick them up.
+"""
+
+import threading
+
+from . import storage
+from .config import get_config
+
+
+class ChangeNotifier(object):
+    """
+    Wakes up the requests watching a folder when a file is added to it. Only
+    folders with active watchers are tracked, and at most `max_waiters` requests
+    can wait at once so that watchers cannot take every thread of the worker.
+    """
+
+    def __init__(self, max_waiters=8):
+        self.max_waiters = max_waiters
+        self._cond = threading.Condition()
+        # {folder: [version, number of watchers]}
+        self._folders = {}
+        self._waiters = 0
+
+    def notify(self, folder):
+        with self._cond:
+            state = self._folders.get(folder)
+            if state is None:
+                return
+            state[0] += 1
+            self._cond.notify_all()
+
+    def watch(self, folder):
+        """
+        Returns a context manager watching `folder`, which is entered as None if
+        too many requests are already waiting:
+
+            with notifier.watch(folder) as watch:
+                # check for changes, then
+                if watch is not None:
+                    watch.wait(timeout)
+        """
+        return _Watch(self, folder)
+
+    @property
+    def waiters(self):
+        return self._waiters
+
+
+class _Watch(object):
+    def __init__(self, notifier, folder):
+        self.notifier = notifier
+        self.folder = folder
+        self.version = None
+
+    def __enter__(self):
+        notifier = self.notifier
+        with notifier._cond:
+            if notifier._waiters >= notifier.max_waiters:
+                return None
+            notifier._waiters += 1
+            state = notifier._folders.setdefault(self.folder, [0, 0])
+            state[1] += 1
+            self.version = state[0]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.version is None:
+            return False
+        notifier = self.notifier
+        with notifier._cond:
+            notifier._waiters -= 1
+            state = notifier._folders[self.folder]
+            state[1] -= 1
+            if state[1] == 0:
+                del notifier._folders[self.folder]
+        return False
+
+    def wait(self, timeout):
+        """
+        Waits up to `timeout` seconds for a file to be added to the folder since
+        the watch started or since the last wait() that returned True.
+        Returns True if one was.
+        """
+        notifier = self.notifier
+        with notifier._cond:
+            changed = notifier._cond.wait_for(
+                lambda: notifier._folders[self.folder][0] != self.version, timeout
+            )
+            self.version = notifier._folders[self.folder][0]
+        return changed
+
+
+def get_change_notifier():
+    return storage.app_state(
+        "change_notifier",
+        lambda: ChangeNotifier(max_waiters=get_config("watch_max_waiters")),
+    )
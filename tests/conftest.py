@@ -1,7 +1,13 @@
 import boto3
+import botocore.handlers
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import EndpointConnectionError
 from datetime import datetime
+from moto import mock_aws
 import pytest
-from unittest.mock import MagicMock, patch
+import threading
+import time
+from unittest.mock import MagicMock
 
 from manifestservice.api import create_app
 
@@ -129,31 +135,103 @@ def broken_s3_mocks(mocker):
     broken_s3_connection = boto3.Session("a", "b", "c")
 
     all_mocks["boto3"] = mocker.patch(
-        "manifestservice.manifests.boto3.Session", return_value=broken_s3_connection
+        "manifestservice.storage.boto3.Session", return_value=broken_s3_connection
     )
 
     return all_mocks
 
 
 @pytest.fixture
-def mocked_bucket():
-    class MockedS3Object:
-        def __init__(self, key):
-            self.key = key
-            self.last_modified = datetime.now()
+def mocked_bucket(mocker):
+    now = datetime.now()
+    page = {
+        "Contents": [
+            {"Key": "username/my-manifest.json", "LastModified": now, "Size": 0},
+            {
+                "Key": "username/cohorts/guid-without-prefix",
+                "LastModified": now,
+                "Size": 0,
+            },
+            {
+                "Key": "username/cohorts/dg.mytest/guid-with-prefix",
+                "LastModified": now,
+                "Size": 0,
+            },
+        ]
+    }
 
     mock = MagicMock()
-    mock.return_value = iter(
-        [
-            MockedS3Object(key="username/my-manifest.json"),
-            MockedS3Object(key="username/cohorts/guid-without-prefix"),
-            MockedS3Object(key="username/cohorts/dg.mytest/guid-with-prefix"),
+    mock.get_paginator.return_value.paginate.return_value = iter([page])
+    mocker.patch("manifestservice.storage.get_s3_client", return_value=mock)
+
+    yield mock
+
+
+class S3FaultInjector(object):
+    """
+    Sits in front of the local s3 stand-in and injects faults into the next
+    requests: `failures` requests fail with `error` ("connection" or an HTTP status
+    code), and each entry of `latencies` delays one request by that many seconds.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.error = "connection"
+        self.latencies = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, request, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.requests.append(request)
+            latency = self.latencies.pop(0) if self.latencies else 0
+            fail = self.failures > 0
+            if fail:
+                self.failures -= 1
+        if latency:
+            time.sleep(latency)
+        if not fail:
+            return None
+        if self.error == "connection":
+            raise EndpointConnectionError(endpoint_url=request.url)
+        raw = MagicMock()
+        raw.stream.return_value = [
+            b"<Error><Code>ServiceUnavailable</Code><Message>injected</Message></Error>"
         ]
-    )
+        return AWSResponse(request.url, int(self.error), {}, raw)
 
-    patcher = patch("boto3.resources.collection.ResourceCollection.__iter__", mock)
-    patcher.start()
 
-    yield mock
+@pytest.fixture
+def s3(app, mocker, monkeypatch):
+    """
+    Runs the test against a local in-memory s3 stand-in (moto) with an empty
+    manifest bucket, and a fault injector in front of it. Only authentication is
+    mocked; the storage functions run for real.
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    injector = S3FaultInjector()
+    monkeypatch.setattr(
+        botocore.handlers,
+        "BUILTIN_HANDLERS",
+        [("before-send", injector)] + botocore.handlers.BUILTIN_HANDLERS,
+    )
+
+    mocker.patch(
+        "manifestservice.manifests.current_token", new={"sub": "18", "aud": ["user"]}
+    )
+    mocker.patch(
+        "manifestservice.manifests._authenticate_user", return_value=(None, 200)
+    )
 
-    patcher.stop()
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-manifest-bucket")
+        app.config["MANIFEST_BUCKET_NAME"] = "test-manifest-bucket"
+        app.config["s3_retry_mode"] = "standard"
+        injector.client = client
+        injector.bucket = "test-manifest-bucket"
+        yield injector
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from manifestservice import invalidation
+from manifestservice.api import create_app
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_redis_bus():
+    """
+    Test that events reach the subscribers of every bus once, and that the bus
+    is only healthy while heartbeats come back.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    buses = [
+        invalidation.InvalidationBus(
+            invalidation.RedisTransport(
+                fakeredis.FakeRedis(server=server), heartbeat=0.1
+            )
+        )
+        for _ in range(2)
+    ]
+    received = [[], []]
+    for bus, events in zip(buses, received):
+        bus.subscribe(events.append)
+    _wait_for(lambda: all(bus.healthy for bus in buses))
+
+    buses[0].publish("user-18")
+    _wait_for(lambda: received[1] == ["user-18"])
+    time.sleep(0.2)
+    assert received[0] == ["user-18"]
+
+    server.connected = False
+    _wait_for(lambda: not buses[1].healthy)
+    buses[1].publish("user-19")
+    server.connected = True
+    _wait_for(lambda: buses[1].healthy)
+    for bus in buses:
+        bus.close()
+
+
+def test_listing_cache_invalidated_across_pods(client, s3):
+    """
+    Test that a listing cached by one pod is dropped when another pod writes to
+    the folder, and is not used while the bus is down.
+    """
+    hub = []
+    other = create_app()
+    for app in [client.application, other]:
+        app.config["MANIFEST_BUCKET_NAME"] = s3.bucket
+        app.config["listing_cache_ttl"] = 60
+        app.extensions.setdefault("manifestservice", {})["invalidation_transport"] = (
+            invalidation.LocalTransport(hub)
+        )
+    other_client = other.test_client()
+
+    first = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    assert [m["filename"] for m in other_client.get("/").json["manifests"]] == [first]
+
+    # changes made outside of the service are not seen until the cache expires
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-x.json", Body=b"[]")
+    assert len(other_client.get("/").json["manifests"]) == 1
+
+    second = client.post("/", json=[{"object_id": "b"}]).json["filename"]
+    filenames = [m["filename"] for m in other_client.get("/").json["manifests"]]
+    assert sorted(filenames) == sorted([first, second, "manifest-x.json"])
+
+    s3.client.delete_object(Bucket=s3.bucket, Key="user-18/manifest-x.json")
+    other.extensions["manifestservice"]["invalidation_transport"].healthy = False
+    assert len(other_client.get("/").json["manifests"]) == 2
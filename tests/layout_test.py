@@ -0,0 +1,122 @@
+import json
+import time
+
+from manifestservice import layout, migrate_layout, scan
+
+SHARD = layout.shard("18", 2)
+
+
+def _keys(s3, prefix):
+    response = s3.client.list_objects_v2(Bucket=s3.bucket, Prefix=prefix)
+    return sorted(obj["Key"] for obj in response.get("Contents", []))
+
+
+def test_layout_folders():
+    assert layout.shard("18", 2) == layout.shard(18, 2)
+    assert len(layout.shard("18", 3)) == 3
+    assert layout.user_folder("", "18") == "user-18"
+    assert layout.user_folder("p/", "18", sharded=True) == f"p/{SHARD}/user-18"
+    assert layout.legacy_folder(f"{SHARD}/user-18", 2) == "user-18"
+    assert (
+        layout.legacy_folder(f"ab/{SHARD}/user-18/exported-metadata", 2)
+        == "ab/user-18/exported-metadata"
+    )
+    assert layout.legacy_folder("ab/user-18", 3) is None
+    assert layout.legacy_folder("user-18", 2) is None
+    assert layout.sharded_folder("p/user-18", 2) == f"p/{SHARD}/user-18"
+    assert layout.sidecar_folder("user-18") == ".sidecars/user-18"
+    assert layout.sidecar_folder(f"p/{SHARD}/user-18") == f"p/{SHARD}/.sidecars/user-18"
+
+
+def test_sharded_layout_reads_legacy_folder(client, s3):
+    """
+    Test that with the sharded layout, new files go to the sharded folder while
+    the files of the legacy folder are still listed, read and deleted.
+    """
+    client.application.config["key_layout"] = "sharded"
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-old.json", Body=b'[{"object_id": "a"}]'
+    )
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key="user-18/exported-metadata/metadata-old.json",
+        Body=b'{"a": "b"}',
+    )
+    new = client.post("/", json=[{"object_id": "b"}]).json["filename"]
+    assert _keys(s3, f"{SHARD}/user-18/{new}") == [f"{SHARD}/user-18/{new}"]
+
+    r = client.get("/")
+    assert sorted(m["filename"] for m in r.json["manifests"]) == sorted(
+        ["manifest-old.json", new]
+    )
+    r = client.get("/file/manifest-old.json")
+    assert json.loads(r.data) == [{"object_id": "a"}]
+    r = client.get("/file/manifest-old.json?fields=object_id&format=ndjson")
+    assert r.data == b'{"object_id": "a"}\n'
+    r = client.get("/metadata/metadata-old.json")
+    assert json.loads(r.data) == {"a": "b"}
+    assert client.get("/file/manifest-missing.json").status_code == 404
+
+    assert client.delete("/file/manifest-old.json").status_code == 200
+    assert _keys(s3, "user-18/") == ["user-18/exported-metadata/metadata-old.json"]
+
+    client.application.config["key_layout_fallback"] = False
+    assert client.get("/metadata").json["external_file_metadata"] == []
+
+
+def test_migrate_layout(client, s3):
+    """
+    Test that the migration moves every object of the legacy user folders to
+    the sharded folders, merging the manifest summaries.
+    """
+    first = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    client.application.config["key_layout"] = "sharded"
+    second = client.post("/", json=[{"object_id": "b"}, {"object_id": "c"}]).json[
+        "filename"
+    ]
+    s3.client.put_object(Bucket=s3.bucket, Key="user-19/manifest-a.json", Body=b"[]")
+    legacy_keys = _keys(s3, "user-18/")
+    listed = client.get("/").json["manifests"]
+    # s3 times are to the second
+    time.sleep(1.1)
+
+    migrate_layout.main(["--bucket", s3.bucket, "--dry-run"])
+    assert _keys(s3, "user-18/") == legacy_keys
+
+    migrate_layout.main(["--bucket", s3.bucket, "--workers", "2"])
+    assert _keys(s3, "user-") == []
+    assert _keys(s3, ".sidecars/") == []
+    keys = _keys(s3, f"{SHARD}/user-18/")
+    for key in legacy_keys:
+        assert f"{SHARD}/{key}" in keys
+    assert _keys(s3, layout.user_folder("", "19", sharded=True) + "/") == [
+        layout.user_folder("", "19", sharded=True) + "/manifest-a.json"
+    ]
+    summaries = json.loads(
+        s3.client.get_object(
+            Bucket=s3.bucket,
+            Key=f"{SHARD}/.sidecars/user-18/summaries/manifests.json",
+        )["Body"].read()
+    )
+    assert set(summaries["files"]) == {first, second}
+
+    client.application.config["key_layout_fallback"] = False
+    r = client.get("/?include=summary")
+    assert sorted(m["filename"] for m in r.json["manifests"]) == sorted([first, second])
+    assert all(m["summary"] for m in r.json["manifests"])
+    # the moved files keep their last modification time
+    fields = ("filename", "last_modified", "last_modified_timestamp")
+    assert sorted(
+        [{key: m[key] for key in fields} for m in r.json["manifests"]],
+        key=lambda m: m["filename"],
+    ) == sorted(
+        [{key: m[key] for key in fields} for m in listed], key=lambda m: m["filename"]
+    )
+    usage = scan.scan_user_folder(s3.client, s3.bucket, f"{SHARD}/user-18")
+    newest = max(m["last_modified"] for m in listed)
+    assert usage["newest"].replace("T", " ").startswith(newest)
+
+    assert list(scan.iter_user_folders(s3.client, s3.bucket, "")) == sorted(
+        [f"{SHARD}/user-18", layout.user_folder("", "19", sharded=True)]
+    )
+    assert migrate_layout.main(["--bucket", s3.bucket])["users"] == 0
@@ -0,0 +1,50 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from manifestservice.listing import FileEntry, SortedList, iter_listing_json
+
+
+def test_file_entry_behaves_like_dict():
+    """
+    Test that listing entries give the same values as the dicts they replace.
+    """
+    modified = datetime(2024, 6, 13, 17, 14, 47, tzinfo=timezone.utc)
+    entry = FileEntry("manifest-a.json", modified)
+    expected = {
+        "filename": "manifest-a.json",
+        "last_modified": "2024-06-13 17:14:47",
+        "last_modified_timestamp": datetime.timestamp(modified),
+    }
+    assert dict(entry) == expected
+    assert json.loads(entry.to_json()) == expected
+    assert dict(entry, summary=None)["summary"] is None
+
+
+def test_sorted_list_only_sorts_when_needed():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    entries = SortedList()
+    for i in range(3):
+        entries.append(FileEntry(str(i), start + timedelta(seconds=i)))
+    assert entries.in_order
+
+    entries.append(FileEntry("old", start - timedelta(days=1)))
+    assert not entries.in_order
+    assert [e.filename for e in entries.sort_by_modified()] == ["old", "0", "1", "2"]
+
+
+def test_iter_listing_json():
+    """
+    Test that the streamed listing is the same JSON document as a json.dumps() of
+    the listing, whatever the chunk size.
+    """
+    modified = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    entries = [FileEntry(f'file-"{i}".json', modified) for i in range(50)]
+    entries.append({"filename": "from-a-dict.json"})
+    expected = {"manifests": [dict(e) for e in entries], "sync": "abc"}
+
+    for chunk_size in [1, 100, 64 * 1024]:
+        chunks = list(
+            iter_listing_json("manifests", entries, {"sync": "abc"}, chunk_size)
+        )
+        assert json.loads("".join(chunks)) == expected
+    assert json.loads("".join(iter_listing_json("cohorts", []))) == {"cohorts": []}
@@ -1,6 +1,7 @@
+import hashlib
 import json as json_utils
 import random
-from manifestservice import manifests
+from manifestservice import manifests, object_index, storage
 
 
 def test_generate_unique_manifest_filename_basic_date_generation():
@@ -151,3 +152,414 @@ def test_POST_successful_manifest_upload(client, mocks):
     assert mocks["_add_manifest_to_bucket"].call_count == 1
     assert mocks["_list_files_in_bucket"].call_count == 1
     assert mocks["_get_file_contents"].call_count == 1
+
+
+def _user_objects(s3):
+    # sidecar files are kept out of the user folder
+    response = s3.client.list_objects_v2(Bucket=s3.bucket, Prefix="user-18/")
+    return [obj["Key"] for obj in response.get("Contents", [])]
+
+
+def test_POST_identical_manifests_deduplicated(client, s3):
+    """
+    Test that with deduplicate_uploads, uploading the same manifest twice stores
+    it once and returns the same filename, while different manifests are stored
+    separately.
+    """
+    client.application.config["deduplicate_uploads"] = True
+    test_manifest = [{"object_id": "a"}, {"object_id": "b"}]
+
+    first = client.post("/", json=test_manifest).json["filename"]
+    second = client.post("/", json=test_manifest).json["filename"]
+    assert first == second
+    assert _user_objects(s3) == ["user-18/" + first]
+
+    third = client.post("/", json=[{"object_id": "c"}]).json["filename"]
+    assert third != first
+    assert len(_user_objects(s3)) == 2
+
+    # a deleted manifest is not reused
+    s3.client.delete_object(Bucket=s3.bucket, Key="user-18/" + first)
+    fourth = client.post("/", json=test_manifest).json["filename"]
+    assert fourth != first
+    assert "user-18/" + fourth in _user_objects(s3)
+
+
+def test_POST_manifest_idempotency_key(client, s3):
+    """
+    Test that a retried upload with the same Idempotency-Key header is not stored
+    twice, even without content deduplication.
+    """
+    test_manifest = [{"object_id": "a"}]
+
+    first = client.post("/", json=test_manifest).json["filename"]
+    second = client.post("/", json=test_manifest).json["filename"]
+    assert first != second
+
+    headers = {"Idempotency-Key": "export-1234"}
+    third = client.post("/", json=test_manifest, headers=headers).json["filename"]
+    fourth = client.post("/", json=test_manifest, headers=headers).json["filename"]
+    assert third == fourth
+    assert len(_user_objects(s3)) == 3
+
+
+def test_GET_manifests_with_summary(client, s3):
+    """
+    Test that manifest summaries are computed on upload, stored as object
+    metadata, and returned by GET /?include=summary without reading manifests.
+    """
+    test_manifest = [
+        {"object_id": "a", "subject_id": "s1"},
+        {"object_id": "b", "subject_id": "s1"},
+        {"object_id": "c", "subject_id": "s2"},
+    ]
+    filename = client.post("/", json=test_manifest).json["filename"]
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-old.json", Body=b"[]")
+
+    head = s3.client.head_object(Bucket=s3.bucket, Key="user-18/" + filename)
+    assert head["Metadata"]["record-count"] == "3"
+
+    r = client.get("/")
+    assert "summary" not in r.json["manifests"][0]
+
+    s3.requests.clear()
+    r = client.get("/?include=summary")
+    assert r.status_code == 200
+    assert not [req for req in s3.requests if filename in req.url]
+    summaries = {m["filename"]: m["summary"] for m in r.json["manifests"]}
+    body = json_utils.dumps(test_manifest).encode()
+    assert summaries[filename] == {
+        "record_count": 3,
+        "size": len(body),
+        "subject_count": 2,
+        "sha256": hashlib.sha256(body).hexdigest(),
+    }
+    assert summaries["manifest-old.json"] is None
+
+
+def test_update_json_concurrent_writers(app, s3):
+    """
+    Test that a concurrent modification of a JSON sidecar is not lost.
+    """
+    key = "user-18/.sidecars/test.json"
+    s3.client.put_object(Bucket=s3.bucket, Key=key, Body=b'{"files": ["a"]}')
+    calls = []
+
+    def add_b(value):
+        calls.append(value)
+        if len(calls) == 1:
+            # another writer updates the file between our read and our write
+            s3.client.put_object(
+                Bucket=s3.bucket, Key=key, Body=b'{"files": ["a", "c"]}'
+            )
+        return {"files": value["files"] + ["b"]}
+
+    with app.app_context():
+        storage.update_json(s3.bucket, key, add_b)
+        assert storage.get_json(s3.bucket, key) == {"files": ["a", "c", "b"]}
+    assert len(calls) == 2
+
+
+def test_DELETE_files(client, s3):
+    """
+    Test deleting single files and batches of files, along with their sidecar
+    files and summaries.
+    """
+    client.application.config["manifest_index_stride"] = 1
+    first = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    second = client.post("/", json=[{"object_id": "b"}]).json["filename"]
+    guid = "dg.test/5183a350-9d56-4084-8a03-6471cafeb7fe"
+    client.post("/cohorts", json={"guid": guid})
+    metadata = client.post("/metadata", json={"a": "b"}).json["filename"]
+
+    r = client.delete("/file/" + first)
+    assert r.status_code == 200
+    assert r.json == {"filename": first}
+    assert "user-18/" + first not in _user_objects(s3)
+    assert storage.get_json(s3.bucket, f".sidecars/user-18/index/{first}") is None
+    summaries = client.get("/?include=summary").json["manifests"]
+    assert [m["filename"] for m in summaries] == [second]
+
+    r = client.post(
+        "/delete",
+        json={"manifests": [second], "cohorts": [guid], "metadata": [metadata]},
+    )
+    assert r.status_code == 200
+    assert r.json == {
+        "deleted": {"manifests": [second], "cohorts": [guid], "metadata": [metadata]},
+        "errors": [],
+    }
+    assert _user_objects(s3) == []
+
+    # deleting a missing file is not an error
+    assert client.delete("/cohorts/" + guid).status_code == 200
+    assert client.delete("/metadata/" + metadata).status_code == 200
+
+
+def test_DELETE_invalid_filenames(client, s3):
+    s3.client.put_object(Bucket=s3.bucket, Key="user-19/manifest.json", Body=b"[]")
+    for body in [
+        {"manifests": ["../user-19/manifest.json"]},
+        {"manifests": [".sidecars"]},
+        {"cohorts": ["not-a-guid"]},
+        {"cohorts": ["../../user-19/5183a350-9d56-4084-8a03-6471cafeb7fe"]},
+        {"other": []},
+        {"manifests": "manifest.json"},
+        ["manifest.json"],
+    ]:
+        assert client.post("/delete", json=body).status_code == 400, body
+    assert client.delete("/metadata/.sidecars").status_code == 400
+
+    response = s3.client.list_objects_v2(Bucket=s3.bucket, Prefix="user-19/")
+    assert response["KeyCount"] == 1
+
+
+def test_POST_quota(client, s3):
+    """
+    Test that uploads beyond the file count or size quota get a 403, and that
+    deleting files makes room again.
+    """
+    client.application.config["quota_max_files"] = 2
+    first = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    client.post("/cohorts", json={"guid": "5183a350-9d56-4084-8a03-6471cafeb7fe"})
+    r = client.post("/metadata", json={"a": "b"})
+    assert r.status_code == 403
+    assert "maximum number of files" in r.json["error"]
+    # existing cohorts are not uploaded again
+    r = client.post("/cohorts", json={"guid": "5183a350-9d56-4084-8a03-6471cafeb7fe"})
+    assert r.status_code == 200
+
+    client.delete("/file/" + first)
+    client.application.config["quota_max_files"] = 0
+    client.application.config["quota_max_bytes"] = 100
+    assert client.post("/", json=[{"object_id": "a" * 50}]).status_code == 200
+    r = client.post("/", json=[{"object_id": "b" * 50}])
+    assert r.status_code == 403
+    assert "storage quota" in r.json["error"]
+
+
+def test_POST_stores_body_as_sent(client, s3):
+    """
+    Test that manifest and metadata uploads are stored byte for byte as sent,
+    and that the offset index points into the stored bytes.
+    """
+    client.application.config["manifest_index_stride"] = 2
+    body = (
+        '[{"object_id":"a","subject_id":"é"},\n'
+        ' {"object_id": "b", "n": 1.50},{"object_id":"c"}\n]'
+    ).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    filename = client.post("/", data=body, headers=headers).json["filename"]
+    stored = s3.client.get_object(Bucket=s3.bucket, Key="user-18/" + filename)
+    assert stored["Body"].read() == body
+    assert stored["Metadata"]["record-count"] == "3"
+
+    r = client.get(f"/file/{filename}?offset=2&limit=1")
+    assert r.json == [{"object_id": "c"}]
+    r = client.get(f"/file/{filename}?offset=1&limit=1")
+    assert r.json == [{"object_id": "b", "n": 1.5}]
+
+    for invalid in [b"[]", b"[1]", b'[{"object_id": "a"}', b'{"object_id": "a"}']:
+        r = client.post("/", data=invalid, headers=headers)
+        assert r.status_code == 400
+    r = client.post("/", data=body, headers={"Content-Type": "text/plain"})
+    assert r.status_code == 415
+
+    body = b'{"a" : ["b", 2.0]}'
+    filename = client.post("/metadata", data=body, headers=headers).json["filename"]
+    key = "user-18/exported-metadata/" + filename
+    assert s3.client.get_object(Bucket=s3.bucket, Key=key)["Body"].read() == body
+    r = client.post("/metadata", data=b"{", headers=headers)
+    assert r.status_code == 400
+
+
+def test_GET_lookup(client, s3):
+    """
+    Test that lookups find the manifests containing an object_id, whether they
+    were indexed on upload or are indexed on demand, and that deleted manifests
+    are not returned.
+    """
+    client.application.config["object_index_partitions"] = 4
+    legacy = client.post("/", json=[{"object_id": "a"}, {"object_id": "b"}]).json[
+        "filename"
+    ]
+    client.application.config["object_index"] = True
+    first = client.post("/", json=[{"object_id": "a", "subject_id": 1}]).json[
+        "filename"
+    ]
+    second = client.post("/", json=[{"object_id": "b"}, {"object_id": 7}]).json[
+        "filename"
+    ]
+
+    # the manifest uploaded without indexing is indexed by the first lookup
+    r = client.get("/lookup?object_id=a")
+    assert r.status_code == 200
+    assert r.json == {
+        "object_id": "a",
+        "manifests": sorted([legacy, first]),
+        "unindexed": [],
+    }
+    assert client.get("/lookup?object_id=7").json["manifests"] == [second]
+    assert client.get("/lookup?object_id=missing").json["manifests"] == []
+    assert client.get("/lookup?subject_id=1").status_code == 400
+    assert client.get("/lookup").status_code == 400
+
+    assert client.delete("/file/" + legacy).status_code == 200
+    assert client.get("/lookup?object_id=b").json["manifests"] == [second]
+
+    client.application.config["object_index_fields"] = ["object_id", "subject_id"]
+    assert client.get("/lookup?subject_id=1").json["manifests"] == [first]
+    r = client.post("/lookup/rebuild")
+    assert r.json == {"manifests": 2, "unindexed": []}
+    files = storage.get_json(s3.bucket, ".sidecars/user-18/objects/files.json")
+    assert files["files"] == sorted([first, second])
+    assert client.get("/lookup?object_id=a").json["manifests"] == [first]
+
+
+def test_GET_lookup_batches(client, s3, monkeypatch):
+    """
+    Test that a lookup writes the index as manifests are indexed and answers
+    once its time is up, listing the manifests it could not search, and that
+    files that are not manifests are not searched again.
+    """
+    client.application.config["object_index_partitions"] = 2
+    filenames = sorted(
+        client.post("/", json=[{"object_id": "a", "file_name": f"O'{i}"}]).json[
+            "filename"
+        ]
+        for i in range(3)
+    )
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-invalid.json", Body=b"{}"
+    )
+    monkeypatch.setattr(object_index, "INDEX_BATCH", 2)
+    monkeypatch.setattr(object_index, "LOOKUP_BUDGET", 0)
+
+    r = client.get("/lookup?object_id=a")
+    assert r.json["manifests"] == filenames[:2]
+    assert r.json["unindexed"] == sorted([filenames[2], "manifest-invalid.json"])
+
+    r = client.get("/lookup?object_id=a")
+    assert r.json["manifests"] == filenames
+    assert r.json["unindexed"] == ["manifest-invalid.json"]
+    s3.requests.clear()
+    client.get("/lookup?object_id=a")
+    assert not [req for req in s3.requests if "manifest-invalid" in req.url]
+
+
+def test_POST_combine(client, s3):
+    """
+    Test that combining manifests stores the result as a new manifest, with its
+    summary, and that invalid requests are rejected.
+    """
+    client.application.config["combine_sort_run_size"] = 2
+    client.application.config["object_index"] = True
+    first = client.post(
+        "/", json=[{"object_id": "c", "subject_id": "s"}, {"object_id": "a"}]
+    ).json["filename"]
+    second = client.post("/", json=[{"object_id": "b"}, {"object_id": "c"}]).json[
+        "filename"
+    ]
+
+    r = client.post(
+        "/combine", json={"manifests": [first, second], "operation": "intersection"}
+    )
+    assert r.status_code == 200
+    combined = r.json["filename"]
+    assert json_utils.loads(client.get("/file/" + combined).data) == [
+        {"object_id": "c", "subject_id": "s"}
+    ]
+    summaries = client.get("/?include=summary").json["manifests"]
+    summary = [m["summary"] for m in summaries if m["filename"] == combined][0]
+    assert summary["record_count"] == 1
+    assert client.get("/lookup?object_id=c").json["manifests"] == sorted(
+        [first, second, combined]
+    )
+
+    r = client.post(
+        "/combine", json={"manifests": [first, second], "operation": "union"}
+    )
+    union = json_utils.loads(client.get("/file/" + r.json["filename"]).data)
+    assert [record["object_id"] for record in union] == ["a", "b", "c"]
+
+    for body in [
+        {"manifests": [first], "operation": "union"},
+        {"manifests": [first, second], "operation": "xor"},
+        {"manifests": [first, "../x"], "operation": "union"},
+        [first, second],
+    ]:
+        assert client.post("/combine", json=body).status_code == 400
+    r = client.post(
+        "/combine", json={"manifests": [first, "manifest-x.json"], "operation": "union"}
+    )
+    assert r.status_code == 404
+
+    # records are parsed as JSON, apostrophes included
+    third = client.post("/", json=[{"object_id": "a", "file_name": "O'Brien"}]).json[
+        "filename"
+    ]
+    r = client.post(
+        "/combine", json={"manifests": [third, first], "operation": "intersection"}
+    )
+    assert r.status_code == 200
+    assert json_utils.loads(client.get("/file/" + r.json["filename"]).data) == [
+        {"object_id": "a", "file_name": "O'Brien"}
+    ]
+
+    r = client.post(
+        "/combine", json={"manifests": [first, first], "operation": "difference"}
+    )
+    assert r.status_code == 400
+    assert "no records" in r.json["error"]
+
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-invalid.json", Body=b'[{"a": }]'
+    )
+    r = client.post(
+        "/combine",
+        json={"manifests": [first, "manifest-invalid.json"], "operation": "union"},
+    )
+    assert r.status_code == 400
+    assert "manifest-invalid.json" in r.json["error"]
+
+
+def test_POST_export(client, s3, monkeypatch):
+    """
+    Test that files are exported with server-side copies, including multipart
+    copies of large files, and that missing files are reported.
+    """
+    assert client.post("/export", json={"manifests": []}).status_code == 501
+    s3.client.create_bucket(Bucket="test-export-bucket")
+    client.application.config["export_bucket"] = "test-export-bucket"
+    client.application.config["export_prefix"] = "workspaces/{sub}/"
+    manifest = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    metadata = client.post("/metadata", json={"a": "b"}).json["filename"]
+
+    s3.requests.clear()
+    r = client.post(
+        "/export",
+        json={"manifests": [manifest, "manifest-x.json"], "metadata": [metadata]},
+    )
+    assert r.status_code == 200
+    assert r.json["bucket"] == "test-export-bucket"
+    assert sorted(e["key"] for e in r.json["exported"]) == sorted(
+        ["workspaces/18/" + manifest, "workspaces/18/" + metadata]
+    )
+    assert r.json["errors"] == [
+        {"type": "manifests", "filename": "manifest-x.json", "error": "Not found."}
+    ]
+    # the files were not read by the service
+    reads = [r for r in s3.requests if r.method == "GET" and "list-type" not in r.url]
+    assert reads == []
+    assert sum("x-amz-copy-source" in request.headers for request in s3.requests) == 2
+    copied = s3.client.get_object(
+        Bucket="test-export-bucket", Key="workspaces/18/" + manifest
+    )
+    assert copied["Body"].read() == b'[{"object_id": "a"}]'
+
+    monkeypatch.setattr(storage, "MAX_COPY_OBJECT_SIZE", 1)
+    r = client.post("/export", json={"metadata": [metadata]})
+    assert r.json["exported"][0]["key"] == "workspaces/18/" + metadata
+    assert any("uploadId=" in request.url for request in s3.requests)
+    assert client.post("/export", json={"cohorts": []}).status_code == 400
+    assert client.post("/export", json={"manifests": ["../a"]}).status_code == 400
@@ -97,3 +97,97 @@ def test_GET_metadata_broken_s3(client, broken_s3_mocks):
     response = r.json
     assert len(response.keys()) == 1
     assert response["error"] == "Currently unable to connect to s3."
+
+
+def test_POST_identical_metadata_deduplicated(client, s3):
+    """
+    Test that with deduplicate_uploads, identical metadata exports are stored once.
+    """
+    client.application.config["deduplicate_uploads"] = True
+    body = {"file_id": "45138"}
+
+    first = client.post("/metadata", json=body).json["filename"]
+    second = client.post("/metadata", json=body).json["filename"]
+    assert first == second
+
+    r = client.get("/metadata")
+    assert [f["filename"] for f in r.json["external_file_metadata"]] == [first]
+
+
+def test_metadata_upload_session(client, s3, monkeypatch):
+    """
+    Test uploading a metadata export in NDJSON chunks: parts can be sent out of
+    order and retried, and the committed file is a JSON array of the records.
+    """
+    monkeypatch.setattr("manifestservice.uploads.MIN_PART_SIZE", 16)
+    monkeypatch.setattr("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 16)
+    client.application.config["metadata_upload_max_chunk_size"] = 100
+
+    r = client.post("/metadata/uploads")
+    assert r.status_code == 200
+    session, filename = r.json["session"], r.json["filename"]
+    assert filename.startswith("metadata-")
+
+    url = f"/metadata/uploads/{session}"
+    r = client.put(url + "/2", data=b'{"file_id": "2"}\n{"file_id": "3"}\n')
+    assert r.status_code == 200
+    assert r.json == {"part": 2, "records": 2}
+    assert client.put(url + "/1", data=b'{"file_id": "x"}\n').status_code == 200
+    # retry of part 1
+    assert client.put(url + "/1", data=b'{"file_id": "1"}\n').status_code == 200
+
+    assert client.put(url + "/3", data=b'{"file_id": \n').status_code == 400
+    assert client.put(url + "/3", data=b"{}").status_code == 400
+    assert client.put(url + "/3", data=b"\n").status_code == 400
+    assert client.put(url + "/3", data=b"[" + b"1," * 60 + b"1]").status_code == 413
+    assert client.put(url + "/0", data=b'{"file_id": "1"}\n').status_code == 400
+    assert client.put("/metadata/uploads/bad/1", data=b"{}").status_code == 400
+    assert client.get("/metadata").json["external_file_metadata"] == []
+
+    r = client.post(url + "/commit", data=b'{"file_id": "4"}\n')
+    assert r.status_code == 200
+    assert r.json == {"filename": filename}
+    r = client.get("/metadata/" + filename)
+    assert json_utils.loads(r.data) == [{"file_id": str(i)} for i in range(1, 5)]
+    r = client.get("/metadata")
+    assert [f["filename"] for f in r.json["external_file_metadata"]] == [filename]
+    assert client.post(url + "/commit").status_code == 404
+
+
+def test_metadata_upload_session_errors(client, s3, monkeypatch):
+    """
+    Test committing an upload session with missing parts, no parts or no
+    records, and aborting a session.
+    """
+    monkeypatch.setattr("manifestservice.uploads.MIN_PART_SIZE", 16)
+    monkeypatch.setattr("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 16)
+
+    session = client.post("/metadata/uploads").json["session"]
+    url = f"/metadata/uploads/{session}"
+    assert client.put(url + "/2", data=b'{"file_id": "2"}\n').status_code == 200
+    r = client.post(url + "/commit")
+    assert r.status_code == 400
+    assert r.json["error"] == "Missing parts: 1."
+    assert client.delete(url).status_code == 200
+    assert client.delete(url).status_code == 404
+
+    # a session without records is aborted
+    r = client.post("/metadata/uploads")
+    filename = r.json["filename"]
+    url = f"/metadata/uploads/{r.json['session']}"
+    r = client.post(url + "/commit")
+    assert r.status_code == 400
+    assert r.json["error"] == "The upload has no records."
+    assert client.delete(url).status_code == 404
+    assert client.get("/metadata/" + filename).status_code == 404
+
+    # the records can all be sent with the commit
+    r = client.post("/metadata/uploads")
+    filename = r.json["filename"]
+    r = client.post(
+        f"/metadata/uploads/{r.json['session']}/commit", data=b'{"file_id": "1"}\n'
+    )
+    assert r.status_code == 200
+    assert json_utils.loads(client.get("/metadata/" + filename).data) == [
+        {"file_id": "1"}
+    ]
@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+from manifestservice.ratelimit import InProcessBackend, RateLimiter, RedisBackend
+
+
+def test_token_bucket():
+    """
+    Test that a user can make `burst` requests at once, then one request every
+    1/rate seconds, and that users and budgets have separate buckets.
+    """
+    now = [0.0]
+    limiter = RateLimiter(
+        {"read": (2, 3), "write": (0, 0)},
+        InProcessBackend(clock=lambda: now[0]),
+    )
+    assert [limiter.check("18", "read") for _ in range(3)] == [0, 0, 0]
+    assert limiter.check("18", "read") == pytest.approx(0.5)
+    assert limiter.check("19", "read") == 0
+    # writes are not limited
+    assert limiter.check("18", "write") == 0
+
+    now[0] = 0.5
+    assert limiter.check("18", "read") == 0
+    assert limiter.check("18", "read") > 0
+
+
+def test_in_process_backend_evicts_idle_buckets():
+    now = [0.0]
+    backend = InProcessBackend(max_keys=10, clock=lambda: now[0])
+    for i in range(10):
+        backend.acquire(str(i), 1, 1)
+    now[0] = 5
+    backend.acquire("new", 1, 1)
+    assert list(backend._buckets) == ["new"]
+
+
+def test_in_process_backend_evicts_with_bucket_limits():
+    """
+    Test that buckets are evicted once refilled at their own rate and burst, not
+    those of the request that triggers the eviction.
+    """
+    now = [0.0]
+    backend = InProcessBackend(max_keys=10, clock=lambda: now[0])
+    for i in range(10):
+        # refilled after 100 seconds
+        backend.acquire(f"write:{i}", 0.1, 10)
+    now[0] = 5
+    backend.acquire("read:new", 100, 1)
+    assert len(backend._buckets) == 11
+    assert backend.acquire("write:0", 0.1, 10) == 0
+
+    now[0] = 200
+    backend.acquire("read:other", 100, 1)
+    assert set(backend._buckets) == {"read:other"}
+
+
+def test_rate_limit_overhead():
+    """
+    Test that checking the rate limit takes less than 20µs.
+    """
+    limiter = RateLimiter({"read": (1000000, 1000000)})
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(10000):
+            limiter.check("18", "read")
+        elapsed = (time.perf_counter() - start) / 10000
+        best = elapsed if best is None else min(best, elapsed)
+    assert best < 20e-6
+
+
+def test_redis_backend():
+    """
+    Test the shared Redis backend, and that it falls back to in-process buckets
+    when Redis is unavailable.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    limiter = RateLimiter(
+        {"write": (1, 2)}, RedisBackend(fakeredis.FakeRedis(server=server))
+    )
+    # another worker sharing the same Redis
+    other_limiter = RateLimiter(
+        {"write": (1, 2)}, RedisBackend(fakeredis.FakeRedis(server=server))
+    )
+    assert limiter.check("18", "write") == 0
+    assert other_limiter.check("18", "write") == 0
+    assert 0 < limiter.check("18", "write") <= 1
+
+    server.connected = False
+    assert other_limiter.check("18", "write") == 0
+
+
+def test_rate_limited_routes(client, s3):
+    """
+    Test that requests beyond the user's budget get a 429 with Retry-After, and
+    that reads and writes have separate budgets.
+    """
+    client.application.config["rate_limit_write_per_second"] = 0.01
+    client.application.config["rate_limit_write_burst"] = 2
+    client.application.config["rate_limit_read_per_second"] = 0.01
+    client.application.config["rate_limit_read_burst"] = 3
+
+    for _ in range(2):
+        assert client.post("/cohorts", json={"guid": "a-b"}).status_code == 400
+    r = client.post("/", json=[{"object_id": "a"}])
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) > 1
+
+    for _ in range(3):
+        assert client.get("/cohorts").status_code == 200
+    r = client.get("/metadata")
+    assert r.status_code == 429
+    assert "Retry-After" in r.headers
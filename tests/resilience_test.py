@@ -0,0 +1,230 @@
+import threading
+import time
+
+import pytest
+
+from manifestservice import deadlines, sync
+from manifestservice.resilience import CircuitBreaker, CircuitOpenError
+from manifestservice.storage import _hedged_call
+from botocore.exceptions import EndpointConnectionError
+
+
+def test_GET_file_reads_from_s3(client, s3):
+    """
+    Test that a stored file is returned by GET /file/<name>, and that a missing
+    file is a 404 rather than an s3 error.
+    """
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b'[{"object_id": "a"}]'
+    )
+
+    r = client.get("/file/manifest-a.json")
+    assert r.status_code == 200
+    assert r.data == b'[{"object_id": "a"}]'
+
+    r = client.get("/file/manifest-missing.json")
+    assert r.status_code == 404
+
+
+def test_GET_file_retries_transient_failures(client, s3):
+    """
+    Test that a transient s3 failure is retried instead of being returned to the
+    user.
+    """
+    client.application.config["s3_max_attempts"] = 2
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b"[]")
+    s3.failures = 1
+    s3.error = "503"
+
+    r = client.get("/file/manifest-a.json")
+    assert r.status_code == 200
+    assert s3.failures == 0
+
+
+def test_GET_file_reads_from_nearest_replica(client, s3):
+    """
+    Test that files are read from the nearest read replica, and from the primary
+    bucket if the replica does not have the file yet or cannot be read, while
+    uploads go to the primary bucket.
+    """
+    client.application.config["s3_local_region"] = "us-west-2"
+    client.application.config["s3_read_replicas"] = [
+        {"bucket": "missing-replica", "region": "eu-west-1"},
+        {"bucket": "replica-west", "region": "us-west-2"},
+    ]
+    s3.client.create_bucket(
+        Bucket="replica-west",
+        CreateBucketConfiguration={"LocationConstraint": "us-west-2"},
+    )
+    s3.client.put_object(
+        Bucket="replica-west", Key="user-18/manifest-a.json", Body=b"[1]"
+    )
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b"[2]")
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-b.json", Body=b"[3]")
+
+    s3.requests.clear()
+    assert client.get("/file/manifest-a.json").data == b"[1]"
+    assert [r.url for r in s3.requests if "manifest-a" in r.url] == [
+        "https://replica-west.s3.us-west-2.amazonaws.com/user-18/manifest-a.json"
+    ]
+    # not replicated yet
+    assert client.get("/file/manifest-b.json").data == b"[3]"
+    r = client.get("/file/manifest-a.json?limit=1&format=ndjson")
+    assert r.data == b"1\n"
+    assert client.get("/file/manifest-missing.json").status_code == 404
+
+    filename = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    s3.client.head_object(Bucket=s3.bucket, Key="user-18/" + filename)
+
+    # unavailable replicas are skipped
+    client.application.config["s3_read_replicas"] = [
+        {"bucket": "missing-replica", "region": "us-west-2"}
+    ]
+    assert client.get("/file/manifest-a.json").data == b"[2]"
+
+
+def test_GET_file_s3_down(client, s3):
+    """
+    Test that s3 failures are returned as a JSON error, and that once the circuit
+    breaker opens, requests fail fast without calling s3.
+    """
+    client.application.config["s3_max_attempts"] = 1
+    client.application.config["circuit_breaker_failure_threshold"] = 2
+    s3.failures = 100
+
+    for _ in range(2):
+        r = client.get("/file/manifest-a.json")
+        assert r.status_code == 500
+        assert r.json["error"] == "Currently unable to connect to s3."
+
+    calls = s3.calls
+    r = client.get("/file/manifest-a.json")
+    assert r.status_code == 503
+    assert int(r.headers["Retry-After"]) > 0
+    assert s3.calls == calls
+
+    # listings and writes fail fast the same way
+    since = sync.SyncToken(time.time_ns()).encode()
+    for r in (
+        client.get("/"),
+        client.get("/cohorts"),
+        client.get(f"/metadata?since={since}"),
+        client.put("/", json=[{"object_id": "a"}]),
+        client.put("/cohorts", json={"guid": "5183a350-9d56-4084-8a03-6471cafeb7fe"}),
+        client.delete("/file/manifest-a.json"),
+    ):
+        assert r.status_code == 503
+        assert int(r.headers["Retry-After"]) > 0
+    assert s3.calls == calls
+
+
+def test_circuit_breaker_half_open():
+    """
+    Test that the breaker lets a single trial call through after the reset
+    timeout, and closes again if it succeeds.
+    """
+    now = [0.0]
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, clock=lambda: now[0]
+    )
+
+    with pytest.raises(EndpointConnectionError):
+        with breaker.guard():
+            raise EndpointConnectionError(endpoint_url="http://s3")
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] = 11
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.before_call()
+    # a second caller is rejected while the trial call is in flight
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_ignores_client_errors():
+    """
+    Test that errors such as a missing key do not open the breaker.
+    """
+    from botocore.exceptions import ClientError
+
+    breaker = CircuitBreaker(failure_threshold=1)
+    error = ClientError(
+        {"Error": {"Code": "NoSuchKey"}, "ResponseMetadata": {"HTTPStatusCode": 404}},
+        "GetObject",
+    )
+    breaker.record_failure(error)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_hedged_call_returns_fastest(app):
+    """
+    Test that a slow read is hedged with a second one and the fastest result wins.
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def read():
+        with lock:
+            calls.append(1)
+            first = len(calls) == 1
+        if first:
+            time.sleep(2)
+            return "slow"
+        return "fast"
+
+    with app.app_context():
+        start = time.monotonic()
+        assert _hedged_call(read, 0.05) == "fast"
+        assert time.monotonic() - start < 1
+        assert len(calls) == 2
+
+        # a read that completes before the hedge delay is not duplicated
+        calls.clear()
+        assert _hedged_call(lambda: calls.append(1) or "ok", 1) == "ok"
+        assert len(calls) == 1
+
+
+def test_deadline_read_timeout():
+    """
+    Test that s3 calls get a read timeout that fits in the remaining time.
+    """
+    assert deadlines.read_timeout(60) == 60
+    token = deadlines._current_deadline.set(deadlines.Deadline(7))
+    try:
+        assert deadlines.read_timeout(60) == 5
+        assert deadlines.read_timeout(3) == 3
+        deadlines.current_deadline().expires = time.monotonic() + 0.2
+        assert deadlines.read_timeout(60) == 1
+    finally:
+        deadlines._current_deadline.reset(token)
+
+
+def test_deadline_stops_retries(client, s3):
+    """
+    Test that s3 retries stop when the deadline of the request, shortened by
+    the X-Request-Timeout header, has passed, and that the request ends with a
+    504.
+    """
+    client.application.config["s3_max_attempts"] = 10
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b"[]")
+    s3.failures = 10
+    s3.error = "503"
+    s3.latencies = [0.2] * 10
+
+    calls = s3.calls
+    r = client.get("/file/manifest-a.json", headers={"X-Request-Timeout": "0.5"})
+    assert r.status_code == 504
+    assert "0.5 seconds" in r.json["error"]
+    # the retries stopped at the deadline, well before s3_max_attempts
+    assert s3.calls - calls < 5
+    assert s3.failures > 5
+
+    s3.failures = 0
+    s3.latencies = []
+    client.application.config["request_timeouts"] = {"manifests.get_manifests": 0}
+    assert client.get("/").status_code == 504
+    assert client.get("/file/manifest-a.json").status_code == 200
@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from manifestservice import retention
+
+
+def test_select_expired():
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    entries = [(f"file-{i}", now - timedelta(days=i)) for i in range(10)]
+    assert retention.select_expired(entries, keep=8, now=now) == {"file-8", "file-9"}
+    assert retention.select_expired(entries, max_age_days=7.5, now=now) == {
+        "file-8",
+        "file-9",
+    }
+    assert retention.select_expired(entries, max_age_days=5, keep=3, now=now) == {
+        f"file-{i}" for i in range(3, 10)
+    }
+    assert retention.select_expired(entries, now=now) == set()
+
+
+def _keys(s3, prefix):
+    response = s3.client.list_objects_v2(Bucket=s3.bucket, Prefix=prefix)
+    return sorted(obj["Key"] for obj in response.get("Contents", []))
+
+
+def test_retention_job(client, s3):
+    """
+    Test that the job keeps the newest files of each type in every user folder,
+    and deletes the others with their sidecar files and old journal entries.
+    """
+    client.application.config["manifest_index_stride"] = 1
+    client.application.config["deduplicate_uploads"] = True
+    manifests = [client.post("/", json=[{"object_id": "a"}]).json["filename"]]
+    manifests.append(client.post("/", json=[{"object_id": "b"}]).json["filename"])
+    client.post("/cohorts", json={"guid": "5183a350-9d56-4084-8a03-6471cafeb7fe"})
+    s3.client.put_object(Bucket=s3.bucket, Key="user-19/manifest-a.json", Body=b"[]")
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key=f".sidecars/user-18/changes/{1:020d}-manifests/manifest-old.json",
+        Body=b"",
+    )
+
+    retention.main(["--bucket", s3.bucket, "--keep", "1", "--dry-run"])
+    assert "user-18/" + manifests[0] in _keys(s3, "user-18/")
+
+    retention.main(["--bucket", s3.bucket, "--keep", "1", "--workers", "2"])
+    keys = _keys(s3, "user-18/") + _keys(s3, ".sidecars/user-18/")
+    assert "user-18/" + manifests[0] not in keys
+    assert f".sidecars/user-18/index/{manifests[0]}" not in keys
+    assert "user-18/" + manifests[1] in keys
+    assert f".sidecars/user-18/index/{manifests[1]}" in keys
+    assert "user-18/cohorts/5183a350-9d56-4084-8a03-6471cafeb7fe" in keys
+    assert not any(key.endswith("manifest-old.json") for key in keys)
+    # recent journal entries are kept
+    assert any(key.startswith(".sidecars/user-18/changes/") for key in keys)
+    assert _keys(s3, "user-19/") == ["user-19/manifest-a.json"]
+    # upload records are kept until upload_record_max_age_days
+    assert any(key.startswith(".sidecars/user-18/uploads/") for key in keys)
+
+    summaries = client.get("/?include=summary").json["manifests"]
+    assert [m["filename"] for m in summaries] == [manifests[1]]
+    r = client.get("/?include=summary")
+    assert r.json["manifests"][0]["summary"]["record_count"] == 1
+
+
+def test_retention_job_upload_records(client, s3):
+    """
+    Test that the job deletes the upload records older than
+    upload_record_max_age_days, whether or not their file still exists.
+    """
+    client.application.config["deduplicate_uploads"] = True
+    client.post("/", json=[{"object_id": "a"}], headers={"Idempotency-Key": "k"})
+    assert len(_keys(s3, ".sidecars/user-18/uploads/")) == 2
+
+    retention.main(["--bucket", s3.bucket, "--upload-record-max-age-days", "1"])
+    assert len(_keys(s3, ".sidecars/user-18/uploads/")) == 2
+
+    time.sleep(1.1)
+    # 0.86 seconds
+    retention.main(["--bucket", s3.bucket, "--upload-record-max-age-days", "0.00001"])
+    assert _keys(s3, ".sidecars/user-18/uploads/") == []
+    assert len(_keys(s3, "user-18/")) == 1
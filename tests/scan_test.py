@@ -0,0 +1,149 @@
+import csv
+import json
+
+from manifestservice import scan
+
+
+def _populate(s3):
+    for user, count in [("1", 2), ("2", 1), ("30", 3)]:
+        for i in range(count):
+            s3.client.put_object(
+                Bucket=s3.bucket,
+                Key=f"prefix/user-{user}/manifest-{i}.json",
+                Body=b"[]",
+            )
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="prefix/user-2/cohorts/some-guid", Body=b""
+    )
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key="prefix/.sidecars/user-2/index/manifest-0.json",
+        Body=b"{}",
+    )
+    s3.client.put_object(Bucket=s3.bucket, Key="other/user-5/manifest.json", Body=b"")
+
+
+def test_scan_bucket(s3, tmp_path):
+    """
+    Test the usage report of every user folder and the bucket-wide totals.
+    """
+    _populate(s3)
+    output = tmp_path / "usage.csv"
+    scan.main(
+        [
+            "--bucket",
+            s3.bucket,
+            "--prefix",
+            "prefix",
+            "--output",
+            str(output),
+            "--workers",
+            "2",
+        ]
+    )
+
+    with open(output) as f:
+        rows = {row["user"]: row for row in csv.DictReader(f)}
+    assert set(rows) == {"user-1", "user-2", "user-30", "TOTAL"}
+    assert rows["user-1"]["manifests"] == "2"
+    assert rows["user-2"]["cohorts"] == "1"
+    assert rows["user-2"]["files"] == "2"
+    assert rows["user-2"]["bytes"] == "2"
+    assert rows["user-2"]["sidecar_bytes"] == "2"
+    assert rows["TOTAL"]["files"] == "7"
+    assert rows["TOTAL"]["oldest"] <= rows["TOTAL"]["newest"]
+
+
+def test_scan_resumes_from_checkpoint(s3, tmp_path):
+    """
+    Test that a scan resumed from a checkpoint only scans the remaining folders
+    and still reports bucket-wide totals.
+    """
+    _populate(s3)
+    checkpoint_path = tmp_path / "scan.ckpt"
+    totals = scan._empty_usage(None)
+    totals["files"] = 100
+    with open(checkpoint_path, "w") as f:
+        json.dump(
+            {"after": "prefix/user-1", "done": ["prefix/user-30"], "totals": totals},
+            f,
+        )
+
+    output = tmp_path / "usage.json"
+    scan.main(
+        [
+            "--bucket",
+            s3.bucket,
+            "--prefix",
+            "prefix",
+            "--format",
+            "json",
+            "--output",
+            str(output),
+            "--checkpoint",
+            str(checkpoint_path),
+        ]
+    )
+
+    with open(output) as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["user"] for row in rows] == ["user-2", "TOTAL"]
+    assert rows[-1]["files"] == 102
+
+    with open(checkpoint_path) as f:
+        saved = json.load(f)
+    assert saved["after"] == "prefix/user-2"
+    assert saved["done"] == ["prefix/user-30"]
+
+
+def test_scan_resume_drops_rows_after_checkpoint(s3, tmp_path):
+    """
+    Test that the rows written after the last checkpoint are dropped from the
+    output when the scan resumes, so that every user folder has a single row.
+    """
+    _populate(s3)
+    output = tmp_path / "usage.json"
+    saved_rows = "".join(
+        json.dumps(scan._empty_usage(user)) + "\n" for user in ("user-1", "user-30")
+    )
+    with open(output, "w") as f:
+        f.write(saved_rows)
+        # a row written after the checkpoint was saved, before an interruption
+        f.write(json.dumps(scan._empty_usage("user-2")) + "\n")
+    checkpoint_path = tmp_path / "scan.ckpt"
+    with open(checkpoint_path, "w") as f:
+        json.dump(
+            {
+                "after": "prefix/user-1",
+                "done": ["prefix/user-30"],
+                "totals": scan._empty_usage(None),
+                "output_offset": len(saved_rows),
+            },
+            f,
+        )
+
+    scan.main(
+        [
+            "--bucket",
+            s3.bucket,
+            "--prefix",
+            "prefix",
+            "--format",
+            "json",
+            "--output",
+            str(output),
+            "--checkpoint",
+            str(checkpoint_path),
+        ]
+    )
+
+    with open(output) as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["user"] for row in rows] == ["user-1", "user-30", "user-2", "TOTAL"]
+    assert rows[2]["files"] == 2
+
+    with open(checkpoint_path) as f:
+        saved = json.load(f)
+    with open(output) as f:
+        # the checkpoint was saved before the TOTAL row was written
+        assert saved["output_offset"] == len(f.read()) - len(json.dumps(rows[-1])) - 1
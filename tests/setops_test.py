@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from manifestservice import setops
+
+
+def test_combine_spills_sorted_runs():
+    """
+    Test the set operations, with runs small enough that most records are
+    sorted in temporary files.
+    """
+    first = [{"object_id": i % 7, "n": i} for i in range(20)] + [{"n": "no id"}]
+    second = [{"object_id": str(i)} for i in range(5)] + [
+        {"object_id": i} for i in range(3, 10)
+    ]
+    third = [{"object_id": i} for i in range(5, 6)]
+
+    def ids(records):
+        return [record["object_id"] for record in records]
+
+    union = list(setops.combine([first, second, third], "union", run_size=3))
+    assert sorted(ids(union), key=json.dumps) == ids(union)
+    assert len(union) == 10 + 5
+    # first record of each object_id, in manifest then record order
+    assert {"object_id": 3, "n": 3} in union
+
+    intersection = list(setops.combine([first, second], "intersection", run_size=3))
+    assert ids(intersection) == [3, 4, 5, 6]
+    assert [r["n"] for r in intersection] == [3, 4, 5, 6]
+    assert ids(setops.combine([first, second, third], "intersection")) == [5]
+
+    difference = list(setops.combine([first, second, third], "difference", 4))
+    assert ids(difference) == [0, 1, 2]
+
+    with pytest.raises(ValueError):
+        list(setops.combine([first, second], "xor"))
@@ -0,0 +1,200 @@
+import threading
+import time
+
+import pytest
+
+from manifestservice import deadlines, manifests
+from manifestservice.resilience import CircuitOpenError
+from manifestservice.singleflight import SingleFlight
+from manifestservice.storage import get_single_flight
+
+
+def _run_concurrently(n, fn):
+    results = [None] * n
+    errors = [None] * n
+
+    def run(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_single_flight_shares_result():
+    """
+    Test that concurrent calls for the same key run the function once and all get
+    its result.
+    """
+    single_flight = SingleFlight()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"manifests": []}
+
+    results, errors = _run_concurrently(
+        5, lambda: single_flight.do("user-18", slow_call)
+    )
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert all(result is results[0] for result in results)
+    assert single_flight.coalesced == 4
+
+    # the call is not cached once it is done
+    single_flight.do("user-18", slow_call)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_errors():
+    """
+    Test that every waiting caller gets the error of the shared call.
+    """
+    single_flight = SingleFlight()
+
+    def failing_call():
+        time.sleep(0.2)
+        raise ValueError("s3 is down")
+
+    results, errors = _run_concurrently(
+        3, lambda: single_flight.do("user-18", failing_call)
+    )
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert single_flight._calls == {}
+
+
+def test_single_flight_bounded():
+    """
+    Test that calls beyond max_keys run without being tracked.
+    """
+    single_flight = SingleFlight(max_keys=0)
+    assert single_flight.do("a", lambda: 1) == 1
+    assert single_flight._calls == {}
+
+
+def test_concurrent_listings_share_s3_call(app, s3):
+    """
+    Test that concurrent listings of the same folder make a single s3 LIST.
+    """
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b"[]")
+    s3.calls = 0
+    s3.latencies = [0.3]
+
+    def list_folder():
+        with app.app_context():
+            return manifests._list_files_in_bucket(s3.bucket, "user-18")
+
+    results, errors = _run_concurrently(4, list_folder)
+    assert errors == [None] * 4
+    assert all(ok for _, ok in results)
+    assert results[0][0]["manifests"][0]["filename"] == "manifest-a.json"
+    assert s3.calls == 1
+    with app.app_context():
+        assert get_single_flight().coalesced == 3
+
+
+def test_single_flight_copies_errors():
+    """
+    Test that waiting callers each raise their own copy of the shared error, so
+    that tracebacks set by raising in different threads are not mixed up.
+    """
+    single_flight = SingleFlight()
+    error = CircuitOpenError(3)
+
+    def failing_call():
+        time.sleep(0.2)
+        raise error
+
+    results, errors = _run_concurrently(
+        3, lambda: single_flight.do("user-18", failing_call)
+    )
+    assert all(isinstance(e, CircuitOpenError) for e in errors)
+    assert all(e.retry_after == 3 for e in errors)
+    assert len({id(e) for e in errors}) == 3
+    assert sum(e is error for e in errors) == 1
+    assert all(e.__cause__ is error for e in errors if e is not error)
+
+
+def _with_deadline(timeout, fn):
+    token = deadlines._current_deadline.set(deadlines.Deadline(timeout))
+    try:
+        return fn()
+    finally:
+        deadlines._current_deadline.reset(token)
+
+
+def test_single_flight_waits_within_deadline():
+    """
+    Test that a waiting caller gives up at its own deadline while the shared call
+    is still running.
+    """
+    single_flight = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocked_call():
+        started.set()
+        release.wait()
+        return {"manifests": []}
+
+    leader = threading.Thread(target=single_flight.do, args=("user-18", blocked_call))
+    leader.start()
+    started.wait()
+    try:
+        with pytest.raises(deadlines.DeadlineExceeded):
+            _with_deadline(0.1, lambda: single_flight.do("user-18", blocked_call))
+        assert leader.is_alive()
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_single_flight_retries_expired_call():
+    """
+    Test that when the caller running the shared call runs out of time, waiting
+    callers run the call again instead of failing with it.
+    """
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            started.set()
+            release.wait()
+            raise deadlines.DeadlineExceeded("the leader ran out of time")
+        return {"manifests": []}
+
+    errors = []
+
+    def lead():
+        try:
+            single_flight.do("user-18", call)
+        except deadlines.DeadlineExceeded as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    follower_result = []
+    follower = threading.Thread(
+        target=lambda: follower_result.append(single_flight.do("user-18", call))
+    )
+    follower.start()
+    while single_flight.coalesced == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(errors) == 1
+    assert follower_result == [{"manifests": []}]
+    assert len(calls) == 2
@@ -0,0 +1,283 @@
+import json
+
+import pytest
+
+from manifestservice.streaming import (
+    InvalidRecord,
+    ManifestFormatError,
+    ManifestSummary,
+    build_offset_index,
+    byte_range_for_records,
+    iter_json_array,
+    project_and_slice,
+    scan_json_array,
+    serialize_records,
+    serialize_with_offsets,
+)
+
+
+def _chunked(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_array_any_chunking():
+    """
+    Test that records are parsed correctly wherever the chunk boundaries fall,
+    including inside numbers and multi-byte characters.
+    """
+    records = [
+        {"object_id": "a", "subject_id": 12345},
+        {"object_id": "bé中", "nested": {"k": [1, 2.5, None]}},
+        {"object_id": "c"},
+    ]
+    data = json.dumps(records).encode("utf-8")
+    for size in range(1, 20):
+        assert list(iter_json_array(_chunked(data, size))) == records
+    assert list(iter_json_array(_chunked(b"[1, 23, 456]", 1))) == [1, 23, 456]
+    assert list(iter_json_array([b"  [ ] "])) == []
+
+
+def test_iter_json_array_quote_fix():
+    """
+    Test that single-quoted documents are handled the same way as
+    _get_file_contents(), and that valid JSON is parsed as is.
+    """
+    data = b"[ { 'object_id': 'a'}, {'object_id': 'b'}]"
+    for size in (1, 3, len(data)):
+        records = list(iter_json_array(_chunked(data, size), quote_fix=True))
+        assert records == [{"object_id": "a"}, {"object_id": "b"}]
+
+    records = [{"file_name": "O'Brien.txt"}, {"file_name": "'", "n": 1}]
+    data = json.dumps(records).encode()
+    for size in (1, 3, len(data)):
+        assert list(iter_json_array(_chunked(data, size), quote_fix=True)) == records
+
+
+def test_iter_json_array_invalid():
+    """
+    Test that documents that are not (complete) JSON arrays are rejected.
+    """
+    for data in [b'{"a": 1}', b'[{"a": 1}', b'[{"a": 1} {"b": 2}]', b""]:
+        with pytest.raises(ManifestFormatError):
+            list(iter_json_array([data]))
+
+
+def test_iter_json_array_bounded():
+    """
+    Test that an invalid document fails as soon as the buffered data goes over
+    max_record_size, without reading the rest of the input.
+    """
+    for start, filler in [(b'{"a" 2', b" 3"), (b'{"a": "', b"x")]:
+        read = []
+
+        def chunks():
+            yield b'[{"a": 1}, ' + start
+            for i in range(1000):
+                read.append(i)
+                yield filler * 10
+
+        records = iter_json_array(chunks(), max_record_size=100)
+        assert next(records) == {"a": 1}
+        with pytest.raises(ManifestFormatError):
+            next(records)
+        assert len(read) < 20
+
+    data = json.dumps([{"a": "x" * 50}, {"a": "y" * 50}]).encode()
+    assert len(list(iter_json_array(_chunked(data, 7), max_record_size=70))) == 2
+
+
+def test_project_and_slice_is_lazy():
+    """
+    Test that no more records than needed are consumed.
+    """
+    consumed = []
+
+    def records():
+        for i in range(1000):
+            consumed.append(i)
+            yield {"object_id": i, "subject_id": -i}
+
+    result = list(project_and_slice(records(), ["object_id"], offset=5, limit=2))
+    assert result == [{"object_id": 5}, {"object_id": 6}]
+    assert len(consumed) == 7
+
+
+def test_serialize_records():
+    records = [{"a": 1}, {"a": 2}]
+    assert json.loads("".join(serialize_records(iter(records)))) == records
+    assert json.loads("".join(serialize_records(iter([])))) == []
+    lines = "".join(serialize_records(iter(records), "ndjson")).splitlines()
+    assert [json.loads(line) for line in lines] == records
+
+
+def test_GET_file_projection_and_slicing(client, s3):
+    """
+    Test the fields/offset/limit/format query parameters of GET /file/<name>.
+    """
+    manifest = [{"object_id": str(i), "subject_id": str(i % 3)} for i in range(10)]
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key="user-18/manifest-a.json",
+        Body=json.dumps(manifest).encode(),
+    )
+
+    r = client.get("/file/manifest-a.json?fields=object_id&offset=2&limit=3")
+    assert r.status_code == 200
+    assert r.json == [{"object_id": "2"}, {"object_id": "3"}, {"object_id": "4"}]
+
+    r = client.get("/file/manifest-a.json?offset=8&format=ndjson")
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in r.data.splitlines()] == manifest[8:]
+
+    r = client.get("/file/manifest-a.json?offset=20")
+    assert r.status_code == 200
+    assert r.json == []
+
+    for query in ["limit=-1", "offset=a", "format=csv"]:
+        r = client.get("/file/manifest-a.json?" + query)
+        assert r.status_code == 400
+
+    r = client.get("/file/manifest-missing.json?limit=1")
+    assert r.status_code == 404
+
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-b.json", Body=b'{"a": 1}'
+    )
+    r = client.get("/file/manifest-b.json?limit=1")
+    assert r.status_code == 400
+
+    # a parse error after the first record fails the transfer
+    s3.client.put_object(
+        Bucket=s3.bucket, Key="user-18/manifest-c.json", Body=b'[{"a": 1}, {"a": ]'
+    )
+    r = client.get("/file/manifest-c.json?limit=2")
+    assert r.status_code == 200
+    with pytest.raises(ManifestFormatError):
+        r.get_data()
+
+
+def test_GET_file_quotes(client, s3):
+    """
+    Test that records containing single quotes are returned as stored, in any
+    position, and that manifests stored with single quotes can still be read,
+    whole or sliced.
+    """
+    manifest = [
+        {"object_id": "a", "file_name": "O'Brien.txt"},
+        {"object_id": "b", "file_name": "d'Arcy.txt"},
+    ]
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key="user-18/manifest-a.json",
+        Body=json.dumps(manifest).encode(),
+    )
+    r = client.get("/file/manifest-a.json")
+    assert json.loads(r.data) == manifest
+    r = client.get("/file/manifest-a.json?offset=0")
+    assert r.status_code == 200
+    assert r.json == manifest
+    r = client.get("/file/manifest-a.json?offset=1&fields=file_name")
+    assert r.status_code == 200
+    assert r.json == [{"file_name": "d'Arcy.txt"}]
+
+    s3.client.put_object(
+        Bucket=s3.bucket,
+        Key="user-18/manifest-b.json",
+        Body=str([{"object_id": "a"}, {"object_id": "b"}]).encode(),
+    )
+    r = client.get("/file/manifest-b.json?fields=object_id")
+    assert r.json == [{"object_id": "a"}, {"object_id": "b"}]
+    r = client.get("/file/manifest-b.json")
+    assert json.loads(r.data) == [{"object_id": "a"}, {"object_id": "b"}]
+
+
+def test_serialize_with_offsets():
+    """
+    Test that manifests are serialized exactly like json.dumps(), and that the
+    offsets point at the start of every stride-th record.
+    """
+    records = [{"object_id": "é" * i, "n": i} for i in range(10)]
+    body, offsets = serialize_with_offsets(records, 3)
+    assert body == json.dumps(records).encode("utf-8")
+    assert len(offsets) == 4
+    for i, offset in enumerate(offsets):
+        assert next(iter_json_array([body[offset:]], partial=True)) == records[i * 3]
+
+    assert serialize_with_offsets([], 3) == (b"[]", [])
+
+
+def test_scan_json_array():
+    """
+    Test that the offsets found in a body as sent point at the start of every
+    stride-th record, whatever the whitespace and encoding, and that invalid
+    bodies are rejected.
+    """
+    records = [{"object_id": "é" * i, "n": i} for i in range(10)]
+    body = (
+        b" [\n"
+        + b" ,\n".join(json.dumps(r, ensure_ascii=False).encode() for r in records)
+        + b"\n] "
+    )
+    summary = ManifestSummary()
+    count, offsets = scan_json_array(body, 3, summary)
+    assert count == summary.records == 10
+    assert summary.to_dict()["size"] == len(body)
+    assert len(offsets) == 4
+    for i, offset in enumerate(offsets):
+        assert next(iter_json_array([body[offset:]], partial=True)) == records[i * 3]
+    assert scan_json_array(b"[ ]", 3) == (0, [])
+
+    for data in [b"", b"{}", b"[1", b"[1,]", b"[1 2]", b"[1] 2", b"[\xff]"]:
+        with pytest.raises(ValueError):
+            scan_json_array(data)
+    with pytest.raises(InvalidRecord):
+        scan_json_array(b"[{}, 1]", validate=lambda record: record == {})
+
+
+def test_byte_range_for_records():
+    records = [{"object_id": str(i)} for i in range(10)]
+    body, offsets = serialize_with_offsets(records, 3)
+    index = build_offset_index(offsets, 3, len(records), len(body))
+
+    for offset in range(10):
+        for limit in [None, 1, 2, 3, 5, 20]:
+            first, last, skip = byte_range_for_records(index, offset, limit)
+            chunk = body[first : last + 1]
+            result = list(
+                project_and_slice(
+                    iter_json_array([chunk], partial=True), offset=skip, limit=limit
+                )
+            )
+            end = None if limit is None else offset + limit
+            assert result == records[offset:end]
+    assert byte_range_for_records(index, 10, 1) is None
+
+
+def test_GET_file_slicing_with_offset_index(client, s3):
+    """
+    Test that with an offset index, slices are served from a ranged GET of the
+    manifest, and that the index is not listed as a manifest.
+    """
+    client.application.config["manifest_index_stride"] = 4
+    manifest = [{"object_id": str(i), "subject_id": "s"} for i in range(50)]
+
+    r = client.post("/", json=manifest)
+    assert r.status_code == 200
+    filename = r.json["filename"]
+
+    r = client.get("/")
+    assert [f["filename"] for f in r.json["manifests"]] == [filename]
+
+    s3.requests.clear()
+    r = client.get(f"/file/{filename}?offset=33&limit=5&fields=object_id")
+    assert r.status_code == 200
+    assert r.json == [{"object_id": str(i)} for i in range(33, 38)]
+    ranged = [req for req in s3.requests if "Range" in req.headers]
+    assert len(ranged) == 1
+
+    r = client.get(f"/file/{filename}?offset=45")
+    assert r.json == manifest[45:]
+
+    r = client.get(f"/file/{filename}")
+    assert json.loads(r.data) == manifest
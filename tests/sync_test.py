@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from manifestservice import retention
+from manifestservice.sync import (
+    InvalidSyncToken,
+    SyncToken,
+    change_name,
+    parse_change_name,
+)
+
+
+def test_change_names_sort_by_time():
+    first = change_name("cohorts", "dg.test/5183a350", time_ns=999)
+    second = change_name("manifests", "manifest.json", time_ns=1000)
+    assert first < second
+    assert parse_change_name(first) == (999, "cohorts", "dg.test/5183a350")
+    assert SyncToken(1000).start_after < second
+    assert SyncToken(1001).start_after > second
+
+
+def test_sync_token_round_trip():
+    token = SyncToken(1234, ["a", "b"])
+    decoded = SyncToken.decode(token.encode())
+    assert decoded.watermark == 1234
+    assert decoded.seen == {"a", "b"}
+    assert "=" not in token.encode()
+
+    for invalid in ["", "not-a-token", SyncToken(1).encode()[:-3]]:
+        with pytest.raises(InvalidSyncToken):
+            SyncToken.decode(invalid)
+
+
+def test_GET_delta_listing(client, s3):
+    """
+    Test that listings return a sync token, and that listing with that token
+    only returns the files added since, without repeating them.
+    """
+    client.post("/", json=[{"object_id": "a"}])
+    r = client.get("/")
+    assert r.json["delta"] is False
+    assert len(r.json["manifests"]) == 1
+    assert r.json["sync_token"]
+
+    # full listings may be repeated in the first delta, within the overlap
+    client.application.config["sync_overlap"] = 0
+    time.sleep(0.01)
+    token = client.get("/").json["sync_token"]
+
+    new_manifest = client.post("/", json=[{"object_id": "b"}]).json["filename"]
+    guid = "5183a350-9d56-4084-8a03-6471cafeb7fe"
+    client.post("/cohorts", json={"guid": guid})
+
+    r = client.get("/", query_string={"since": token})
+    assert r.json["delta"] is True
+    assert [m["filename"] for m in r.json["manifests"]] == [new_manifest]
+    r = client.get("/cohorts", query_string={"since": token})
+    assert [c["filename"] for c in r.json["cohorts"]] == [guid]
+
+    # files already returned are not returned again
+    client.application.config["sync_overlap"] = 60
+    r = client.get("/", query_string={"since": token})
+    token = r.json["sync_token"]
+    r = client.get("/", query_string={"since": token})
+    assert r.json == {
+        "manifests": [],
+        "sync_token": token,
+        "delta": True,
+        "deleted": [],
+    }
+
+
+def test_GET_delta_listing_deletions(client, s3):
+    """
+    Test that deltas report the files deleted since the token, by the service
+    or by the retention job, and only the last change of a file.
+    """
+    client.application.config["sync_overlap"] = 0
+    first = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+    second = client.post("/", json=[{"object_id": "b"}]).json["filename"]
+    client.post("/", json=[{"object_id": "d"}])
+    time.sleep(0.01)
+    token = client.get("/").json["sync_token"]
+
+    assert client.delete("/file/" + first).status_code == 200
+    third = client.post("/", json=[{"object_id": "c"}]).json["filename"]
+    assert client.delete("/file/" + third).status_code == 200
+    r = client.get("/", query_string={"since": token})
+    assert r.json["manifests"] == []
+    assert r.json["deleted"] == sorted([first, third])
+    r = client.get("/cohorts", query_string={"since": token})
+    assert r.json["deleted"] == []
+
+    token = r.json["sync_token"]
+    retention.main(["--bucket", s3.bucket, "--keep", "1"])
+    r = client.get("/", query_string={"since": token})
+    assert r.json["deleted"] == [second]
+
+
+def test_GET_delta_listing_resync(client, s3):
+    """
+    Test that an expired token gets a full listing and an invalid one a 400.
+    """
+    client.post("/", json=[{"object_id": "a"}])
+    token = SyncToken(time.time_ns() - int(2e9)).encode()
+    client.application.config["sync_token_max_age"] = 1
+
+    r = client.get("/metadata", query_string={"since": token})
+    assert r.status_code == 200
+    assert r.json["delta"] is False
+
+    r = client.get("/", query_string={"since": token})
+    assert r.json["delta"] is False
+    assert len(r.json["manifests"]) == 1
+
+    r = client.get("/cohorts", query_string={"since": "not-a-token"})
+    assert r.status_code == 400
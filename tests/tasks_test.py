@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from manifestservice import tasks
+
+calls = []
+failures = {"count": 0}
+release = threading.Event()
+
+
+@tasks.task
+def _record(value):
+    if failures["count"] > 0:
+        failures["count"] -= 1
+        raise ValueError("injected")
+    calls.append(value)
+
+
+@tasks.task
+def _blocked(value):
+    release.wait(5)
+    calls.append(value)
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    calls.clear()
+    failures["count"] = 0
+    release.clear()
+    yield
+    release.set()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_executor_retries_failed_tasks(app):
+    """
+    Test that failed tasks are retried with backoff, and given up on after
+    max_attempts.
+    """
+    executor = tasks.TaskExecutor(app, workers=2, max_attempts=3, retry_delay=0.01)
+    failures["count"] = 2
+    assert executor.submit(tasks._task_name(_record), ["a"])
+    _wait_for(lambda: calls == ["a"])
+    assert executor.stats()["retried"] == 2
+
+    failures["count"] = 3
+    executor.submit(tasks._task_name(_record), ["b"])
+    _wait_for(lambda: executor.stats()["failed"] == 1)
+    assert calls == ["a"]
+    stats = executor.stats()
+    assert stats["completed"] == 1
+    assert stats["latency_p50"] is not None
+    assert executor.shutdown(1) == 0
+
+
+def test_executor_bounded_queue_and_drain(app):
+    """
+    Test that tasks beyond the queue size are refused (and run by the caller),
+    and that shutdown drains the queue.
+    """
+    executor = tasks.TaskExecutor(app, workers=1, max_queue=2)
+    name = tasks._task_name(_blocked)
+    assert executor.submit(name, [1])
+    _wait_for(lambda: executor.stats()["running"] == 1)
+    assert executor.submit(name, [2])
+    assert executor.submit(name, [3])
+    assert not executor.submit(name, [4])
+    assert executor.stats()["queued"] == 2
+
+    # not done before the timeout
+    assert executor.shutdown(0.05) == 3
+    release.set()
+    assert executor.shutdown(5) == 0
+    assert calls == [1, 2, 3]
+    assert not executor.submit(name, [5])
+
+
+def test_durable_queue_recovery(app, tmp_path):
+    """
+    Test that tasks left in the durable queue by a worker process that exited
+    are run by the next executor, and removed once done.
+    """
+    dead_worker = tmp_path / "999999999"
+    dead_worker.mkdir()
+    task = tasks._Task(tasks._task_name(_record), ["recovered"])
+    (dead_worker / f"{task.id}.json").write_text(json.dumps(task.to_dict()))
+    running_worker = tmp_path / str(os.getppid())
+    running_worker.mkdir()
+    (running_worker / "other.json").write_text("{}")
+
+    executor = tasks.TaskExecutor(app, queue_path=str(tmp_path))
+    _wait_for(lambda: calls == ["recovered"])
+    executor.submit(tasks._task_name(_record), ["new"])
+    _wait_for(lambda: calls == ["recovered", "new"])
+    assert executor.shutdown(1) == 0
+    assert not dead_worker.exists()
+    assert os.listdir(tmp_path / str(os.getpid())) == []
+    assert os.listdir(running_worker) == ["other.json"]
+
+
+def test_background_tasks_on_upload(client, s3):
+    """
+    Test that with background_tasks, manifest summaries are stored after the
+    upload's response, and that stats are reported.
+    """
+    client.application.config["background_tasks"] = True
+    filename = client.post("/", json=[{"object_id": "a"}]).json["filename"]
+
+    def summary():
+        manifests = client.get("/?include=summary").json["manifests"]
+        return manifests[0]["summary"]
+
+    _wait_for(summary)
+    assert summary()["record_count"] == 1
+    r = client.get("/")
+    assert [m["filename"] for m in r.json["manifests"]] == [filename]
+
+    tasks.shutdown(client.application, 5)
+    r = client.get("/_status/tasks")
+    assert r.status_code == 200
+    assert r.json["queued"] == 0
+    assert r.json["completed"] >= 1
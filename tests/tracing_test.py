@@ -0,0 +1,168 @@
+import contextvars
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from manifestservice import tracing
+
+
+def _read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_server_timing(client, s3):
+    client.application.config["server_timing"] = True
+    r = client.post("/", json=[{"object_id": "a"}])
+    timings = dict(
+        item.split(";dur=") for item in r.headers["Server-Timing"].split(", ")
+    )
+    for name in ["list_files", "validate", "upload", "s3.PutObject", "total"]:
+        assert name in timings
+    assert float(timings["total"]) >= float(timings["upload"])
+
+    client.application.config["server_timing"] = False
+    assert "Server-Timing" not in client.get("/").headers
+
+
+def test_sampled_traces_exported(client, s3, tmp_path):
+    """
+    Test that the spans of sampled requests are exported with their attributes,
+    including s3 retries.
+    """
+    path = tmp_path / "traces.jsonl"
+    client.application.config["tracing_sample_rate"] = 1
+    client.application.config["tracing_exporter"] = "file"
+    client.application.config["tracing_file_path"] = str(path)
+
+    s3.failures = 1
+    s3.error = "503"
+    client.post("/", json=[{"object_id": "a"}, {"object_id": "b"}])
+
+    exported = _read_spans(path)
+    spans = {span["name"]: span for span in exported}
+    root = spans["request"]
+    assert root["parent_id"] is None
+    assert root["attributes"]["status"] == 200
+    assert root["attributes"]["route"] == "/"
+    assert spans["list_files"]["parent_id"] == root["span_id"]
+    assert spans["list_files"]["attributes"]["object_count"] == 0
+    assert spans["validate"]["attributes"]["records"] == 2
+    # the first s3 call (the listing) was retried
+    assert spans["s3.ListObjectsV2"]["attributes"]["retries"] == 1
+    assert spans["s3.ListObjectsV2"]["parent_id"] == spans["list_files"]["span_id"]
+    (put,) = [s for s in exported if s["parent_id"] == spans["upload"]["span_id"]]
+    assert put["name"] == "s3.PutObject"
+    assert put["attributes"]["bytes_sent"] == spans["validate"]["attributes"]["bytes"]
+    assert len({span["trace_id"] for span in exported}) == 1
+
+    client.application.config["tracing_sample_rate"] = 0
+    client.get("/")
+    assert len(_read_spans(path)) == len(exported)
+
+
+def test_streamed_listing_traced(client, s3, tmp_path):
+    """
+    Test that the serialization of streamed listings, which happens after the
+    request handler has returned, is traced, and that the trace is exported once
+    the response is sent.
+    """
+    path = tmp_path / "traces.jsonl"
+    client.application.config["tracing_sample_rate"] = 1
+    client.application.config["tracing_exporter"] = "file"
+    client.application.config["tracing_file_path"] = str(path)
+    s3.client.put_object(Bucket=s3.bucket, Key="user-18/manifest-a.json", Body=b"[]")
+
+    r = client.get("/")
+    assert r.json["manifests"][0]["filename"] == "manifest-a.json"
+    r.close()
+
+    spans = {span["name"]: span for span in _read_spans(path)}
+    root = spans["request"]
+    serialize = spans["serialize"]
+    assert serialize["parent_id"] == root["span_id"]
+    assert serialize["attributes"]["records"] == 1
+    assert serialize["start"] >= spans["list_files"]["end"]
+    assert serialize["end"] is not None
+    assert root["end"] >= serialize["end"]
+
+
+def test_untraced_span_overhead():
+    assert tracing.span("phase") is tracing.NULL_SPAN
+    start = time.perf_counter()
+    for _ in range(10000):
+        with tracing.span("phase") as span:
+            span.set(bytes=1)
+    assert (time.perf_counter() - start) / 10000 < 5e-6
+
+
+def test_spans_on_threads():
+    """
+    Test that threads working for a request nest their spans under the span
+    open when they were started, without interfering with each other.
+    """
+    trace = tracing.start_trace("request")
+    with tracing.span("export") as export:
+
+        def work(i):
+            for _ in range(100):
+                with tracing.span(f"copy-{i}") as copy:
+                    with tracing.span("s3.PutObject") as put:
+                        assert put.parent_id == copy.span_id
+                    assert tracing.current_span() is copy
+            assert tracing.current_span() is export
+
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(work, i))
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert tracing.current_span() is export
+    assert tracing.current_span() is trace.root
+    tracing.end_trace(trace)
+
+    copies = [span for span in trace.spans if span.name.startswith("copy-")]
+    assert len(copies) == 400
+    assert {span.parent_id for span in copies} == {export.span_id}
+    assert len(trace.spans) == 2 + 800
+
+
+def test_otlp_exporter():
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.path, json.loads(body)))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Collector)
+    threading.Thread(target=server.handle_request, daemon=True).start()
+    exporter = tracing.OTLPExporter(f"http://127.0.0.1:{server.server_port}/v1/traces")
+
+    trace = tracing.start_trace("request", method="GET")
+    with tracing.span("list_files", object_count=3):
+        pass
+    tracing.end_trace(trace)
+    exporter.export(trace)
+
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    server.server_close()
+    path, body = received[0]
+    assert path == "/v1/traces"
+    spans = body["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [s["name"] for s in spans] == ["request", "list_files"]
+    assert spans[1]["parentSpanId"] == spans[0]["spanId"]
+    assert spans[1]["attributes"] == [
+        {"key": "object_count", "value": {"intValue": "3"}}
+    ]
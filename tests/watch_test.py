@@ -0,0 +1,109 @@
+import threading
+import time
+
+from manifestservice.watch import ChangeNotifier
+
+
+def test_change_notifier():
+    notifier = ChangeNotifier(max_waiters=2)
+    # folders without watchers are not tracked
+    notifier.notify("user-1")
+
+    with notifier.watch("user-1") as first, notifier.watch("user-2") as second:
+        with notifier.watch("user-1") as third:
+            assert third is None
+        assert first.wait(0.01) is False
+        notifier.notify("user-1")
+        # notifications between waits are not lost
+        assert first.wait(0) is True
+        assert second.wait(0) is False
+
+        threading.Timer(0.05, notifier.notify, ["user-2"]).start()
+        start = time.monotonic()
+        assert second.wait(5) is True
+        assert time.monotonic() - start < 1
+
+    assert notifier.waiters == 0
+    assert notifier._folders == {}
+
+
+def test_GET_watch(client, s3):
+    """
+    Test that a watch returns as soon as a file is uploaded, and after the
+    timeout if there is none.
+    """
+    token = client.get("/").json["sync_token"]
+    client.application.config["sync_overlap"] = 0
+
+    start = time.monotonic()
+    r = client.get("/watch", query_string={"since": token, "timeout": 0.2})
+    assert time.monotonic() - start >= 0.2
+    assert r.json["manifests"] == []
+    assert r.json["delta"] is True
+
+    app = client.application
+    manifest = [{"object_id": "a"}]
+    uploaded = {}
+
+    def upload():
+        time.sleep(0.2)
+        with app.test_client() as other_client:
+            uploaded.update(other_client.post("/", json=manifest).json)
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+    start = time.monotonic()
+    r = client.get("/watch", query_string={"since": token, "timeout": 20})
+    thread.join()
+    # woken up by the upload, not by the journal poll
+    assert time.monotonic() - start < 2
+    assert [m["filename"] for m in r.json["manifests"]] == [uploaded["filename"]]
+    assert r.json["cohorts"] == []
+
+    # deletions are changes too
+    token = r.json["sync_token"]
+
+    def delete():
+        with app.test_client() as other_client:
+            other_client.delete("/file/" + uploaded["filename"])
+
+    threading.Timer(0.2, delete).start()
+    start = time.monotonic()
+    r = client.get("/watch", query_string={"since": token, "timeout": 20})
+    assert time.monotonic() - start < 2
+    assert r.json["manifests"] == []
+    assert r.json["deleted"]["manifests"] == [uploaded["filename"]]
+
+    assert client.get("/watch").status_code == 400
+    assert client.get("/watch?since=x&timeout=soon").status_code == 400
+
+    # no waiting once too many requests are waiting: changes or a 503
+    client.application.config["watch_max_waiters"] = 0
+    app.extensions["manifestservice"].pop("change_notifier")
+    r = client.get("/watch", query_string={"since": token, "timeout": 20})
+    assert r.status_code == 200
+    assert r.json["deleted"]["manifests"] == [uploaded["filename"]]
+    r = client.get("/watch", query_string={"since": r.json["sync_token"]})
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "5"
+
+
+def test_GET_watch_other_worker(client, s3):
+    """
+    Test that uploads made by other workers are found by re-reading the change
+    journal.
+    """
+    client.application.config["watch_poll_interval"] = 0.1
+    client.application.config["sync_overlap"] = 0
+    token = client.get("/").json["sync_token"]
+
+    def upload():
+        s3.client.put_object(
+            Bucket=s3.bucket,
+            Key=f".sidecars/user-18/changes/{time.time_ns():020d}-cohorts/some-guid",
+            Body=b"",
+        )
+
+    threading.Timer(0.3, upload).start()
+    r = client.get("/watch", query_string={"since": token, "timeout": 5})
+    assert [c["filename"] for c in r.json["cohorts"]] == ["some-guid"]